@@ -0,0 +1,241 @@
+"""
+ASGI entry point: the routes of server.py served from an event loop
+
+usage: uvicorn asgi:app --host 0.0.0.0 --port 8080
+       hypercorn asgi:app --bind 0.0.0.0:8080
+
+Request bodies are read and responses are sent on the event loop, so slow clients and idle keep-alive connections don't hold a thread.
+The bottle handlers (and every DB Function) run on two bounded thread pools sized like the connection pools (see SQLitePoolPlugin):
+  * read_executor  - /get, /subscribe, /login, ... (DB_READ_POOL threads)
+  * write_executor - /add, /edit, /delete, /createTable, ... (DB_WRITE_POOL threads, writers queue on the event loop)
+Waiting costs no thread either:
+  * /subscribe long-polls and server-sent events wait on the event loop (waitForRowsAsync) and fetch on read_executor
+  * /ingest websockets read frames on the event loop and insert every frame on write_executor
+"""
+from concurrent.futures import ThreadPoolExecutor
+from db_functions import (
+    getTable, getTables, tableListing, clean, parseBody, ingestFrame, fetchNewRows,
+    waitForRowsAsync, streamRowsAsync, startRetention
+)
+from server import app as wsgi_app, plugin, dbfile
+import asyncio
+import json
+import time
+import sys
+import io
+import os
+
+
+read_executor = ThreadPoolExecutor(max_workers=plugin.read_pool.size, thread_name_prefix="db-read")
+write_executor = ThreadPoolExecutor(max_workers=plugin.write_pool.size, thread_name_prefix="db-write")
+
+
+# WSGI Bridge #################################################################
+def wsgiEnviron(scope, body):
+    # -- the WSGI environ bottle expects, built from an ASGI http scope
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "m2band.async": {},
+    }
+    for (name, value) in scope.get("headers", []):
+        name, value = name.decode("latin-1").upper().replace("-", "_"), value.decode("latin-1")
+        if name == "CONTENT_LENGTH":
+            continue
+        key = name if name == "CONTENT_TYPE" else f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+def callWSGI(environ):
+    # -- run the bottle app (on an executor thread): (status, headers, body chunks or iterator)
+    started = {}
+    def start_response(status, headers, exc_info=None):
+        started.update(status=int(status.split()[0]), headers=headers)
+    result = wsgi_app(environ, start_response)
+    if isinstance(result, (list, tuple)):
+        body = list(result)
+        if hasattr(result, "close"):
+            result.close()
+        return started["status"], started["headers"], body
+    return started["status"], started["headers"], result
+
+def nextChunk(iterator):
+    # -- next chunk of a generator response (on an executor thread), None when done
+    try:
+        return next(iterator)
+    except StopIteration:
+        if hasattr(iterator, "close"):
+            iterator.close()
+        return None
+
+def pooledFetch(table, conditions, values):
+    # -- fetch(cursor) for streamRowsAsync(): one read pool connection per fetch, not per subscriber
+    def fetch(cursor):
+        db = plugin.read_pool.acquire()
+        try:
+            return fetchNewRows(db, table, conditions, values, cursor)
+        finally:
+            plugin.read_pool.release(db)
+    return fetch
+
+
+# HTTP ########################################################################
+async def readBody(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+async def watchDisconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+async def sendStart(send, status, headers, drop=()):
+    headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for (k, v) in headers if k.lower() not in drop]
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+
+async def http(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    executor = read_executor if plugin.isRead(scope["path"]) else write_executor
+    body = await readBody(receive)
+    if body is None:
+        return
+    environ = wsgiEnviron(scope, body)
+    status, headers, chunks = await loop.run_in_executor(executor, callWSGI, environ)
+
+    # -- /subscribe long-poll: wait on the event loop, then run the handler again from the same cursor and deadline
+    while "wait" in environ["m2band.async"]:
+        wait = environ["m2band.async"]["wait"]
+        await waitForRowsAsync(wait["table"], wait["since"], wait["deadline"] - time.time())
+        environ = wsgiEnviron(scope, body)
+        environ["m2band.async"]["resume"] = {"since": wait["since"], "deadline": wait["deadline"]}
+        status, headers, chunks = await loop.run_in_executor(executor, callWSGI, environ)
+
+    # -- /subscribe server-sent events: streamed from the event loop until the client disconnects
+    stream = environ["m2band.async"].get("stream")
+    if stream:
+        await sendStart(send, status, headers, drop=("content-length",))
+        disconnected = asyncio.ensure_future(watchDisconnect(receive))
+        fetch = pooledFetch(stream["table"], stream["conditions"], stream["values"])
+        events = streamRowsAsync(fetch, stream["table"]["name"], stream["cursor"], stream["timeout"], executor)
+        try:
+            async for event in events:
+                if disconnected.done():
+                    break
+                await send({"type": "http.response.body", "body": event.encode(), "more_body": True})
+        finally:
+            disconnected.cancel()
+            await events.aclose()
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+        return
+
+    await sendStart(send, status, headers)
+    if isinstance(chunks, list):
+        await send({"type": "http.response.body", "body": b"".join(chunks), "more_body": False})
+        return
+    # -- generator response (compressed stream): every chunk is produced on the executor
+    while True:
+        chunk = await loop.run_in_executor(executor, nextChunk, chunks)
+        if chunk is None:
+            break
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+# WebSocket ###################################################################
+def insertFrame(table, frame):
+    # -- /ingest: one frame, one transaction on a write pool connection
+    db = plugin.write_pool.acquire()
+    try:
+        return ingestFrame(db, table, frame)
+    finally:
+        plugin.write_pool.release(db)
+
+def ingestTable(table_name):
+    db = plugin.read_pool.acquire()
+    try:
+        tables = getTables(db)
+        return tables, getTable(db, tables, table_name)
+    finally:
+        plugin.read_pool.release(db)
+
+async def websocket(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    if (await receive())["type"] != "websocket.connect":
+        return
+    parts = scope["path"].strip("/").split("/")
+    if parts[0] != "ingest":
+        await send({"type": "websocket.close", "code": 1008})
+        return
+    table_name = parts[1] if len(parts) > 1 else ""
+    tables, table = await loop.run_in_executor(read_executor, ingestTable, table_name)
+    await send({"type": "websocket.accept"})
+    if (not table) or (table_name == "users"):
+        res = {"message": "expected a websocket request for a table", "usage": "/ingest/usage",
+               "tables": [t["name"] for t in tables if t["name"] != "users"]}
+        await send({"type": "websocket.send", "text": json.dumps(clean(res), default=str)})
+        await send({"type": "websocket.close", "code": 1000})
+        return
+
+    # -- one frame in, one ack out: {"frame": 7, "rows": [...]} -> {"frame": 7, "count": 25, ...}
+    while True:
+        message = await receive()
+        if message["type"] == "websocket.disconnect":
+            break
+        try:
+            if message.get("bytes") is not None:
+                frame = parseBody(table, "application/msgpack", message["bytes"])
+            else:
+                frame = json.loads(message.get("text") or "")
+        except (ValueError, TypeError) as e:
+            ack = {"frame": None, "message": "invalid frame", "error": str(e)}
+        else:
+            ack = await loop.run_in_executor(write_executor, insertFrame, table, frame)
+        await send({"type": "websocket.send", "text": json.dumps(ack, default=str)})
+
+
+# Lifespan ####################################################################
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # -- Retention Policies: RETENTION_POLICIES='{"oximeter": {"max_age": "90 days", "max_rows": 100000}}'
+            retention_policies = json.loads(os.environ.get("RETENTION_POLICIES", "{}"))
+            if retention_policies:
+                startRetention(dbfile, retention_policies,
+                               interval=int(os.environ.get("RETENTION_INTERVAL", 3600)),
+                               chunk_size=int(os.environ.get("RETENTION_CHUNK_SIZE", 500)))
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            read_executor.shutdown(wait=False)
+            write_executor.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "http":
+        await http(scope, receive, send)
+    elif scope["type"] == "websocket":
+        await websocket(scope, receive, send)
+    elif scope["type"] == "lifespan":
+        await lifespan(scope, receive, send)
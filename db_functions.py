@@ -5,17 +5,66 @@ All functions use "parametrized queries" to prevent SQL injection attacks.
 All functions support a full SQL [query] or a python [dict]
 
 # -- insertRow()    - Insert data into the database
+# -- insertRows()   - Insert multiple rows into the database (executemany)
+# -- upsertRow()    - Insert a row or update the row with the same natural key (INSERT ... ON CONFLICT)
 # -- fetchRow()     - Fetch a single row from a table in the database
 # -- fetchRows()    - Fetch multiple rows from a table in the database
 # -- updateRow()    - Update data in the database
+# -- updateRows()   - Update many rows with different values (executemany per set of changed columns)
 # -- deleteRow()    - Delete row(s) from the database
 
 # Overview of Helper Functions #
 # -- securePassword()   - create a password (sha256 hash, salt, and iterate)
 # -- checkPassword()    - check if password matches
 # -- clean()            - sanitize data for json delivery
+
+# Overview of Static Responses #
+# -- staticResponse()   - pre-serialized usage responses with an ETag
+# -- tableListing()     - pre-serialized table listing, rebuilt when the schema changes
+# -- getTables()        - cached until PRAGMA schema_version changes
+
+# Overview of Generation Functions #
+# -- bumpGeneration()   - mark a table as changed (called by every write)
+# -- discardRowIds()    - forget the new rowids of rolled back writes (they are not published to /subscribe)
+# -- getETag()          - (weak) ETag for a query from the table's generation
+# -- result_cache       - LRU cache of serialized /get responses (ResultCache)
+# -- single_flight      - identical in-flight /get queries run once and share the response (SingleFlight)
+
+# Overview of Slow Query Functions #
+# -- timedExecute()     - db.execute() timed by the slow query log (used by all DB Functions)
+# -- slow_query_log     - ring buffer and log file of slow queries with their EXPLAIN QUERY PLAN (SlowQueryLog)
+
+# Overview of Subscription Functions #
+# -- waitForRows()      - sleep until rows newer than a cursor are committed to a table
+# -- fetchNewRows()     - fetch the rows newer than a cursor
+# -- lastRowId()        - the newest row id of a table (every shard): the default cursor
+# -- streamRows()       - server-sent events for newly inserted rows
+# -- waitForRowsAsync() - waitForRows() for an event loop (asgi.py)
+# -- streamRowsAsync()  - streamRows() for an event loop (asgi.py)
+# -- ingestFrame()      - validate and insert a frame of samples from /ingest
+
+# Overview of Sharding Functions #
+# -- configureShards()  - enable sharding: user-scoped tables in N database files by crc32(user_id)
+# -- shardConnections() - this thread's connections to every shard
+# -- commitShards()     - commit (or roll back) the shards at the end of a request
+
+# Overview of Connection Pools #
+# -- SQLitePoolPlugin   - hands each request a pooled connection: read pool (query_only, snapshot) or write pool
+# -- ConnectionPool     - a pool of configured connections to one database file
+
+# Overview of Admission Control #
+# -- AdmissionPlugin    - token buckets per client IP / user_id and route class (429), concurrency cap and load shedding (503)
+
+# Overview of Retention Functions #
+# -- purgeTable()       - delete rows outside of a retention policy in small chunks
+# -- startRetention()   - enforce retention policies from a background thread
+
+# Overview of Chunked Writes #
+# -- startWriteJob()    - run a large /delete or /edit in rowid-ranged chunks from a background thread (WriteJob)
+# -- write_jobs         - the latest jobs: progress, status and cancellation
 """
-from bottle import request, response, FormsDict, template, json_dumps, JSONPlugin
+from bottle import request, response, FormsDict, template, json_dumps, JSONPlugin, HTTPResponse, HTTPError
+from collections import OrderedDict, deque
 from datetime import datetime
 from functools import wraps
 # from pathlib import Path
@@ -23,16 +72,43 @@ from rich import print, inspect
 from bs4 import BeautifulSoup
 # import subprocess
 import traceback
+import asyncio
+import copy
 import logging
 import sqlite3
 import hashlib
+import threading
 import codecs
-# import time
+import time
 import json
 import sys
+import struct
+import queue
+import math
+import zlib
 import os
 import re
 
+# -- optional compression formats
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# -- optional binary body formats
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
 ###############################################################################
 #                              CREATE OPERATIONS                              #
 ###############################################################################
@@ -73,6 +149,8 @@ def insertRow(db, query="", **kwargs):
         }
         user_id = insertRow(db, **params)
     """
+    if shardRoute(db, query, kwargs):
+        return shardedInsertRow(db, **kwargs)
     if query:
         table = ""
         columns = []
@@ -81,12 +159,13 @@ def insertRow(db, query="", **kwargs):
         # table      = kwargs["table"]
         table = kwargs["table"]["name"] if isinstance(kwargs.get("table"), dict) else kwargs.get("table")
         columns = kwargs["columns"]
-        col_values = kwargs["col_values"]
+        col_values = [toEpoch(v) if c in epochColumns(kwargs["table"]) else v
+                      for (c, v) in zip(columns, kwargs["col_values"])]
         query = f"INSERT INTO {table} ({','.join(columns)}) VALUES ({', '.join(['?']*len(columns))});"
     print(query, col_values) if col_values else print(query)
 
     try:
-        cur = db.execute(query, col_values) if col_values else db.execute(query)
+        cur = timedExecute(db, query, col_values)
     except sqlite3.Error as e:
         exc_type, exc_value, exc_tb = sys.exc_info()
         tb_msgs = traceback.format_exception(exc_type, exc_value, exc_tb)
@@ -108,10 +187,126 @@ def insertRow(db, query="", **kwargs):
     #     print(e.args)
     #     return {"SQLite_Error": e.args, "query": query, "col_values": col_values, "kwargs": kwargs}
 
+    bumpGeneration(table or query, rowid=cur.lastrowid)
     # if cur:
     return cur.lastrowid
     # return False
 
+def insertRows(db, query="", **kwargs):
+    """
+    Insert multiple rows into the database with a single statement (executemany)
+
+    ARGS:
+        Required - db (object)          - the database connection object
+        Optional - query (str)          - a complete SQL query
+
+        Required - table (str)          - the table to insert data into
+        Required - columns (list)       - the columns to edit
+        Required - rows (list[list])    - the values for the columns, one (list) per row
+    RETURNS:
+        lastrowids (list) OR False - the IDs of the inserted rows
+
+    EXAMPLE: with [params] directly
+        entry_ids = insertRows(db,
+                               table="oximeter",
+                               columns=["user_id", "heart_rate", "blood_o2", "temperature"],
+                               rows=[[5, 80, 97, 98.1], [5, 82, 97, 98.2]])
+    """
+    if shardRoute(db, query, kwargs):
+        return shardedInsertRows(db, **kwargs)
+    if query:
+        table = ""
+        columns = []
+        rows = kwargs.get("rows")
+    else:
+        table = kwargs["table"]["name"] if isinstance(kwargs.get("table"), dict) else kwargs.get("table")
+        columns = kwargs["columns"]
+        epoch_cols = [i for (i, c) in enumerate(columns) if c in epochColumns(kwargs["table"])]
+        rows = [[toEpoch(v) if i in epoch_cols else v for (i, v) in enumerate(row)] for row in kwargs["rows"]]
+        query = f"INSERT INTO {table} ({','.join(columns)}) VALUES ({', '.join(['?']*len(columns))});"
+    print(query, f"{len(rows)} rows")
+
+    try:
+        cur = timedExecute(db, query, rows, many=True)
+        lastrowid = db.execute("SELECT last_insert_rowid();").fetchone()[0]
+    except sqlite3.Error as e:
+        exc_type, exc_value, exc_tb = sys.exc_info()
+        tb_msgs = traceback.format_exception(exc_type, exc_value, exc_tb)
+        if isinstance(tb_msgs, list):
+            tb_msgs = ''.join(tb_msgs).splitlines()
+        err = {
+            f'SQLite.{e.__class__.__name__}': f'{" ".join(e.args)}',
+            'Debug Info': {
+                "query": query,
+                "parsed": {"table": table, "columns": columns, "rows": len(rows)}
+            },
+            'SQLite Traceback': tb_msgs
+        }
+        print(err)
+        return err
+
+    bumpGeneration(table or query, rowid=lastrowid)
+    return list(range(lastrowid - cur.rowcount + 1, lastrowid + 1))
+
+def upsertRow(db, **kwargs):
+    """
+    Insert a row, or update (or keep) the existing row with the same natural key, in a single statement
+
+    ARGS:
+        Required - db (object)          - the database connection object
+
+        Required - table (str)          - the table to insert data into
+        Required - columns (list)       - the columns to insert
+        Required - col_values (list)    - the values for the columns
+        Required - conflict (list)      - the natural key: the columns of a unique index (example: ["user_id", "entry_time"])
+        Optional - on_conflict (str)    - "update" the existing row with the new values OR do "nothing" (default: "update")
+    RETURNS:
+        (row_id, action) OR error (dict) - the ID of the new or updated row (None when ignored)
+                                           and the action: "inserted", "updated" or "ignored"
+
+    EXAMPLE:
+        row_id, action = upsertRow(db,
+                                   table="oximeter",
+                                   columns=["user_id", "heart_rate", "blood_o2", "temperature", "steps", "entry_time"],
+                                   col_values=[8, 133, 95, 98.71, 3, "2022-04-05 12:16:54.651"],
+                                   conflict=["user_id", "entry_time"],
+                                   on_conflict="nothing")
+    """
+    if shardRoute(db, "", kwargs):
+        return shardedUpsertRow(db, **kwargs)
+    table = kwargs["table"]["name"] if isinstance(kwargs.get("table"), dict) else kwargs.get("table")
+    ref = getColumns(db, shardTable(db, kwargs["table"]), ref=True)
+    columns, conflict = kwargs["columns"], kwargs["conflict"]
+    col_values = [toEpoch(v) if c in epochColumns(kwargs["table"]) else v
+                  for (c, v) in zip(columns, kwargs["col_values"])]
+
+    # -- INSERT INTO oximeter (...) VALUES (?, ...) ON CONFLICT (user_id,entry_time) DO UPDATE SET heart_rate=excluded.heart_rate, ... RETURNING entry_id;
+    updates = [f"{c}=excluded.{c}" for c in columns if (c not in conflict) and (c not in (ref, "user_id"))]
+    action = f"DO UPDATE SET {', '.join(updates)}" if (kwargs.get("on_conflict", "update") == "update") and updates else "DO NOTHING"
+    query = (f"INSERT INTO {table} ({','.join(columns)}) VALUES ({', '.join(['?']*len(columns))}) "
+             f"ON CONFLICT ({','.join(conflict)}) {action} RETURNING {ref};")
+    print(query, col_values)
+
+    try:
+        before = db.execute("SELECT last_insert_rowid();").fetchone()[0]
+        rows = timedExecute(db, query, col_values, fetch="all")
+        after = db.execute("SELECT last_insert_rowid();").fetchone()[0]
+    except sqlite3.Error as e:
+        err = {
+            f'SQLite.{e.__class__.__name__}': f'{" ".join(e.args)}',
+            'Debug Info': {"query": query, "kwargs": kwargs}
+        }
+        print(err)
+        return err
+
+    if not rows:
+        return None, "ignored"
+    # -- an insert changes last_insert_rowid(), an update doesn't
+    row_id = rows[0][0]
+    inserted = (after != before) and (after == row_id)
+    bumpGeneration(table, rowid=row_id if inserted else 0)
+    return row_id, "inserted" if inserted else "updated"
+
 ###############################################################################
 #                               READ OPERATIONS                               #
 ###############################################################################
@@ -148,6 +343,8 @@ def fetchRow(db, query="", **kwargs):
         }
         row = fetchRow(db, **params)
     """
+    if shardRoute(db, query, kwargs):
+        return shardedFetchRow(db, **kwargs)
     if query:
         table = ""
         columns = []
@@ -159,11 +356,12 @@ def fetchRow(db, query="", **kwargs):
         columns = "*" if not kwargs.get("columns") else ",".join(kwargs["columns"])
         condition = "1" if not kwargs.get("where") else f'{kwargs["where"]}'
         values = [kwargs.get("values")] if isinstance(kwargs.get("values"), str) else kwargs.get("values")
+        values = parseEpochValues(kwargs["table"], condition, values)
         query = f"SELECT {columns} FROM {table} WHERE {condition};"
     print(query, values) if values else print(query)
 
     try:
-        row = db.execute(query, values).fetchone() if values else db.execute(query).fetchone()
+        row = timedExecute(db, query, values, fetch="one")
     except sqlite3.Error as e:
         exc_type, exc_value, exc_tb = sys.exc_info()
         tb_msgs = traceback.format_exception(exc_type, exc_value, exc_tb)
@@ -224,6 +422,8 @@ def fetchRows(db, query="", **kwargs):
         }
         rows = fetchRows(db, **params)
     """
+    if shardRoute(db, query, kwargs):
+        return shardedFetchRows(db, **kwargs)
     if query:
         table = ""
         columns = []
@@ -234,11 +434,12 @@ def fetchRows(db, query="", **kwargs):
         columns = "*" if not kwargs.get("columns") else ",".join(kwargs["columns"])
         condition = "1" if not kwargs.get("where") else f'{kwargs["where"]}'
         values = [kwargs.get("values")] if isinstance(kwargs.get("values"), str) else kwargs.get("values")
+        values = parseEpochValues(kwargs["table"], condition, values)
         query = f"SELECT {columns} FROM {table} WHERE {condition};"
     print(query, values) if values else print(query)
 
     try:
-        rows = db.execute(query, values).fetchall() if values else db.execute(query).fetchall()
+        rows = timedExecute(db, query, values, fetch="all")
     except sqlite3.Error as e:
         exc_type, exc_value, exc_tb = sys.exc_info()
         tb_msgs = traceback.format_exception(exc_type, exc_value, exc_tb)
@@ -312,6 +513,8 @@ def updateRow(db, query="", **kwargs):
         }
         num_edits = updateRow(db, **params)
     """
+    if shardRoute(db, query, kwargs):
+        return shardedUpdateRow(db, **kwargs)
     if query:
         table = ""
         columns = []
@@ -323,11 +526,13 @@ def updateRow(db, query="", **kwargs):
         columns, col_values = parseColumnValues(kwargs["columns"], kwargs["col_values"])
         condition = f'({kwargs["where"]})'
         values = [kwargs["values"]] if isinstance(kwargs["values"], str) else kwargs["values"]
+        col_values = parseEpochValues(kwargs["table"], columns, col_values)
+        values = parseEpochValues(kwargs["table"], condition, values)
         query = f"UPDATE {table} SET {columns} WHERE {condition};"
     print(query, col_values, values) if (col_values and values) else print(query)
 
     try:
-        cur = db.execute(query, col_values+values) if (col_values or values) else db.execute(query)
+        cur = timedExecute(db, query, col_values+values)
     except sqlite3.Error as e:
         exc_type, exc_value, exc_tb = sys.exc_info()
         tb_msgs = traceback.format_exception(exc_type, exc_value, exc_tb)
@@ -352,8 +557,65 @@ def updateRow(db, query="", **kwargs):
     #     print(e.args)
     #     return {"SQLite_Error": e.args, "query": query, "col_values": col_values, "values": values, "kwargs": kwargs}
 
+    bumpGeneration(table or query)
     return cur.rowcount
 
+def updateRows(db, **kwargs):
+    """
+    Update many rows, each with its own values, in one transaction
+
+    The updates run in order, the updates with the same key and changed columns share a (cached) statement:
+        UPDATE oximeter SET temperature=? WHERE entry_id=?;  [98.2, 52], [98.4, 53], ...
+
+    ARGS:
+        Required - db (object)          - the database connection object
+
+        Required - table (str)          - the table to update data
+        Required - updates (list)       - [{"key": {column: value, ...}, "changes": {column: value, ...}}, ...]
+    RETURNS:
+        counts (list) OR error (dict) - the number of rows matching each key (in "updates" order)
+                                        nothing is changed when an error is returned
+
+    EXAMPLE:
+        counts = updateRows(db,
+                            table="oximeter",
+                            updates=[{"key": {"entry_id": 52}, "changes": {"temperature": 98.2}},
+                                     {"key": {"entry_id": 53}, "changes": {"temperature": 98.4, "steps": 3}}])
+    """
+    if shardRoute(db, "", kwargs):
+        return shardedUpdateRows(db, **kwargs)
+    table = kwargs["table"]["name"] if isinstance(kwargs.get("table"), dict) else kwargs.get("table")
+    epoch_cols = epochColumns(kwargs["table"])
+    epoch = lambda items: [toEpoch(v) if c in epoch_cols else v for (c, v) in items]
+
+    # -- one statement per (key columns, changed columns), run for every update in "updates" order:
+    # -- an update can change the key columns of an earlier one, each count is its own statement's rowcount
+    queries = {}
+    counts = []
+    db.execute("SAVEPOINT update_rows;")
+    try:
+        for update in kwargs["updates"]:
+            (keys, changes) = (tuple(update["key"]), tuple(update["changes"]))
+            if (keys, changes) not in queries:
+                condition = " AND ".join(f"{k}=?" for k in keys)
+                queries[(keys, changes)] = f"UPDATE {table} SET {', '.join(f'{c}=?' for c in changes)} WHERE ({condition});"
+                print(queries[(keys, changes)])
+            query = queries[(keys, changes)]
+            counts.append(timedExecute(db, query, epoch(update["changes"].items()) + epoch(update["key"].items())).rowcount)
+    except sqlite3.Error as e:
+        db.execute("ROLLBACK TO update_rows;")
+        db.execute("RELEASE update_rows;")
+        err = {
+            f'SQLite.{e.__class__.__name__}': f'{" ".join(e.args)}',
+            'Debug Info': {"query": query, "table": table, "updates": len(kwargs["updates"])}
+        }
+        print(err)
+        return err
+    db.execute("RELEASE update_rows;")
+
+    bumpGeneration(table)
+    return counts
+
 ###############################################################################
 #                              DELETE OPERATIONS                              #
 ###############################################################################
@@ -391,6 +653,8 @@ def deleteRow(db, query="", **kwargs):
         }
         num_deletes = deleteRow(db, **params)
     """
+    if shardRoute(db, query, kwargs):
+        return shardedDeleteRow(db, **kwargs)
     if query:
         table = ""
         condition = ""
@@ -400,11 +664,12 @@ def deleteRow(db, query="", **kwargs):
         table = kwargs["table"]["name"] if isinstance(kwargs.get("table"), dict) else kwargs.get("table")
         condition = f'({kwargs["where"]})'
         values = [kwargs["values"]] if isinstance(kwargs["values"], str) else kwargs["values"]
+        values = parseEpochValues(kwargs["table"], condition, values)
         query = f"DELETE FROM {table} WHERE {condition};"
     print(query, values) if values else print(query)
 
     try:
-        cur = db.execute(query, values)
+        cur = timedExecute(db, query, values)
     except sqlite3.Error as e:
         exc_type, exc_value, exc_tb = sys.exc_info()
         tb_msgs = traceback.format_exception(exc_type, exc_value, exc_tb)
@@ -428,12 +693,21 @@ def deleteRow(db, query="", **kwargs):
     #     print(e.args)
     #     return {"SQLite_Error": e.args, "query": query, "values": values, "kwargs": kwargs}
 
+    bumpGeneration(table or query)
     return cur.rowcount
 
 ###############################################################################
 #                               Helper Functions                              #
 ###############################################################################
 # DB Functions ################################################################
+def connectDB(dbfile, factory=sqlite3.Connection, check_same_thread=True):
+    # -- a connection configured like the ones SQLitePoolPlugin hands to each request
+    db = sqlite3.connect(dbfile, timeout=30, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES,
+                         factory=factory, check_same_thread=check_same_thread)
+    db.text_factory = str
+    db.row_factory = sqlite3.Row
+    return db
+
 def addTable(db, query="", **kwargs):
     if not query:
         # table = kwargs.get("table")
@@ -446,6 +720,7 @@ def addTable(db, query="", **kwargs):
     except (sqlite3.ProgrammingError, sqlite3.OperationalError) as e:
         print(e.args)
         return {"SQLite_Error": e.args, "query": query, "columns": columns, "kwargs": kwargs}
+    bumpGeneration(table or query)
     return {"message": f"{abs(cur.rowcount)} table created", "table": table, "columns": columns}
 
 def deleteTable(db, query="", **kwargs):
@@ -460,6 +735,7 @@ def deleteTable(db, query="", **kwargs):
     except (sqlite3.ProgrammingError, sqlite3.OperationalError) as e:
         print(e.args)
         return {"SQLite_Error": e.args, "query": query, "kwargs": kwargs}
+    bumpGeneration(table or query)
     return {"message": f"{abs(cur.rowcount)} table deleted!"}
 
 def getTable(db, tables=[], table_name=''):
@@ -472,6 +748,10 @@ def getTable(db, tables=[], table_name=''):
     return table
 
 def getTables(db):
+    # -- cached per database until PRAGMA schema_version changes (see "Static Responses")
+    return copy.deepcopy(schemaEntry(db)["tables"])
+
+def loadTables(db):
     args = {
         "table": 'sqlite_schema',
         # "columns": ["name", "type", "sql"],
@@ -486,6 +766,101 @@ def getTables(db):
 
     return tables
 
+def epochColumns(table):
+    """return the "*_time" columns stored as integer epoch milliseconds (type EPOCH)"""
+    columns = table.get("columns", {}) if isinstance(table, dict) else {}
+    if isinstance(columns, list):
+        columns = {c["name"]: c["type"].split()[0] for c in columns}
+    return [k for (k, v) in columns.items() if v.upper() == "EPOCH"]
+
+def migrateTimeColumns(db, table_name):
+    """
+    Rebuild a table so every "*_time" column is stored as integer epoch milliseconds
+
+    ARGS:
+        Required - db (object)          - the database connection object
+        Required - table_name (str)     - the table to migrate
+    RETURNS:
+        res (dict) - message, table and the new columns
+    """
+    col_info = getColumns(db, {"name": table_name})
+    time_cols = [c["name"] for c in col_info if c["name"].endswith("_time") and not c["type"].startswith("EPOCH")]
+    if not time_cols:
+        return {"message": "0 columns migrated", "table": table_name}
+
+    # -- CREATE TABLE with EPOCH columns, copy the rows, DROP the old table and recreate its indexes
+    columns = [f'{c["name"]} EPOCH {dt_epoch}' if c["name"] in time_cols else f'{c["name"]} {c["type"]}'
+               for c in col_info]
+    select = [f"CAST(ROUND((julianday({c['name']}, 'utc') - 2440587.5) * 86400000) AS INTEGER)"
+              if c["name"] in time_cols else c["name"] for c in col_info]
+    indexes = db.execute("SELECT sql FROM sqlite_schema WHERE type='index' AND tbl_name=? AND sql IS NOT NULL;",
+                         [table_name]).fetchall()
+    # -- UNIQUE column constraints (no sql) become unique indexes
+    unique = uniqueColumns(db, table_name, constraints_only=True)
+    queries = [
+        f'CREATE TABLE {table_name}_epoch ({", ".join(columns)});',
+        f'INSERT INTO {table_name}_epoch SELECT {", ".join(select)} FROM {table_name};',
+        f'DROP TABLE {table_name};',
+        f'ALTER TABLE {table_name}_epoch RENAME TO {table_name};',
+    ] + [f"{row[0]};" for row in indexes] + [
+        f'CREATE UNIQUE INDEX {table_name}_{"_".join(cols)} ON {table_name} ({", ".join(cols)});' for cols in unique
+    ]
+
+    try:
+        if not db.in_transaction:
+            db.execute("BEGIN;")
+        for query in queries:
+            print(query)
+            db.execute(query)
+        db.commit()
+    except sqlite3.Error as e:
+        db.rollback()
+        return {f'SQLite.{e.__class__.__name__}': f'{" ".join(e.args)}', "query": query}
+    return {"message": f"{len(time_cols)} columns migrated", "table": table_name, "columns": columns}
+
+def uniqueColumns(db, table_name, constraints_only=False):
+    # -- [[column, ...], ...] of every unique index (or only the UNIQUE constraints) of a table, primary key excluded
+    origins = ["u"] if constraints_only else ["u", "c"]
+    indexes = db.execute(f"PRAGMA index_list({table_name});").fetchall()
+    return [[col[2] for col in db.execute(f"PRAGMA index_info({index[1]});").fetchall()]
+            for index in indexes if index[2] and (index[3] in origins)]
+
+def addUniqueIndex(db, table_name, columns):
+    """
+    Enforce unique values in the "columns" of an existing table with a unique index
+
+    ARGS:
+        Required - db (object)          - the database connection object
+        Required - table_name (str)     - the table to index
+        Required - columns (list)       - the column(s) that must be unique
+    RETURNS:
+        res (dict) - message, table and index OR the duplicate values that must be resolved first
+    """
+    if columns in uniqueColumns(db, table_name):
+        return {"message": "0 indexes created (already unique)", "table": table_name, "columns": columns}
+
+    cols = ", ".join(columns)
+    query = f"SELECT {cols}, COUNT(*) FROM {table_name} GROUP BY {cols} HAVING COUNT(*) > 1;"
+    duplicates = db.execute(query).fetchall()
+    if shardRoute(db, "", {"table": table_name}):
+        # -- the rows live in the shards (the index is copied to the shards with the schema)
+        duplicates = [row for conn in shardConnections(db) for row in conn.execute(query).fetchall()]
+    if duplicates:
+        return {"message": "duplicate values, resolve them before creating the index", "table": table_name,
+                "duplicates": [dict(zip(columns + ["count"], row)) for row in duplicates]}
+
+    query = f'CREATE UNIQUE INDEX {table_name}_{"_".join(columns)} ON {table_name} ({cols});'
+    print(query)
+    # -- inside a transaction (e.g. /batch) the index is committed or rolled back with it
+    owner = not db.in_transaction
+    try:
+        db.execute(query)
+        db.commit() if owner else None
+    except sqlite3.Error as e:
+        db.rollback() if owner else None
+        return {f'SQLite.{e.__class__.__name__}': f'{" ".join(e.args)}', "query": query}
+    return {"message": "1 index created", "table": table_name, "index": f'{table_name}_{"_".join(columns)}', "columns": columns}
+
 def getColumns(db, table, required=False, editable=False, non_editable=False, ref=False):
     if not table.get("columns"):
         query = f'PRAGMA table_info({table["name"]});'
@@ -554,6 +929,26 @@ def checkUserAgent():
     return False
 
 
+def toEpoch(value):
+    """convert an ISO datetime (localtime) to epoch milliseconds, numbers are kept as-is"""
+    if isinstance(value, (int, float)) or re.fullmatch(r"-?[0-9]+", str(value)):
+        return int(value)
+    try:
+        return round(datetime.fromisoformat(str(value).strip()).timestamp() * 1000)
+    except ValueError:
+        return value
+
+def fromEpoch(value):
+    """sqlite3 converter: epoch milliseconds to an ISO datetime (localtime)"""
+    try:
+        return datetime.fromtimestamp(int(value) / 1000).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+    except ValueError:
+        return value.decode()
+
+
+sqlite3.register_converter("EPOCH", fromEpoch)
+
+
 def clean(data):
     if isinstance(data, dict):
         for k, v in data.items():
@@ -585,7 +980,9 @@ def clean2(data):
 def extract(info, cols):
     return{k: v for k, v in {c.values() for c in info} if k in cols}
 
-def mapUrlPaths(url_paths, req_items, table=""):
+dt_epoch = "NOT NULL DEFAULT (CAST(ROUND((julianday('now') - 2440587.5) * 86400000) AS INTEGER))"
+
+def mapUrlPaths(url_paths, req_items, table="", epoch=False):
     # dt = "DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))"
     dt = "NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))"
     r = re.compile(r"/", re.VERBOSE)
@@ -606,7 +1003,12 @@ def mapUrlPaths(url_paths, req_items, table=""):
             else:
                 id_cols.append(f"{k} {v} NOT NULL")
         elif re.match(r"([a-z_0-9]+_time)", k):
-            time_cols.append(f"{k} {v} {dt}")
+            if epoch or (v == "EPOCH"):
+                time_cols.append(f"{k} EPOCH {dt_epoch}")
+            else:
+                time_cols.append(f"{k} {v} {dt}")
+        elif (table == "users") and (k == "username"):
+            non_cols.append(f"{k} {v} NOT NULL UNIQUE")
         elif re.match(r"([a-z_0-9]+)", k):
             non_cols.append(f"{k} {v} NOT NULL")
         else:
@@ -667,6 +1069,88 @@ def parseFilters(filters, conditions, values):
 
     return filter_conditions, filter_values
 
+struct_types = {"INTEGER": "i", "DOUBLE": "d"}
+body_types = {
+    "application/msgpack": "msgpack", "application/x-msgpack": "msgpack",
+    "application/cbor": "cbor",
+    "application/octet-stream": "struct",
+    "application/json": "json",
+}
+
+def getStructLayout(table):
+    # -- fixed-layout packed struct (little-endian) of the required columns: INTEGER=int32, DOUBLE=float64
+    required_columns = {k: v for (k, v) in table["columns"].items()
+                        if not re.search(r"(_id|_time)" if table["name"] == "users" else r"((?<!user)_id|_time)", k)}
+    if any(v not in struct_types for v in required_columns.values()):
+        return list(required_columns.keys()), None
+    return list(required_columns.keys()), struct.Struct("<" + "".join(struct_types[v] for v in required_columns.values()))
+
+def parseBody(table, content_type, body):
+    """
+    Decode a binary request body into a frame of rows for ingestFrame()
+
+    ARGS:
+        Required - table (dict)         - the table the rows belong to (from getTable())
+        Required - content_type (str)   - one of "body_types"
+        Required - body (bytes)         - the request body
+    RETURNS:
+        frame (dict) - {"columns": [...], "rows": [[...], ...]} or {"rows": [{...}, ...]}
+
+    Raises ValueError if the body can't be decoded
+    """
+    body_type = body_types.get(content_type.split(";")[0].strip().lower())
+    if body_type == "struct":
+        columns, layout = getStructLayout(table)
+        if not layout:
+            raise ValueError(f"<{table['name']}> has columns that can't be packed: {columns}")
+        if (not body) or (len(body) % layout.size):
+            raise ValueError(f"body size {len(body)} is not a multiple of the row size {layout.size} ({layout.format})")
+        return {"columns": columns, "rows": [list(row) for row in layout.iter_unpack(body)]}
+
+    if body_type == "msgpack":
+        if not msgpack:
+            raise ValueError("msgpack is not installed (pip3 install msgpack)")
+        data = msgpack.unpackb(body, raw=False)
+    elif body_type == "cbor":
+        if not cbor2:
+            raise ValueError("cbor2 is not installed (pip3 install cbor2)")
+        data = cbor2.loads(body)
+    elif body_type == "json":
+        data = json.loads(body)
+    else:
+        raise ValueError(f"unsupported content type: {content_type}")
+
+    # -- a single row, a list of rows or a full frame
+    if isinstance(data, dict) and ("rows" not in data):
+        return {"rows": [data]}
+    if isinstance(data, list):
+        return {"rows": data}
+    if isinstance(data, dict):
+        return data
+    raise ValueError(f"expected an object or an array, got {type(data).__name__}")
+
+def parsePlaceholders(conditions):
+    # -- the column compared against each "?" in conditions (None when it can't be determined)
+    regex = r"""
+        (?P<col>[a-z_0-9]+)\s*                             # column name
+        ((==|!=|<>|<=|>=|=|<|>)|\s(NOT\s+)?BETWEEN\s+(\?\s+AND\s+)?)\s*$   # operator (or BETWEEN ? AND)
+    """
+    r = re.compile(regex, re.VERBOSE | re.IGNORECASE)
+    placeholders = []
+    for m in re.finditer(r"\?", conditions):
+        match = r.search(conditions[:m.start()])
+        placeholders.append(match.group("col") if match else None)
+    return placeholders
+
+def parseEpochValues(table, conditions, values):
+    # -- convert ISO datetime values bound to EPOCH columns into epoch milliseconds
+    epoch_cols = epochColumns(table)
+    if not (epoch_cols and values):
+        return values
+    placeholders = parsePlaceholders(conditions)
+    return [toEpoch(v) if (i < len(placeholders) and placeholders[i] in epoch_cols) else v
+            for (i, v) in enumerate(values)]
+
 def parseColumnValues(cols, vals):
     columns = ""
     col_values = []
@@ -720,6 +1204,13 @@ def log_to_logger(fn):
             if not actual_response.get("message") == "available commands":
                 logger.info(json.dumps({"request.params": dict(request.params)}))
                 logger.info(json.dumps(actual_response, default=str, indent=2))
+        elif isinstance(actual_response, bytes):
+            # -- pre-serialized (cached) json response
+            logger.info(json.dumps({"request.params": dict(request.params)}))
+            logger.info(actual_response.decode())
+        elif not isinstance(actual_response, str):
+            # -- streamed response (server-sent events)
+            logger.info(json.dumps({"request.params": dict(request.params)}))
         else:
             soup = BeautifulSoup(actual_response, 'html5lib')
             logger.info(json.dumps(json.loads(soup.select_one("pre").getText()), indent=2))
@@ -776,6 +1267,1479 @@ class ErrorsRestPlugin(object):
         return callback
 
 
+# Table Generations ###########################################################
+"""
+Every table carries a generation counter, bumped by insertRow/updateRow/deleteRow/addTable/deleteTable.
+A write bumps the counter immediately and again after its transaction commits (commitGenerations()),
+so an ETag handed out while the write was still uncommitted can never match the committed data.
+The counters live in this process only: restarting the server changes "boot_id" and all ETags.
+"""
+table_generations = {}
+generation_lock = threading.Lock()
+pending_generations = threading.local()
+boot_id = codecs.encode(os.urandom(4), "hex").decode()
+
+def bumpGeneration(table, rowid=0):
+    # -- table can be a table (dict), a table name (str) or a full SQL query
+    if isinstance(table, dict):
+        name = table["name"]
+    else:
+        match = re.search(r"\b(INTO|UPDATE|FROM|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?([a-z_0-9]+)", table, re.IGNORECASE)
+        name = match.group(2) if (match and " " in table.strip()) else table.strip()
+    with generation_lock:
+        table_generations[name] = table_generations.get(name, 0) + 1
+    result_cache.invalidate(name)
+    if not hasattr(pending_generations, "tables"):
+        pending_generations.tables = set()
+        pending_generations.rowids = {}
+    pending_generations.tables.add(name)
+    if rowid:
+        pending_generations.rowids[name] = max(rowid, pending_generations.rowids.get(name, 0))
+
+def commitGenerations():
+    # -- called after the connection commits: bump every table written by this thread again
+    tables = getattr(pending_generations, "tables", set())
+    with generation_lock:
+        for name in tables:
+            table_generations[name] = table_generations.get(name, 0) + 1
+    for name in tables:
+        result_cache.invalidate(name)
+    publishRows(getattr(pending_generations, "rowids", {}))
+    pending_generations.tables = set()
+    pending_generations.rowids = {}
+
+def pendingRowIds():
+    # -- the rowids this thread will publish at its next commitGenerations() (a /batch savepoint saves them)
+    return dict(getattr(pending_generations, "rowids", {}))
+
+def discardRowIds(saved=None):
+    # -- the writes were rolled back: don't publish their rowids (the next insert reuses a rolled back rowid)
+    pending_generations.rowids = dict(saved or {})
+
+def getGeneration(table_name):
+    return table_generations.get(table_name, 0)
+
+def getETag(table_name, *query):
+    # -- ETag = boot_id + table generation + hash of the normalized query
+    # -- weak (W/): the same tag for the identity and the compressed body (CompressionPlugin), they aren't byte-identical
+    key = json.dumps(query, sort_keys=True, default=str)
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return f'W/"{boot_id}-{getGeneration(table_name)}-{digest}"'
+
+def checkETag(etag):
+    # -- True if the request's If-None-Match header matches "etag" (weak comparison)
+    if_none_match = request.headers.get("If-None-Match", "")
+    tags = [re.sub(r"^W/", "", t.strip()) for t in if_none_match.split(",")]
+    return (re.sub(r"^W/", "", etag) in tags) or ("*" in tags)
+
+def notModified(etag):
+    # -- 304 for a matching If-None-Match: raised past CompressionPlugin, so it sets "Vary" itself
+    return HTTPResponse(status=304, headers={"ETag": etag, "Vary": "Accept-Encoding"})
+
+
+# Subscriptions ###############################################################
+"""
+commitGenerations() publishes the last committed rowid of every table written by insertRow.
+Subscribers sleep on "table_events" until a table's last rowid passes their cursor,
+then fetch only the new rows with an index seek: "{ref}_id > cursor".
+"""
+table_rowids = {}
+table_events = threading.Condition()
+async_waiters = {}  # -- table_name: [(loop, future, cursor)] - waitForRowsAsync() callers (asgi.py)
+
+def publishRows(rowids):
+    if not rowids:
+        return
+    ready = []
+    with table_events:
+        for (name, rowid) in rowids.items():
+            table_rowids[name] = max(rowid, table_rowids.get(name, 0))
+            waiters = async_waiters.get(name, [])
+            ready += [w for w in waiters if w[2] < rowid]
+            async_waiters[name] = [w for w in waiters if w[2] >= rowid]
+        table_events.notify_all()
+    for (loop, future, cursor) in ready:
+        loop.call_soon_threadsafe(lambda f: f.done() or f.set_result(True), future)
+
+def waitForRows(table_name, cursor, timeout):
+    # -- True if rows newer than "cursor" were committed to "table_name" before "timeout" (seconds)
+    with table_events:
+        return table_events.wait_for(lambda: table_rowids.get(table_name, 0) > cursor, timeout)
+
+async def waitForRowsAsync(table_name, cursor, timeout):
+    # -- waitForRows() for an event loop: the caller waits without holding a thread
+    loop = asyncio.get_running_loop()
+    waiter = (loop, loop.create_future(), cursor)
+    with table_events:
+        if table_rowids.get(table_name, 0) > cursor:
+            return True
+        async_waiters.setdefault(table_name, []).append(waiter)
+    try:
+        return await asyncio.wait_for(waiter[1], max(timeout, 0))
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        with table_events:
+            if waiter in async_waiters.get(table_name, []):
+                async_waiters[table_name].remove(waiter)
+
+def lastRowId(db, table):
+    # -- the newest "{ref}_id" of a table (the default /subscribe cursor), from every shard of a sharded table
+    ref = getColumns(db, table, ref=True)
+    query = f'SELECT IFNULL(MAX({ref}), 0) FROM {table["name"]};'
+    connections = shardConnections(db) if shardRoute(db, "", {"table": table}) else [db]
+    return max(conn.execute(query).fetchone()[0] for conn in connections)
+
+def fetchNewRows(db, table, conditions, values, cursor):
+    # -- SELECT * FROM oximeter WHERE (user_id=?) AND entry_id > ? ORDER BY entry_id;
+    col_ref = getColumns(db, table, ref=True)
+    where = f"({conditions}) AND {col_ref} > ? ORDER BY {col_ref}" if conditions else f"{col_ref} > ? ORDER BY {col_ref}"
+    published = table_rowids.get(table["name"], 0)  # -- committed before this query, so it sees them
+    rows = fetchRows(db, table=table, where=where, values=values + [cursor], force=True)
+    if isinstance(rows, dict):
+        return rows, cursor
+    rows = rows or []
+    # -- skip past published rows that didn't match, so they don't wake this subscriber again
+    return rows, max(rows[-1][col_ref] if rows else cursor, published)
+
+def streamRows(dbfile, table, conditions, values, cursor, timeout=25):
+    """
+    Server-sent events: yield newly inserted rows matching "conditions" as they are committed
+
+    ARGS:
+        Required - dbfile (str)         - path to the SQLite database (the request's connection is closed)
+        Required - table (dict)         - the table to watch
+        Required - conditions (str)     - conditional "WHERE" statement
+        Required - values (list)        - the value(s) for the "WHERE" statement
+        Required - cursor (int)         - only rows with "{ref}_id > cursor" are sent
+        Optional - timeout (int)        - seconds between keep-alive comments
+    """
+    db = connectDB(dbfile)
+    try:
+        yield f"retry: 3000\n: subscribed to <{table['name']}>\n\n"
+        rows, cursor = fetchNewRows(db, table, conditions, values, cursor)
+        while True:
+            if isinstance(rows, dict):
+                yield f"event: error\ndata: {json.dumps(rows, default=str)}\n\n"
+                return
+            if rows:
+                yield f"id: {cursor}\nevent: rows\ndata: {json.dumps(rows, default=str)}\n\n"
+            if waitForRows(table["name"], cursor, timeout):
+                rows, cursor = fetchNewRows(db, table, conditions, values, cursor)
+            else:
+                rows = []
+                yield ": keep-alive\n\n"
+    finally:
+        db.close()
+
+async def streamRowsAsync(fetch, table_name, cursor, timeout=25, executor=None):
+    """
+    Server-sent events from an event loop: streamRows() without a thread (or connection) per subscriber
+
+    ARGS:
+        Required - fetch (function)     - fetch(cursor) -> (rows, cursor), fetchNewRows() on a pooled connection
+        Required - table_name (str)     - the table to watch
+        Required - cursor (int)         - only rows with "{ref}_id > cursor" are sent
+        Optional - timeout (int)        - seconds between keep-alive comments
+        Optional - executor (object)    - the executor "fetch" runs on (the database threads)
+    """
+    loop = asyncio.get_running_loop()
+    yield f"retry: 3000\n: subscribed to <{table_name}>\n\n"
+    rows, cursor = await loop.run_in_executor(executor, fetch, cursor)
+    while True:
+        if isinstance(rows, dict):
+            yield f"event: error\ndata: {json.dumps(rows, default=str)}\n\n"
+            return
+        if rows:
+            yield f"id: {cursor}\nevent: rows\ndata: {json.dumps(rows, default=str)}\n\n"
+        if await waitForRowsAsync(table_name, cursor, timeout):
+            rows, cursor = await loop.run_in_executor(executor, fetch, cursor)
+        else:
+            rows = []
+            yield ": keep-alive\n\n"
+
+# Ingest ######################################################################
+def ingestFrame(db, table, frame):
+    """
+    Validate a frame of samples against the table's columns and insert it as one transaction
+
+    ARGS:
+        Required - db (object)          - the database connection object
+        Required - table (dict)         - the table to insert data into (from getTable())
+        Required - frame (dict|list)    - {"frame": 7, "rows": [{column: value}, ...]}
+                                          {"frame": 7, "columns": [...], "rows": [[value, ...], ...]}
+                                          [{column: value}, ...]
+    RETURNS:
+        ack (dict) - the frame number and either the inserted IDs or the error
+    """
+    frame = {"rows": frame} if isinstance(frame, list) else frame
+    if not isinstance(frame, dict):
+        return {"frame": None, "message": "invalid frame: expected a JSON object or list", "submitted": frame}
+    ack = {"frame": frame.get("frame")}
+    required_columns = getColumns(db, table, required=True)
+    allowed_columns = {**required_columns, **{c: t for (c, t) in table["columns"].items() if c.endswith("_time")}}
+
+    # -- rows as (dict) with the same keys or as (list) in "columns" order
+    rows = frame.get("rows") or []
+    if not isinstance(rows, list):
+        return {**ack, "message": "invalid frame: 'rows' must be a list"}
+    if rows and isinstance(rows[0], dict):
+        columns = list(rows[0].keys())
+        mismatched = [i for (i, row) in enumerate(rows) if (not isinstance(row, dict)) or (row.keys() != rows[0].keys())]
+        if mismatched:
+            return {**ack, "message": "invalid frame: every row needs the columns of the first row",
+                    "columns": columns, "mismatched_rows": mismatched[:10]}
+        rows = [[row[c] for c in columns] for row in rows]
+    else:
+        columns = frame.get("columns") or list(required_columns.keys())
+        if (not isinstance(columns, list)) or any(not isinstance(c, str) for c in columns) \
+                or any(not isinstance(row, (list, tuple)) for row in rows):
+            return {**ack, "message": "invalid frame: 'columns' must be a list and every row a list of values"}
+
+    missing = [c for c in required_columns if c not in columns]
+    unknown = [c for c in columns if c not in allowed_columns]
+    # -- every cell is a single value (no lists or objects)
+    non_scalar = [i for (i, row) in enumerate(rows) if any(isinstance(v, (dict, list)) for v in row)]
+    if (not rows) or missing or unknown or non_scalar or any(len(row) != len(columns) for row in rows):
+        return {**ack, "message": "invalid frame", "required": [required_columns],
+                "missing": missing, "unknown": unknown, "non_scalar_rows": non_scalar[:10], "rows": len(rows)}
+
+    # -- INSERT INTO oximeter (user_id,heart_rate,...) VALUES (?, ?, ...); x len(rows)
+    row_ids = insertRows(db, table=table, columns=columns, rows=rows)
+    if isinstance(row_ids, dict):
+        db.rollback()
+        commitShards(rollback=True)
+        discardRowIds()
+        return {**ack, **row_ids}
+    db.commit()
+    commitShards()
+    commitGenerations()
+
+    col_ref = getColumns(db, table, ref=True)
+    return {**ack, "message": f"data added to <{table['name']}>", "count": len(row_ids),
+            col_ref: [row_ids[0], row_ids[-1]]}
+
+
+# Static Responses ############################################################
+"""
+Documentation (usage) and discovery (table listing) responses don't depend on the request.
+They are serialized once and served as bytes with an ETag (hash of the body).
+The tables (and their listing) are reloaded when the database's PRAGMA schema_version changes.
+"""
+static_responses = {}   # -- name: (etag, body)
+schema_cache = {}       # -- database file: {"version": schema_version, "tables": [...], "listing": (etag, body)}
+schema_lock = threading.Lock()
+
+def serializeResponse(data):
+    body = json_dumps(clean(data)).encode()
+    return (f'W/"{hashlib.sha1(body).hexdigest()[:16]}"', body)
+
+def sendResponse(etag, body):
+    # -- pre-serialized body (or 304 if the client has it already)
+    if checkETag(etag):
+        raise notModified(etag)
+    response.set_header("ETag", etag)
+    response.content_type = "application/json"
+    return body
+
+def addStaticResponse(name, data):
+    static_responses[name] = serializeResponse(data)
+
+def staticResponse(name):
+    return sendResponse(*static_responses[name])
+
+def schemaEntry(db):
+    query = "SELECT (SELECT file FROM pragma_database_list WHERE name = 'main'), schema_version FROM pragma_schema_version;"
+    dbfile, version = db.execute(query).fetchone()
+    with schema_lock:
+        entry = schema_cache.get(dbfile)
+    if entry and (entry["version"] == version):
+        return entry
+    entry = {"version": version, "tables": loadTables(db), "listing": None, "unique": {}}
+    with schema_lock:
+        schema_cache[dbfile] = entry
+    return entry
+
+def tableListing(db):
+    # -- "active tables in the database": the response to every call without a valid table
+    entry = schemaEntry(db)
+    if not entry["listing"]:
+        entry["listing"] = serializeResponse({"message": "active tables in the database", "tables": entry["tables"]})
+    return sendResponse(*entry["listing"])
+
+def uniqueKeys(db, table_name):
+    # -- uniqueColumns() as sets, cached until the schema changes (the natural keys /add can upsert on)
+    entry = schemaEntry(db)
+    if table_name not in entry["unique"]:
+        entry["unique"][table_name] = [set(cols) for cols in uniqueColumns(db, table_name)]
+    return entry["unique"][table_name]
+
+
+# Result Cache ################################################################
+class ResultCache(object):
+    """
+    LRU cache of serialized /get responses keyed on (table_name, conditions, values)
+
+    An entry is only served while its table's generation is unchanged,
+    and every write to a table evicts all of that table's entries.
+    """
+    def __init__(self, max_entries=1024, max_bytes=64*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    # -- key: (generation, body)
+        self.tables = {}                # -- table_name: {keys}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if (not entry) or (entry[0] != getGeneration(key[0])):
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key, generation, body):
+        if (not self.max_entries) or (len(body) > self.max_bytes) or (generation != getGeneration(key[0])):
+            return
+        with self.lock:
+            self._pop(key)
+            self.entries[key] = (generation, body)
+            self.tables.setdefault(key[0], set()).add(key)
+            self.size += len(body)
+            while (len(self.entries) > self.max_entries) or (self.size > self.max_bytes):
+                self._pop(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def invalidate(self, table_name):
+        with self.lock:
+            keys = self.tables.pop(table_name, set())
+            for key in keys:
+                self._pop(key)
+            self.stats["invalidations"] += len(keys)
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= len(entry[1])
+            self.tables.get(key[0], set()).discard(key)
+
+    def info(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {**self.stats, "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else 0,
+                "entries": len(self.entries), "bytes": self.size,
+                "max_entries": self.max_entries, "max_bytes": self.max_bytes}
+
+
+result_cache = ResultCache()
+
+
+# Request Coalescing ##########################################################
+class SingleFlight(object):
+    """
+    Coalesce identical in-flight /get queries keyed on (table_name, conditions, values) and the table's generation
+
+    The first request (the leader) runs the query, identical requests that arrive while it runs wait for it
+    (up to "max_wait" seconds, then they run the query themselves) and share its serialized response.
+    A write to the table changes the generation, so requests after the write start a new flight.
+    """
+    def __init__(self, max_wait=5.0):
+        self.max_wait = max_wait
+        self.flights = {}               # -- (key, generation): {"done": Event, "res": response}
+        self.lock = threading.Lock()
+        self.stats = {"leaders": 0, "shared": 0, "timeouts": 0}
+
+    def do(self, key, generation, fn):
+        """fn() -> the response for "key", run once for concurrent identical calls"""
+        if self.max_wait <= 0:
+            return fn()
+        flight_key = (key, generation)
+        with self.lock:
+            flight = self.flights.get(flight_key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[flight_key] = {"done": threading.Event(), "res": None}
+                self.stats["leaders"] += 1
+
+        if leader:
+            try:
+                flight["res"] = fn()
+            finally:
+                with self.lock:
+                    self.flights.pop(flight_key, None)
+                flight["done"].set()
+            return flight["res"]
+
+        if flight["done"].wait(self.max_wait) and (flight["res"] is not None):
+            with self.lock:
+                self.stats["shared"] += 1
+            return flight["res"]
+        with self.lock:
+            self.stats["timeouts"] += 1
+        return fn()
+
+    def info(self):
+        with self.lock:
+            in_flight = len(self.flights)
+        requests = self.stats["leaders"] + self.stats["shared"] + self.stats["timeouts"]
+        return {**self.stats, "in_flight": in_flight, "max_wait": self.max_wait,
+                "shared_rate": round(self.stats["shared"] / requests, 3) if requests else 0}
+
+
+single_flight = SingleFlight()
+
+
+# Slow Query Log ##############################################################
+class SlowQueryLog(object):
+    """
+    Ring buffer (and log file) of the queries that ran longer than "threshold_ms"
+
+    Every entry has the SQL, the types of the bound values, the duration, the rows returned (or changed),
+    an estimate of the rows scanned and the EXPLAIN QUERY PLAN of the query.
+    """
+    def __init__(self, threshold_ms=100, max_entries=100, log_file="m2band_slow.log"):
+        self.threshold_ms = threshold_ms   # -- negative disables the log
+        self.entries = deque(maxlen=max_entries)
+        self.log_file = log_file
+        self.logger = None
+        self.lock = threading.Lock()
+        self.recorded = 0
+
+    def resize(self, max_entries):
+        with self.lock:
+            self.entries = deque(self.entries, maxlen=max_entries)
+
+    def explain(self, db, query, values):
+        """EXPLAIN QUERY PLAN as indented lines, and the tables read by a full scan"""
+        if not re.match(r"\s*(SELECT|UPDATE|DELETE|WITH)\b", query, re.IGNORECASE):
+            return [], []
+        try:
+            rows = db.execute(f"EXPLAIN QUERY PLAN {query}", values or []).fetchall()
+        except sqlite3.Error as e:
+            return [f"{e.__class__.__name__}: {e}"], []
+        depth, plan = {0: -1}, []
+        for (node, parent, _, detail) in rows:
+            depth[node] = depth.get(parent, -1) + 1
+            plan.append(f'{"  " * depth[node]}{detail}')
+        scans = [m.group(1) for m in [re.match(r"SCAN (?:TABLE )?(\w+)$", d) for (_, _, _, d) in rows] if m]
+        return plan, scans
+
+    def record(self, db, query, values, ms, rows_returned, vm_steps, many=False):
+        plan, scans = ([], []) if many else self.explain(db, query, values)
+        try:
+            # -- a full scan reads every row: estimate it from the rowid span (cheap, unlike COUNT(*))
+            rows_scanned = sum(db.execute(f"SELECT COALESCE(MAX(rowid) - MIN(rowid) + 1, 0) FROM {t};").fetchone()[0]
+                               for t in scans) if scans else None
+        except sqlite3.Error:
+            rows_scanned = None
+        values = [] if values is None else list(values)
+        entry = {
+            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+            "ms": round(ms, 3),
+            "query": query,
+            # -- the types only: /stats is not authenticated and the values are user data (user_ids, filters, passwords)
+            "values": [type(v).__name__ for v in values[:20]] + ([f"... {len(values) - 20} more"] if len(values) > 20 else []),
+            "rows_returned": rows_returned,
+            "rows_scanned": rows_scanned,
+            "vm_steps": vm_steps,
+            "full_scans": scans,
+            "plan": plan,
+        }
+        with self.lock:
+            self.entries.append(entry)
+            self.recorded += 1
+            if self.logger is None:
+                self.logger = logging.getLogger("m2band_slow")
+                self.logger.setLevel(logging.INFO)
+                self.logger.propagate = False
+                self.logger.addHandler(logging.FileHandler(self.log_file))
+        self.logger.info(json.dumps(entry, default=str))
+
+    def info(self):
+        with self.lock:
+            return {"threshold_ms": self.threshold_ms, "recorded": self.recorded,
+                    "max_entries": self.entries.maxlen, "entries": list(self.entries)[::-1]}
+
+
+slow_query_log = SlowQueryLog()
+
+def timedExecute(db, query, values=None, fetch="", many=False):
+    """
+    db.execute() (or db.executemany()) timed by the slow query log
+
+    ARGS:
+        Required - db (object)          - the database connection object
+        Required - query (str)          - the SQL query
+        Optional - values (list)        - the values for the query (a list of rows with [many])
+        Optional - fetch (str)          - "one" or "all": fetch the result inside the timed section
+        Optional - many (bool)          - use executemany()
+    RETURNS:
+        row (sqlite3.Row) | rows (list) | cursor (sqlite3.Cursor) - for fetch="one" | "all" | ""
+
+    Raises sqlite3.Error like db.execute()
+    """
+    def execute():
+        if many:
+            cur = db.executemany(query, values)
+        else:
+            cur = db.execute(query, values) if values else db.execute(query)
+        return cur, (cur.fetchone() if fetch == "one" else cur.fetchall() if fetch == "all" else cur)
+
+    if slow_query_log.threshold_ms < 0:
+        return execute()[1]
+
+    # -- count virtual machine steps (in thousands) as a measure of the work done
+    steps = [0]
+    def progress():
+        steps[0] += 1
+        return 0
+
+    db.set_progress_handler(progress, 1000)
+    start = time.perf_counter()
+    try:
+        cur, res = execute()
+    finally:
+        ms = (time.perf_counter() - start) * 1000
+        db.set_progress_handler(None, 1000)
+
+    if ms >= slow_query_log.threshold_ms:
+        rows_returned = (1 if res else 0) if fetch == "one" else len(res) if fetch == "all" else cur.rowcount
+        slow_query_log.record(db, query, values, ms, rows_returned, steps[0] * 1000, many=many)
+    return res
+
+
+# CompressionPlugin ###########################################################
+class CompressionPlugin(object):
+    name = 'CompressionPlugin'
+    api = 2
+
+    def __init__(self, min_size=1024, level=6, dumps=None):
+        """init()"""
+        self.min_size = min_size
+        self.level = level
+        self.json_dumps = dumps
+        self.encodings = [e for (e, lib) in [("zstd", zstandard), ("br", brotli), ("gzip", zlib)] if lib]
+
+    def setup(self, app):
+        """Initialize Handler"""
+        for plugin in app.plugins:
+            if isinstance(plugin, JSONPlugin):
+                self.json_dumps = plugin.json_dumps
+                break
+
+        if not self.json_dumps:
+            self.json_dumps = json_dumps
+
+    def negotiate(self, accept_encoding):
+        """pick the best supported encoding from an Accept-Encoding header (or None)"""
+        weights = {}
+        for item in accept_encoding.lower().split(","):
+            encoding, _, q = item.strip().partition(";q=")
+            try:
+                weights[encoding.strip()] = float(q) if q else 1.0
+            except ValueError:
+                continue
+        accepted = [(weights.get(e, weights.get("*", 0)), -i, e) for (i, e) in enumerate(self.encodings)]
+        q, _, encoding = max(accepted)
+        return encoding if q > 0 else None
+
+    def compressor(self, encoding):
+        """return (compress, flush) functions for a streaming compressor"""
+        if encoding == "zstd":
+            c = zstandard.ZstdCompressor(level=self.level).compressobj()
+            return (lambda data: c.compress(data) + c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)), c.flush
+        if encoding == "br":
+            c = brotli.Compressor(quality=min(self.level, 11))
+            return (lambda data: c.process(data) + c.flush()), c.finish
+        c = zlib.compressobj(min(self.level, 9), zlib.DEFLATED, 31)  # -- wbits=31: gzip container
+        return (lambda data: c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH)), c.flush
+
+    def stream(self, encoding, chunks):
+        """compress a chunked/generator response, flushing after every chunk"""
+        compress, flush = self.compressor(encoding)
+        for chunk in chunks:
+            chunk = chunk.encode() if isinstance(chunk, str) else chunk
+            if chunk:
+                yield compress(chunk)
+        yield flush()
+
+    def apply(self, callback, route):
+        """Execute Handler"""
+        @wraps(callback)
+        def wrapper(*args, **kwargs):
+            rv = callback(*args, **kwargs)
+            if isinstance(rv, HTTPResponse):
+                return rv
+            response.add_header("Vary", "Accept-Encoding")
+            encoding = self.negotiate(request.headers.get("Accept-Encoding", ""))
+            if (not encoding) or response.get_header("Content-Encoding"):
+                return rv
+
+            # -- serialize the response body like JSONPlugin would
+            if isinstance(rv, dict):
+                body = self.json_dumps(rv).encode()
+                response.content_type = "application/json"
+            elif isinstance(rv, (str, bytes)):
+                body = rv.encode() if isinstance(rv, str) else rv
+            elif hasattr(rv, "__iter__"):
+                response.set_header("Content-Encoding", encoding)
+                return self.stream(encoding, rv)
+            else:
+                return rv
+
+            if len(body) < self.min_size:
+                return body
+            compress, flush = self.compressor(encoding)
+            response.set_header("Content-Encoding", encoding)
+            return compress(body) + flush()
+        return wrapper
+
+
+# AdmissionPlugin #############################################################
+"""
+Admission control, installed before every other plugin so rejected requests never reach the database:
+  * rate limits - a token bucket per (route class, client IP) and per (route class, user_id):
+                  "rate" requests per second with bursts of "burst" requests, over the limit: 429 + Retry-After
+  * concurrency - at most "max_concurrent" requests run at once, the others queue (up to "queue_timeout" seconds).
+                  Once "shed_depth" requests are queued new requests are shed (503 + Retry-After), except the
+                  "protected" classes (ingest) which are only shed when the queue is full ("max_queue").
+                  "stream" routes (/subscribe, /ingest) mostly wait for data and are not counted.
+"""
+admission_limits = {
+    "login": {"rate": 1, "burst": 10},      # -- /login, /logout, /createUser
+    "read": {"rate": 20, "burst": 100},     # -- /get
+    "write": {"rate": 50, "burst": 250},    # -- /add, /edit, /delete, /batch
+    "stream": {"rate": 1, "burst": 20},     # -- /subscribe, /ingest (new connections)
+    "admin": {"rate": 1, "burst": 10},      # -- /createTable, /deleteTable
+    "other": {"rate": 10, "burst": 50},     # -- /, /stats, usage
+}
+admission_routes = {
+    "get": "read", "getUser": "read", "getUsers": "read", "getSensorData": "read", "getAllSensorData": "read",
+    "add": "write", "edit": "write", "delete": "write", "batch": "write", "addSensorData": "write", "editSensorData": "write",
+    "deleteSensorData": "write", "editUser": "write", "deleteUser": "write",
+    "login": "login", "logout": "login", "addUser": "login", "createUser": "login",
+    "subscribe": "stream", "ingest": "stream",
+    "createTable": "admin", "deleteTable": "admin",
+}
+
+class AdmissionPlugin(object):
+    name = 'AdmissionPlugin'
+    api = 2
+
+    def __init__(self, limits=None, max_concurrent=64, max_queue=256, shed_depth=64, queue_timeout=10,
+                 protected=("write",), uncapped=("stream",), trust_proxy=False):
+        """init()"""
+        self.limits = {**admission_limits, **(limits or {})}
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.shed_depth = shed_depth
+        self.queue_timeout = queue_timeout
+        self.protected = protected
+        self.uncapped = uncapped
+        self.trust_proxy = trust_proxy
+        self.buckets = {}               # -- (route class, "ip"|"user", key): [tokens, last update]
+        self.purged = time.time()
+        self.lock = threading.Lock()
+        self.slots = threading.Condition()
+        self.in_flight = 0
+        self.queued = 0
+        self.stats = {"admitted": 0, "limited": {}, "shed": {}, "timeouts": 0, "max_in_flight": 0, "max_queued": 0}
+
+    def routeClass(self, rule):
+        return admission_routes.get(rule.strip("/").split("/")[0], "other")
+
+    def clientKeys(self):
+        # -- (client ip, authenticated user) of the request: REMOTE_USER is set by the WSGI server (HTTP auth), not a header
+        # -- the user_id in the URL is not checked: any client could drain another user's bucket with it
+        ip = request.environ.get("REMOTE_ADDR", "")
+        if self.trust_proxy and request.environ.get("HTTP_X_FORWARDED_FOR"):
+            ip = request.environ["HTTP_X_FORWARDED_FOR"].split(",")[0].strip()
+        return ip, request.environ.get("REMOTE_USER")
+
+    def take(self, key, rate, burst):
+        """take a token from the bucket "key", returns 0 or the seconds until the next token"""
+        now = time.time()
+        with self.lock:
+            if now - self.purged > 60:
+                # -- drop the buckets that refilled completely (idle clients)
+                self.buckets = {k: b for (k, b) in self.buckets.items()
+                                if b[0] + (now - b[1]) * self.limits[k[0]]["rate"] < self.limits[k[0]]["burst"]}
+                self.purged = now
+            tokens, last = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            if tokens < 1:
+                self.buckets[key] = [tokens, now]
+                return (1 - tokens) / rate
+            self.buckets[key] = [tokens - 1, now]
+            return 0
+
+    def reject(self, status, message, retry_after, route_class):
+        stat = "limited" if status == 429 else "shed"
+        with self.lock:
+            self.stats[stat][route_class] = self.stats[stat].get(route_class, 0) + 1
+        res = {"message": message, "route_class": route_class, "retry_after": math.ceil(retry_after)}
+        return HTTPResponse(body=json_dumps(res), status=status,
+                            headers={"Retry-After": str(math.ceil(retry_after)), "Content-Type": "application/json"})
+
+    def admit(self, route_class):
+        """wait for a free slot (or raise a 503)"""
+        with self.slots:
+            if self.in_flight >= self.max_concurrent:
+                shed_depth = self.max_queue if route_class in self.protected else self.shed_depth
+                if self.queued >= shed_depth:
+                    raise self.reject(503, "server busy", 1, route_class)
+                self.queued += 1
+                self.stats["max_queued"] = max(self.stats["max_queued"], self.queued)
+                try:
+                    admitted = self.slots.wait_for(lambda: self.in_flight < self.max_concurrent, self.queue_timeout)
+                finally:
+                    self.queued -= 1
+                if not admitted:
+                    self.stats["timeouts"] += 1
+                    raise self.reject(503, "server busy", 1, route_class)
+            self.in_flight += 1
+            self.stats["admitted"] += 1
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.in_flight)
+
+    def release(self):
+        with self.slots:
+            self.in_flight -= 1
+            self.slots.notify()
+
+    def info(self):
+        with self.lock:
+            return {**copy.deepcopy(self.stats), "in_flight": self.in_flight, "queued": self.queued,
+                    "buckets": len(self.buckets), "max_concurrent": self.max_concurrent, "limits": self.limits}
+
+    def apply(self, callback, route):
+        """Execute Handler"""
+        route_class = self.routeClass(route.rule)
+        limit = self.limits.get(route_class) or self.limits["other"]
+        capped = self.max_concurrent and (route_class not in self.uncapped)
+
+        @wraps(callback)
+        def wrapper(*args, **kwargs):
+            if limit["rate"]:
+                ip, user = self.clientKeys()
+                retry_after = self.take((route_class, "ip", ip), limit["rate"], limit["burst"])
+                if user and not retry_after:
+                    retry_after = self.take((route_class, "user", user), limit["rate"], limit["burst"])
+                if retry_after:
+                    raise self.reject(429, "too many requests", retry_after, route_class)
+            if not capped:
+                return callback(*args, **kwargs)
+            self.admit(route_class)
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                self.release()
+        return wrapper
+
+
+# SQLitePoolPlugin ############################################################
+"""
+Readers and writers use separate pools of connections to the database (with wal=True the database is switched to
+WAL mode, so reads never wait for a write; otherwise a write waits for the reads in progress to finish):
+  * read pool  - "PRAGMA query_only", memory mapped I/O and a large page cache, one connection per concurrent reader
+                 (grows past its size instead of blocking, extra connections are closed when released).
+                 Each request reads from one snapshot (a read transaction), routes can opt out with sqlite={"snapshot": False}
+                 (example: /subscribe must see rows committed while it waits).
+  * write pool - a few connections for add/edit/delete/DDL, requests wait for a free one (SQLite has a single writer anyway)
+The pool of a route is picked by its rule (read_routes) or with the route config sqlite={"pool": "read"|"write"}.
+"""
+class PooledConnection(sqlite3.Connection):
+    pool_slot = True  # -- False: an overflow connection (closed when released)
+
+
+class ConnectionPool(object):
+    def __init__(self, dbfile, size=4, pragmas=None, overflow=False, timeout=30):
+        """init()"""
+        self.dbfile = dbfile
+        self.size = size
+        self.pragmas = pragmas or []
+        self.overflow = overflow
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()  # -- LIFO: the most recently used connection has the warmest cache
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.stats = {"open": 0, "in_use": 0, "acquired": 0, "waits": 0, "overflow": 0, "timeouts": 0}
+
+    def connect(self):
+        db = connectDB(self.dbfile, factory=PooledConnection, check_same_thread=False)
+        for pragma in self.pragmas:
+            db.execute(pragma)
+        with self.lock:
+            self.stats["open"] += 1
+        return db
+
+    def acquire(self):
+        """a connection for this request (waits up to "timeout" seconds for a free one unless the pool can overflow)"""
+        if self.slots.acquire(blocking=False):
+            slot = True
+        elif self.overflow:
+            slot = False
+        else:
+            with self.lock:
+                self.stats["waits"] += 1
+            slot = self.slots.acquire(timeout=self.timeout)
+            if not slot:
+                with self.lock:
+                    self.stats["timeouts"] += 1
+                raise HTTPError(503, "Database Busy: no free connection")
+        try:
+            db = self.idle.get_nowait()
+        except queue.Empty:
+            db = self.connect()
+        with self.lock:
+            self.stats["acquired"] += 1
+            self.stats["in_use"] += 1
+            self.stats["overflow"] += (not slot)
+        db.pool_slot = slot
+        return db
+
+    def release(self, db):
+        """end any open transaction and return the connection to the pool"""
+        if db.in_transaction:
+            db.rollback()
+        slot = db.pool_slot
+        with self.lock:
+            self.stats["in_use"] -= 1
+            if not slot:
+                self.stats["open"] -= 1
+        if slot:
+            self.idle.put(db)
+            self.slots.release()
+        else:
+            db.close()
+
+    def info(self):
+        with self.lock:
+            return {"size": self.size, "idle": self.idle.qsize(), **self.stats}
+
+
+class SQLitePoolPlugin(object):
+    name = 'sqlite'
+    api = 2
+
+    def __init__(self, dbfile, keyword="db", read_routes=(), read_size=8, write_size=2,
+                 mmap_size=256*1024*1024, cache_size=64*1024*1024, snapshot=True, timeout=30, wal=False):
+        """init()"""
+        self.dbfile = dbfile
+        self.keyword = keyword
+        self.read_routes = read_routes
+        self.snapshot = snapshot
+        if dbfile != ":memory:":
+            # -- journal_mode is stored in the file: WAL only on request (recent writes live in "<dbfile>-wal")
+            db = connectDB(dbfile)
+            mode = db.execute("PRAGMA journal_mode;").fetchone()[0]
+            if wal and (mode != "wal"):
+                db.execute("PRAGMA journal_mode = WAL;")
+            elif (not wal) and (mode == "wal"):
+                db.execute("PRAGMA journal_mode = DELETE;")
+            db.close()
+        self.read_pool = ConnectionPool(dbfile, size=read_size, overflow=True, timeout=timeout, pragmas=[
+            "PRAGMA query_only = ON;",
+            f"PRAGMA mmap_size = {int(mmap_size)};",
+            f"PRAGMA cache_size = {-int(cache_size) // 1024};",  # -- negative: KiB
+        ])
+        self.write_pool = ConnectionPool(dbfile, size=write_size, overflow=False, timeout=timeout)
+
+    def finish(self, db, rollback=False):
+        # -- the request's connection and this thread's shard connections are committed (or rolled back) together
+        db.rollback() if rollback else db.commit()
+        commitShards(rollback=rollback)
+        if rollback:
+            discardRowIds()
+
+    def isRead(self, rule):
+        return any((rule == r) or rule.startswith(r.rstrip("/") + "/") for r in self.read_routes)
+
+    def info(self):
+        return {"read": self.read_pool.info(), "write": self.write_pool.info()}
+
+    def apply(self, callback, route):
+        """Execute Handler"""
+        if self.keyword not in route.get_callback_args():
+            return callback
+
+        g = lambda key, default: route.config.get('sqlite.' + key, default)
+        read = g("pool", "read" if self.isRead(route.rule) else "write") == "read"
+        snapshot = read and g("snapshot", self.snapshot)
+        pool = self.read_pool if read else self.write_pool
+
+        @wraps(callback)
+        def wrapper(*args, **kwargs):
+            db = pool.acquire()
+            kwargs[self.keyword] = db
+            try:
+                if snapshot:
+                    # -- every query of the request reads the same snapshot (starts with the first SELECT)
+                    db.execute("BEGIN;")
+                rv = callback(*args, **kwargs)
+                # -- error responses are sent with status 200: the handler flags them with request.environ["m2band.failed"]
+                self.finish(db, rollback=request.environ.get("m2band.failed", False))
+            except sqlite3.IntegrityError as e:
+                self.finish(db, rollback=True)
+                raise HTTPError(500, "Database Error", e)
+            except HTTPError:
+                self.finish(db, rollback=True)
+                raise
+            except HTTPResponse:
+                self.finish(db)
+                raise
+            except Exception:
+                self.finish(db, rollback=True)
+                raise
+            finally:
+                pool.release(db)
+            return rv
+        return wrapper
+
+
+# Retention ###################################################################
+def enableIncrementalVacuum(db):
+    """
+    Switch the database to incremental auto_vacuum (one time VACUUM if needed)
+
+    The VACUUM rebuilds the whole file under an exclusive lock: run it offline (tests/Enable_Incremental_Vacuum.py),
+    never from the server.
+
+    ARGS:
+        Required - db (object)          - the database connection object
+    RETURNS:
+        auto_vacuum (int) - the auto_vacuum mode (2 == INCREMENTAL)
+    """
+    if db.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+        # -- auto_vacuum can only be changed on an existing database by rebuilding it
+        print("PRAGMA auto_vacuum = INCREMENTAL; VACUUM;")
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        db.execute("VACUUM;")
+    return db.execute("PRAGMA auto_vacuum;").fetchone()[0]
+
+def purgeTable(db, table, max_age="", max_rows=0, chunk_size=500, pause=0.05, vacuum_pages=100):
+    """
+    Delete rows outside of a table's retention policy in small chunks
+
+    ARGS:
+        Required - db (object)          - the database connection object
+        Required - table (str|dict)     - the table to purge
+        Optional - max_age (str)        - SQLite datetime modifier, example: "90 days"
+        Optional - max_rows (int)       - max number of rows to keep per "user_id"
+        Optional - chunk_size (int)     - max number of rows deleted per transaction
+        Optional - pause (float)        - seconds to sleep between transactions
+        Optional - vacuum_pages (int)   - max number of pages freed per incremental_vacuum
+    RETURNS:
+        num_deletes (int) - the number of rows that were deleted
+
+    EXAMPLE:
+        num_deletes = purgeTable(db, "oximeter", max_age="90 days", max_rows=100000)
+    """
+    table = getTable(db, table_name=table) if isinstance(table, str) else table
+    if not table:
+        return 0
+    time_cols = [col for col in getColumns(db, table, non_editable=True) if col.endswith("_time")]
+
+    # -- build the "conditions" for each purge, oldest rows first
+    purges = []
+    if max_age and time_cols:
+        cutoff = db.execute("SELECT strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime', ?);",
+                            [f"-{max_age}"]).fetchone()[0]
+        purges.append((f"{time_cols[0]} < ?", [cutoff]))
+    if max_rows and (table["name"] != "users") and ("user_id" in table["columns"]):
+        query = f'SELECT user_id, COUNT(*) - ? AS excess FROM {table["name"]} GROUP BY user_id HAVING excess > 0;'
+        for user_id, excess in db.execute(query, [int(max_rows)]).fetchall():
+            query = f'SELECT rowid FROM {table["name"]} WHERE user_id=? ORDER BY rowid LIMIT 1 OFFSET ?;'
+            last_rowid = db.execute(query, [user_id, excess - 1]).fetchone()[0]
+            purges.append(("user_id=? AND rowid <= ?", [user_id, last_rowid]))
+
+    # -- DELETE FROM oximeter WHERE (rowid IN (SELECT rowid FROM oximeter WHERE ... LIMIT 500));
+    num_deletes = 0
+    for conditions, values in purges:
+        where = f'rowid IN (SELECT rowid FROM {table["name"]} WHERE {conditions} ORDER BY rowid LIMIT {int(chunk_size)})'
+        while True:
+            num_chunk = deleteRow(db, table=table, where=where, values=values)
+            if isinstance(num_chunk, dict):
+                db.rollback()
+                return num_deletes
+            db.commit()
+            commitGenerations()
+            num_deletes += num_chunk
+            if num_chunk < chunk_size:
+                break
+            # -- let pending ingest transactions grab the write lock
+            time.sleep(pause)
+
+    # -- reclaim free pages a few at a time (only with auto_vacuum = INCREMENTAL, the pragma is a no-op otherwise)
+    if num_deletes and vacuum_pages and (db.execute("PRAGMA auto_vacuum;").fetchone()[0] == 2):
+        free_pages = db.execute("PRAGMA freelist_count;").fetchone()[0]
+        while free_pages:
+            db.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)});").fetchall()
+            db.commit()
+            remaining = db.execute("PRAGMA freelist_count;").fetchone()[0]
+            if remaining >= free_pages:
+                break
+            free_pages = remaining
+            time.sleep(pause)
+    return num_deletes
+
+def startRetention(dbfile, policies, interval=3600, chunk_size=500, pause=0.05):
+    """
+    Enforce retention policies from a background thread
+
+    ARGS:
+        Required - dbfile (str)         - path to the SQLite database
+        Required - policies (dict)      - {table_name: {"max_age": str, "max_rows": int}}
+        Optional - interval (int)       - seconds between purges
+        Optional - chunk_size (int)     - max number of rows deleted per transaction
+        Optional - pause (float)        - seconds to sleep between transactions
+    RETURNS:
+        thread (object) - the running daemon thread
+
+    EXAMPLE:
+        policies = {"oximeter": {"max_age": "90 days", "max_rows": 100000}}
+        startRetention("m2band.db", policies, interval=600)
+    """
+    def _retention():
+        db = connectDB(dbfile)
+        try:
+            # -- without auto_vacuum = INCREMENTAL the freed pages are reused but the file doesn't shrink
+            for conn in [db] + (shardConnections(db) if shard_config["count"] > 1 else []):
+                if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+                    logger.info(json.dumps({"retention": "auto_vacuum is not INCREMENTAL", "shard": getattr(conn, "shard", None),
+                                            "run": "tests/Enable_Incremental_Vacuum.py"}))
+        except sqlite3.Error as e:
+            logger.info(json.dumps({"retention": "startup", f"SQLite.{e.__class__.__name__}": str(e)}))
+        while True:
+            for table_name, policy in policies.items():
+                # -- sharded tables are purged shard by shard
+                sharded = (shard_config["count"] > 1) and (table_name in shardedTables(db))
+                for conn in (shardConnections(db) if sharded else [db]):
+                    try:
+                        start = time.time()
+                        num_deletes = purgeTable(conn, table_name, chunk_size=chunk_size, pause=pause, **policy)
+                        logger.info(json.dumps({"retention": table_name, "shard": getattr(conn, "shard", None),
+                                                "policy": policy, "deleted": num_deletes,
+                                                "seconds": round(time.time() - start, 3)}))
+                    except sqlite3.Error as e:
+                        conn.rollback()
+                        logger.info(json.dumps({"retention": table_name, f"SQLite.{e.__class__.__name__}": str(e)}))
+            time.sleep(interval)
+
+    thread = threading.Thread(target=_retention, name="retention", daemon=True)
+    thread.start()
+    return thread
+
+
+# Chunked Writes ##############################################################
+"""
+A /delete or /edit with a broad filter holds the write lock for the whole statement and stalls ingest.
+A WriteJob runs the same statement over one rowid range at a time (chunk_size rowids), each range in its own
+short transaction, with a pause in between, so other writers get the lock between chunks:
+    DELETE FROM oximeter WHERE (rowid > ? AND rowid <= ? AND (temperature > 100.4));
+Jobs run one at a time on their own connection. Rows added after a job started (higher rowids) are not touched.
+"""
+write_jobs = OrderedDict()  # -- job id: WriteJob (the latest max_jobs)
+write_jobs_lock = threading.Lock()
+write_job_runner = threading.Lock()
+
+class WriteJob(object):
+    max_jobs = 100
+
+    def __init__(self, op, table, where, values, columns=None, col_values=None, chunk_size=500, pause=0.05):
+        """init()"""
+        self.id = codecs.encode(os.urandom(4), "hex").decode()
+        self.op = op
+        self.table = table
+        self.where = where
+        self.values = [values] if isinstance(values, str) else list(values or [])
+        self.columns = columns or []
+        self.col_values = col_values or []
+        self.chunk_size = max(1, int(chunk_size))
+        self.pause = pause
+        self.cancelled = threading.Event()
+        self.state = {"status": "queued", "rows": 0, "chunks": 0, "percent": 0.0, "shard": None,
+                      "rowid": None, "started": None, "finished": None, "error": None}
+
+    def info(self):
+        return {"job": self.id, "op": self.op, "table": self.table["name"], "where": self.where,
+                "values": self.values, "chunk_size": self.chunk_size, **self.state}
+
+    def cancel(self):
+        # -- stops after the current chunk (the chunks already committed stay committed)
+        self.cancelled.set()
+
+    def rowidBounds(self, db):
+        # -- (first - 1, last) rowid of the table: rows added after the job started are left alone
+        table_name = self.table["name"]
+        return db.execute(f"SELECT IFNULL(MIN(rowid), 0) - 1, IFNULL(MAX(rowid), 0) FROM {table_name};").fetchone()
+
+    def runChunks(self, db, part, parts, first, last):
+        table_name = self.table["name"]
+        cursor = first
+        while (cursor < last) and not self.cancelled.is_set():
+            # -- the next range: chunk_size rowids (an index seek, not a scan of the matching rows)
+            query = f"SELECT rowid FROM {table_name} WHERE rowid > ? ORDER BY rowid LIMIT 1 OFFSET ?;"
+            upper = db.execute(query, [cursor, self.chunk_size - 1]).fetchone()
+            upper = min(upper[0], last) if upper else last
+            where = f"rowid > ? AND rowid <= ? AND ({self.where})" if self.where else "rowid > ? AND rowid <= ?"
+            values = [cursor, upper] + self.values
+            if self.op == "delete":
+                res = deleteRow(db, table=self.table, where=where, values=values)
+            else:
+                res = updateRow(db, table=self.table, columns=self.columns, col_values=self.col_values,
+                                where=where, values=values)
+            if isinstance(res, dict):
+                db.rollback()
+                return {k: v for (k, v) in res.items() if k.startswith("SQLite.")}
+            db.commit()
+            commitGenerations()
+            cursor = upper
+            self.state.update({
+                "rows": self.state["rows"] + res, "chunks": self.state["chunks"] + 1, "rowid": cursor,
+                "percent": round(100 * (part + (cursor - first) / max(1, last - first)) / parts, 1),
+            })
+            # -- let pending ingest transactions grab the write lock
+            time.sleep(self.pause)
+
+    def run(self, dbfile):
+        with write_job_runner:
+            self.state.update({"status": "running", "started": time.strftime("%Y-%m-%d %H:%M:%S")})
+            db = connectDB(dbfile)
+            try:
+                # -- sharded tables are processed shard by shard
+                sharded = (shard_config["count"] > 1) and (self.table["name"] in shardedTables(db))
+                connections = shardConnections(db) if sharded else [db]
+                # -- the bounds of every shard are read up front: the job covers the rows that existed when it started
+                bounds = [self.rowidBounds(conn) for conn in connections]
+                for (part, (conn, (first, last))) in enumerate(zip(connections, bounds)):
+                    self.state["shard"] = getattr(conn, "shard", None)
+                    err = self.runChunks(conn, part, len(connections), first, last)
+                    if err:
+                        self.state.update({"status": "failed", "error": err})
+                        break
+                else:
+                    self.state["status"] = "cancelled" if self.cancelled.is_set() else "done"
+            except sqlite3.Error as e:
+                self.state.update({"status": "failed", "error": {f"SQLite.{e.__class__.__name__}": str(e)}})
+            finally:
+                db.close()
+                self.state["finished"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            logger.info(json.dumps({"write_job": self.info()}, default=str))
+
+def startWriteJob(dbfile, op, table, where="", values=None, columns=None, col_values=None, chunk_size=500, pause=0.05):
+    """
+    Run a large delete or update in rowid-ranged chunks from a background thread
+
+    ARGS:
+        Required - dbfile (str)         - path to the SQLite database
+        Required - op (str)             - "delete" OR "edit"
+        Required - table (dict)         - the table to delete from / update
+        Optional - where (str)          - conditional "WHERE" statement (like deleteRow() and updateRow())
+        Optional - values (list)        - the value(s) for the "WHERE" statement
+        Optional - columns (list)       - "edit": the columns to edit
+        Optional - col_values (list)    - "edit": the values for the columns
+        Optional - chunk_size (int)     - rowids per transaction
+        Optional - pause (float)        - seconds to sleep between transactions
+    RETURNS:
+        job (WriteJob) - job.info() for progress, job.cancel() to stop after the current chunk
+
+    EXAMPLE:
+        job = startWriteJob("m2band.db", "delete", getTable(db, table_name="oximeter"),
+                            where="temperature > ?", values=[100.4], chunk_size=1000)
+    """
+    job = WriteJob(op, table, where, values, columns, col_values, chunk_size, pause)
+    with write_jobs_lock:
+        write_jobs[job.id] = job
+        finished = [k for (k, j) in write_jobs.items() if j.state["finished"]]
+        for k in finished[:max(0, len(write_jobs) - WriteJob.max_jobs)]:
+            del write_jobs[k]
+    threading.Thread(target=job.run, args=(dbfile,), name=f"write-job-{job.id}", daemon=True).start()
+    return job
+
+
+# Sharding ####################################################################
+"""
+Optional sharded mode (SHARDS > 1): user-scoped tables (every table with a "user_id" column except "users")
+live in SHARDS database files next to the main one (m2band.shard0.db, m2band.shard1.db, ...),
+the shard of a row is crc32(user_id) % SHARDS. The main database keeps the users table and the
+schema of every table (the sharded tables stay empty there).
+
+insertRow(s), fetchRow(s), updateRow and deleteRow called with a [table] route to the shard of the
+"user_id" in the columns or in the "user_id=?" condition, and fan out to every shard (merged results)
+when the conditions don't pin a single user_id. Full SQL [query] calls are not routed.
+
+New row ids are unique across shards: the smallest id > max(ids in every shard, now in microseconds)
+with id % SHARDS == shard, so ids keep growing with time like a single table's. Id allocation is serialized
+across the shards until commit (see allocateIds), so ids are also committed in order.
+Each thread keeps one connection per shard, committed by commitShards() at the end of a request (SQLitePoolPlugin),
+or rolled back with the request's own connection when the request failed. A fan out that fails in one shard
+rolls back every shard at once.
+tests/Reshard_Database.py moves the rows when SHARDS changes.
+"""
+shard_config = {"count": 1, "dbfile": ""}
+shard_local = threading.local()
+shard_ids = {}                  # -- (dbfile, table): the last id allocated in any shard
+shard_ids_lock = threading.Lock()  # -- held from a request's first id allocation until its shards are committed
+
+class ShardConnection(sqlite3.Connection):
+    """connection to a shard file (the CRUD functions don't route these again)"""
+    shard = 0
+
+def shardFile(dbfile, shard):
+    name, ext = os.path.splitext(dbfile)
+    return f"{name}.shard{shard}{ext or '.db'}"
+
+def shardIndex(user_id, count=None):
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        pass
+    return zlib.crc32(str(user_id).encode()) % (count or shard_config["count"])
+
+def shardedTables(db):
+    # -- the user-scoped tables: a "user_id" column (except "users")
+    return [t["name"] for t in schemaEntry(db)["tables"]
+            if (t["name"] != "users") and any(c["name"] == "user_id" for c in t["columns"])]
+
+def configureShards(dbfile, count):
+    """
+    Enable (count > 1) or disable sharding for "dbfile"
+
+    Raises RuntimeError if the files on disk were sharded with a different count
+    (run tests/Reshard_Database.py first)
+    """
+    count = max(1, int(count))
+    # -- every shard file on disk (m2band.shard0.db, m2band.shard7.db, ...), not only the ones "count" expects
+    name, ext = os.path.splitext(dbfile)
+    pattern = re.compile(re.escape(os.path.basename(name)) + r"\.shard\d+" + re.escape(ext or ".db") + "$")
+    found = [f for f in os.listdir(os.path.dirname(os.path.abspath(dbfile))) if pattern.match(f)]
+    if len(found) != (count if count > 1 else 0):
+        if found or (count == 1):
+            raise RuntimeError(f'{len(found)} shard files found: {dbfile} is not sharded '
+                               f'into {count} files, run: tests/Reshard_Database.py {dbfile} {count}')
+    if count > 1:
+        db = connectDB(dbfile)
+        for table_name in shardedTables(db):
+            if db.execute(f"SELECT 1 FROM {table_name} LIMIT 1;").fetchone():
+                raise RuntimeError(f'<{table_name}> has rows in {dbfile}: run: tests/Reshard_Database.py {dbfile} {count}')
+        db.close()
+    shard_config.update({"count": count, "dbfile": dbfile})
+    return shard_config
+
+def shardConnections(db):
+    """this thread's connections to every shard, with the sharded tables synced to the main schema"""
+    if getattr(shard_local, "connections", None) is None:
+        shard_local.connections = []
+        shard_local.version = None
+        for shard in range(shard_config["count"]):
+            conn = connectDB(shardFile(shard_config["dbfile"], shard), factory=ShardConnection)
+            conn.shard = shard
+            shard_local.connections.append(conn)
+
+    entry = schemaEntry(db)
+    if shard_local.version != entry["version"]:
+        names = shardedTables(db)
+        statements = db.execute("SELECT sql FROM sqlite_schema WHERE tbl_name IN (%s) AND sql IS NOT NULL "
+                                "ORDER BY type = 'index';" % ", ".join("?" * len(names)), names).fetchall()
+        for conn in shard_local.connections:
+            existing = [r[0] for r in conn.execute("SELECT name FROM sqlite_schema WHERE type = 'table';")]
+            for name in [n for n in existing if (n not in names) and (not n.startswith("sqlite_"))]:
+                conn.execute(f"DROP TABLE {name};")
+            for (sql,) in statements:
+                conn.execute(re.sub(r"^CREATE (UNIQUE )?(TABLE|INDEX) ", r"CREATE \1\2 IF NOT EXISTS ", sql))
+            conn.commit()
+        shard_local.version = entry["version"]
+    return shard_local.connections
+
+def commitShards(rollback=False):
+    # -- called at the end of every request (and after every explicit commit of the main connection)
+    try:
+        for conn in getattr(shard_local, "connections", None) or []:
+            conn.rollback() if rollback else conn.commit()
+    finally:
+        if getattr(shard_local, "allocating", False):
+            shard_local.allocating = False
+            shard_ids_lock.release()
+
+def shardRoute(db, query, kwargs):
+    # -- True if a CRUD call has to be routed to the shard(s)
+    if (shard_config["count"] < 2) or query or isinstance(db, ShardConnection):
+        return False
+    table = kwargs.get("table")
+    name = table["name"] if isinstance(table, dict) else (table or "")
+    if (name == "users") or name.startswith("sqlite_"):
+        return False
+    return name in shardedTables(db)
+
+def shardTable(db, table):
+    # -- the table (dict) with "columns" as {name: type}
+    if isinstance(table, dict) and isinstance(table.get("columns"), dict):
+        return table
+    return getTable(db, table_name=table["name"] if isinstance(table, dict) else table)
+
+def shardTargets(db, conditions, values):
+    """the shard connections that can hold rows matching "conditions": one for "user_id=?", else all"""
+    connections = shardConnections(db)
+    values = [values] if isinstance(values, str) else (values or [])
+    if conditions and not re.search(r"\b(OR|NOT)\b", conditions, re.IGNORECASE):
+        for m in re.finditer(r"\buser_id\s*==?\s*\?", conditions):
+            index = conditions[:m.end()].count("?") - 1
+            if index < len(values):
+                return [connections[shardIndex(values[index])]]
+    return connections
+
+def allocateIds(conn, table, ref, count):
+    """
+    reserve "count" new ids in a shard (takes the shard's write lock until commit)
+
+    One request at a time allocates ids (shard_ids_lock, released by commitShards()), and every id is larger than
+    the last one allocated in any shard: the shards commit their ids in increasing order, so a /subscribe cursor
+    ("{ref} > cursor") that moved past an id can't miss a row committed later with a smaller one.
+    """
+    if not getattr(shard_local, "allocating", False):
+        shard_ids_lock.acquire()
+        shard_local.allocating = True
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE;")
+    key = (shard_config["dbfile"], table)
+    if key not in shard_ids:
+        shard_ids[key] = max(c.execute(f"SELECT IFNULL(MAX({ref}), 0) FROM {table};").fetchone()[0]
+                             for c in shard_local.connections)
+    m = max(shard_ids[key], int(time.time() * 1000000),
+            conn.execute(f"SELECT IFNULL(MAX({ref}), 0) FROM {table};").fetchone()[0])
+    n = shard_config["count"]
+    first = m - m % n + conn.shard
+    first += n if first <= m else 0
+    ids = [first + i * n for i in range(count)]
+    shard_ids[key] = ids[-1]
+    return ids
+
+def shardedInsertRow(db, **kwargs):
+    table = shardTable(db, kwargs["table"])
+    ref = getColumns(db, table, ref=True)
+    params = dict(zip(kwargs["columns"], kwargs["col_values"]))
+    conn = shardConnections(db)[shardIndex(params.get("user_id"))]
+    try:
+        (row_id,) = allocateIds(conn, table["name"], ref, 1)
+    except sqlite3.Error as e:
+        return {f'SQLite.{e.__class__.__name__}': str(e), 'Debug Info': {"shard": conn.shard, "kwargs": kwargs}}
+    return insertRow(conn, table=table, columns=[ref] + list(kwargs["columns"]), col_values=[row_id] + list(kwargs["col_values"]))
+
+def shardedUpsertRow(db, **kwargs):
+    # -- the natural key must contain user_id, so a conflicting row is always in the same shard
+    if "user_id" not in kwargs["conflict"]:
+        return {'SQLite.NotSupportedError': "the upsert key of a sharded table must include user_id",
+                'Debug Info': {"kwargs": kwargs}}
+    table = shardTable(db, kwargs["table"])
+    ref = getColumns(db, table, ref=True)
+    params = dict(zip(kwargs["columns"], kwargs["col_values"]))
+    conn = shardConnections(db)[shardIndex(params.get("user_id"))]
+    try:
+        (row_id,) = allocateIds(conn, table["name"], ref, 1)
+    except sqlite3.Error as e:
+        return {f'SQLite.{e.__class__.__name__}': str(e), 'Debug Info': {"shard": conn.shard, "kwargs": kwargs}}
+    return upsertRow(conn, **{**kwargs, "table": table, "columns": [ref] + list(kwargs["columns"]),
+                              "col_values": [row_id] + list(kwargs["col_values"])})
+
+def shardedInsertRows(db, **kwargs):
+    table = shardTable(db, kwargs["table"])
+    ref = getColumns(db, table, ref=True)
+    columns = list(kwargs["columns"])
+    connections = shardConnections(db)
+    user_col = columns.index("user_id") if "user_id" in columns else None
+    groups = {}
+    for (i, row) in enumerate(kwargs["rows"]):
+        groups.setdefault(shardIndex(row[user_col] if user_col is not None else None), []).append(i)
+
+    row_ids = [None] * len(kwargs["rows"])
+    for (shard, indexes) in groups.items():
+        conn = connections[shard]
+        try:
+            ids = allocateIds(conn, table["name"], ref, len(indexes))
+        except sqlite3.Error as e:
+            return {f'SQLite.{e.__class__.__name__}': str(e), 'Debug Info': {"shard": shard, "table": table["name"]}}
+        rows = [[row_id] + list(kwargs["rows"][i]) for (row_id, i) in zip(ids, indexes)]
+        res = insertRows(conn, table=table, columns=[ref] + columns, rows=rows)
+        if isinstance(res, dict):
+            commitShards(rollback=True)  # -- the shards written before the error
+            return res
+        for (row_id, i) in zip(ids, indexes):
+            row_ids[i] = row_id
+    return row_ids
+
+def shardedFetchRow(db, **kwargs):
+    rows = shardedFetchRows(db, **{**kwargs, "force": True})
+    return rows[0] if isinstance(rows, list) else rows
+
+def shardedFetchRows(db, **kwargs):
+    targets = shardTargets(db, kwargs.get("where", ""), kwargs.get("values"))
+    if len(targets) == 1:
+        return fetchRows(targets[0], **kwargs)
+
+    # -- fan out: merge every shard's rows in id order (like a single table)
+    rows = []
+    for conn in targets:
+        res = fetchRows(conn, **{**kwargs, "force": True})
+        if isinstance(res, dict):
+            return res
+        rows += res or []
+    ref = getColumns(db, shardTable(db, kwargs["table"]), ref=True)
+    if rows and (ref in rows[0]):
+        rows.sort(key=lambda row: row[ref])
+    if rows:
+        return rows[0] if ((len(rows) == 1) and (not kwargs.get("force"))) else rows
+    return False
+
+def shardedUpdateRow(db, **kwargs):
+    if "user_id" in kwargs["columns"]:
+        # -- the row would have to move to another shard
+        return {'SQLite.NotSupportedError': "user_id can't be edited in a sharded table",
+                'Debug Info': {"kwargs": kwargs}}
+    num_edits = 0
+    for conn in shardTargets(db, kwargs.get("where", ""), kwargs.get("values")):
+        res = updateRow(conn, **kwargs)
+        if isinstance(res, dict):
+            commitShards(rollback=True)  # -- the shards updated before the error
+            return res
+        num_edits += res
+    return num_edits
+
+def shardedUpdateRows(db, **kwargs):
+    # -- updates keyed by user_id go to their shard, the others to every shard (counts are summed)
+    updates = kwargs["updates"]
+    if any("user_id" in u["changes"] for u in updates):
+        return {'SQLite.NotSupportedError': "user_id can't be edited in a sharded table",
+                'Debug Info': {"table": kwargs["table"], "updates": len(updates)}}
+    connections = shardConnections(db)
+    targets = {}
+    for (i, update) in enumerate(updates):
+        shards = [shardIndex(update["key"]["user_id"])] if "user_id" in update["key"] else range(len(connections))
+        for shard in shards:
+            targets.setdefault(shard, []).append(i)
+    counts = [0] * len(updates)
+    for (shard, rows) in targets.items():
+        res = updateRows(connections[shard], **{**kwargs, "updates": [updates[i] for i in rows]})
+        if isinstance(res, dict):
+            commitShards(rollback=True)  # -- the shards updated before the error
+            return res
+        for (i, count) in zip(rows, res):
+            counts[i] += count
+    return counts
+
+def shardedDeleteRow(db, **kwargs):
+    num_deletes = 0
+    for conn in shardTargets(db, kwargs.get("where", ""), kwargs.get("values")):
+        res = deleteRow(conn, **kwargs)
+        if isinstance(res, dict):
+            commitShards(rollback=True)  # -- the shards deleted from before the error
+            return res
+        num_deletes += res
+    return num_deletes
+
+
 # DEPRECATED FUNCTIONS ########################################################
 """
 def parseFilters(filters, conditions):
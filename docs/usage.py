@@ -29,7 +29,32 @@ usage_add = {
                 "user_id": 8
             },
         },
-        "Required": "'user_id' and all params not '*_id' and '*_time'",
+        "/add/<table_name> (binary body)": {
+            "body": "add entries: MessagePack, CBOR or packed struct (set the 'Content-Type' header)",
+            "Content-Type": {
+                "application/msgpack": "an object, an array of objects or {'columns': [...], 'rows': [[...], ...]}",
+                "application/cbor": "an object, an array of objects or {'columns': [...], 'rows': [[...], ...]}",
+                "application/octet-stream": "packed rows (little-endian): required columns in table order, INTEGER=int32, DOUBLE=float64",
+            },
+            "example": "/add/oximeter (body: struct.pack('<iiidi', user_id, heart_rate, blood_o2, temperature, steps) * n)",
+            "response": {
+                "message": "data added to <oximeter>",
+                "count": 3,
+                "entry_id": [54, 56]
+            },
+        },
+        "/add/<table_name>?param_name=param_value&upsert=col_1,col_2": {
+            "params": "add entry OR update the entry with the same values in the unique columns 'col_1,col_2' (an existing unique index, with 'user_id' if the table has one)",
+            "on_conflict": "'update' (default) the existing entry OR do 'nothing'",
+            "example": "/add/oximeter?user_id=3&heart_rate=70&blood_o2=97&temperature=98.1&steps=5&entry_time=2022-04-05 12:16:54.651&upsert=user_id,entry_time",
+            "response": {
+                "message": "data updated in <oximeter>",
+                "entry_id": 925,
+                "upsert": {"conflict": ["user_id", "entry_time"], "on_conflict": "update", "action": "updated"},
+                "user_id": 3
+            },
+        },
+        "Required": "'user_id' and all params not '*_id' and '*_time' (and the 'upsert' columns)",
         "Exception": "no 'user_id' when adding to the users table",
         "Response": {
             "'user_id'": "when entry added to 'users' table",
@@ -165,6 +190,28 @@ usage_edit = {
                 }]
             },
         },
+        "/edit/<table_name>?filter=query&chunk=<rowids>": {
+            "params": "large edits: a background job edits 'chunk' rowids per transaction (ingest isn't stalled), see '/jobs'",
+            "example": "/edit/oximeter?steps=0&filter=(steps < 0)&chunk=1000",
+            "response": {
+                "message": "edit job started",
+                "job": "4be0d913",
+                "progress": "/jobs/4be0d913",
+                "cancel": "/jobs/4be0d913/cancel",
+                "submitted": [{"filter": "(steps < 0)", "steps": "0"}]
+            },
+        },
+        "/edit/<table_name> (JSON body)": {
+            "body": "bulk edit, a different edit for every entry: [{'key': {column: value, ...}, 'changes': {edit_param: value, ...}}, ...]",
+            "example": "/edit/oximeter (body: [{'key': {'entry_id': 52}, 'changes': {'temperature': 98.2}}, "
+                       "{'key': {'entry_id': 53}, 'changes': {'temperature': 98.4}}, {'key': {'entry_id': 99}, 'changes': {'steps': 3}}])",
+            "response": {
+                "message": "edited 2 oximeter entries",
+                "rows": 3,
+                "counts": [1, 1, 0],
+                "not_found": [2]
+            },
+        },
         "Required": {
             "Parameters": {
                 "at least 1 edit parameter": "any parameter not '*_id' or '*_time'",
@@ -223,6 +270,17 @@ usage_delete = {
                 "submitted": [{"filter": "(user_id = '8' AND temperature > '100.4')"}]
             },
         },
+        "/delete/<table_name>?filter=query&chunk=<rowids>": {
+            "params": "large deletes: a background job deletes 'chunk' rowids per transaction (ingest isn't stalled), see '/jobs'",
+            "example": "/delete/oximeter?filter=(temperature > '100.4')&chunk=1000",
+            "response": {
+                "message": "delete job started",
+                "job": "9f2c61ab",
+                "progress": "/jobs/9f2c61ab",
+                "cancel": "/jobs/9f2c61ab/cancel",
+                "submitted": [{"filter": "(temperature > '100.4')"}]
+            },
+        },
         "Required": {
             "Parameters": {
                 "at least 1 reference parameter": "any '*_id' or '*_time' parameter or 'filter'"
@@ -314,7 +372,7 @@ usage_create_table = {
                 "{ref}_id": "INTEGER",
                 "{ref}_time": "DATETIME",
                 "column_name": "lowercase with underscores where appropriate",
-                "column_type": "one of 'INTEGER', 'DOUBLE', 'TEXT', 'DATETIME'",
+                "column_type": "one of 'INTEGER', 'DOUBLE', 'TEXT', 'DATETIME', 'EPOCH'",
             }
         },
         "Exception": "'{ref}_id' not required when creating 'users' table",
@@ -369,3 +427,171 @@ usage_logout = {
     },
 
 }
+
+usage_stats = {
+    "message": "usage info: /stats",
+    "description": "server statistics",
+    "end_points": {
+        "/stats": {
+            "returns": "all server stats"
+        },
+        "/stats/<stat_name>": {
+            "returns": "a single server stat",
+            "example": "/stats/cache",
+            "response": {
+                "message": "server stats: cache",
+                "cache": {
+                    "hits": 120, "misses": 14, "evictions": 0, "invalidations": 9, "hit_rate": 0.896,
+                    "entries": 5, "bytes": 20480, "max_entries": 1024, "max_bytes": 67108864
+                }
+            },
+        },
+        "Stats": {
+            "cache": "/get result cache: hits, misses, evictions, invalidations and size",
+            "coalescing": "identical in-flight /get queries: leaders (queries run), shared (requests that waited for a leader), timeouts",
+            "slowQueries": "the latest queries slower than SLOW_QUERY_MS: query, value types, ms, rows returned/scanned, query plan",
+            "legacy": "requests served per legacy path (/addUser, /getSensorData, ...) and when each was last used",
+            "pools": "read and write connection pools: size, open, idle, in use, waits, overflow connections, timeouts",
+            "admission": "rate limited (429) and shed (503) requests per route class, requests in flight and queued",
+        },
+    },
+}
+
+usage_subscribe = {
+    "message": "usage info: '/subscribe'",
+    "description": "wait for new entries in a table: <table_name> (same params and filter as '/get')",
+    "endpoints": {
+        "/subscribe": {
+            "returns": "returns all tables[] in the database",
+        },
+        "/subscribe/usage": {
+            "returns": "message: 'usage-info'",
+        },
+        "/subscribe/<table_name>/<param_name>/<param_value>?since=<ref_id>": {
+            "url_paths": "long-poll: new entries matching 'param_name=param_value' with '{ref}_id > since'",
+            "example": "/subscribe/oximeter/user_id/8?since=53",
+            "response": {
+                "message": "found 1 new oximeter entries",
+                "since": 54,
+                "data": [
+                    {"entry_id": 54, "user_id": 8, "heart_rate": 133, "blood_o2": 95, "temperature": 98.71, "entry_time": "2022-04-05 12:16:54.651"}
+                ],
+            },
+        },
+        "/subscribe/<table_name>?param_name=param_value&stream=sse": {
+            "params": "server-sent events: one 'rows' event per batch of new entries",
+            "example": "/subscribe/oximeter?user_id=8&stream=sse",
+            "response": "id: 54\nevent: rows\ndata: [{\"entry_id\": 54, \"user_id\": 8, ...}]",
+        },
+        "Options": {
+            "since": "'{ref}_id' cursor, only newer entries are returned (default: the newest entry)",
+            "timeout": "seconds to wait before returning 0 entries (default: 25, max: 60)",
+            "stream": "'sse' (or header 'Accept: text/event-stream') for server-sent events",
+        },
+        "Response": {
+            "since": "the cursor for the next '/subscribe' request",
+            "data[]": "the new entries (oldest first)",
+        },
+    },
+}
+
+usage_ingest = {
+    "message": "usage info: '/ingest'",
+    "description": "websocket channel: stream frames of samples into a table: <table_name>",
+    "endpoints": {
+        "/ingest/usage": {
+            "returns": "message: 'usage-info'",
+        },
+        "/ingest/<table_name>": {
+            "websocket": "send one frame per batch of samples, receive one ack per frame",
+            "example": "ws://m2band.hopto.org/ingest/oximeter",
+            "frame": {
+                "frame": 7,
+                "columns": ["user_id", "heart_rate", "blood_o2", "temperature", "steps"],
+                "rows": [[8, 133, 95, 98.71, 2], [8, 131, 96, 98.69, 4]]
+            },
+            "response": {
+                "frame": 7,
+                "message": "data added to <oximeter>",
+                "count": 2,
+                "entry_id": [54, 55]
+            },
+        },
+        "Frames": {
+            "{'frame': n, 'columns': [...], 'rows': [[...], ...]}": "rows as arrays in 'columns' order",
+            "{'frame': n, 'rows': [{...}, ...]}": "rows as objects",
+            "[{...}, ...]": "rows as objects (no frame number)",
+        },
+        "Required": "'user_id' and all params not '*_id' and '*_time' ('*_time' is optional)",
+        "Exception": "the users table can not be used with '/ingest'",
+        "Response": {
+            "frame": "the frame number that was submitted",
+            "count": "number of entries added (all rows of a frame are added in one transaction)",
+            "'<ref>_id'": "[first, last] id of the added entries",
+        },
+    },
+}
+
+usage_batch = {
+    "message": "usage info: '/batch'",
+    "description": "run a list of '/add', '/get', '/edit' and '/delete' calls in order, in one transaction (one request, one commit)",
+    "endpoints": {
+        "/batch/usage": {
+            "returns": "message: 'usage-info'",
+        },
+        "/batch (JSON body)": {
+            "body": "a list of operations: {'op': 'add'|'get'|'edit'|'delete', 'table': <table_name>, 'params': {param_name: param_value, 'filter': ...}}",
+            "example": "/batch (body: [{'op': 'add', 'table': 'oximeter', 'params': {'user_id': 8, 'heart_rate': 133, ...}}, "
+                       "{'op': 'delete', 'table': 'oximeter', 'params': {'entry_id': 54}}])",
+            "response": {
+                "message": "batch: 2 of 2 operations applied",
+                "mode": "atomic",
+                "failed": 0,
+                "results": [
+                    {"op": 0, "status": "ok", "result": {"message": "data added to <oximeter>", "entry_id": 55, "user_id": 8}},
+                    {"op": 1, "status": "ok", "result": {"message": "1 oximeter entry deleted", "submitted": [{"entry_id": 54}]}}
+                ]
+            },
+        },
+        "/batch/<mode> (JSON body)": {
+            "atomic": "default: the first failed operation rolls back the whole batch, the rest is 'skipped'",
+            "savepoint": "every operation has its own savepoint: a failed operation is rolled back, the others are committed "
+                         "(not with sharded tables: the shards can only roll back the whole batch)",
+        },
+        "Operations": "'params' are the params of the same call as a single request (e.g. '/add/oximeter?user_id=8&...')",
+        "Response": {
+            "results[]": "one result per operation (in order): status 'ok', 'failed', 'rolled back' or 'skipped' and the call's response",
+            "get": "reads in a batch see the batch's own (uncommitted) changes and are not cached",
+        },
+    },
+}
+
+usage_jobs = {
+    "message": "usage info: '/jobs'",
+    "description": "progress and cancellation of chunked '/delete' and '/edit' jobs (started with 'chunk=<rowids>')",
+    "endpoints": {
+        "/jobs": {
+            "returns": "the latest jobs",
+        },
+        "/jobs/<job_id>": {
+            "returns": "the progress of a job",
+            "example": "/jobs/9f2c61ab",
+            "response": {
+                "message": "job 9f2c61ab: running",
+                "job": "9f2c61ab", "op": "delete", "table": "oximeter", "where": "(temperature > ?)", "values": ["100.4"],
+                "chunk_size": 1000, "status": "running", "rows": 318, "chunks": 12, "percent": 41.5, "shard": None,
+                "rowid": 12040, "started": "2022-04-05 12:16:54", "finished": None, "error": None
+            },
+        },
+        "/jobs/<job_id>/cancel": {
+            "returns": "the job, it stops after the current chunk (the chunks done stay committed)",
+        },
+        "Status": {
+            "queued": "waiting for the running job (one job at a time)",
+            "running": "'rows' changed so far in 'chunks' transactions, 'rowid' is the end of the last chunk",
+            "done": "every rowid that existed when the job started was processed",
+            "cancelled": "stopped by '/jobs/<job_id>/cancel'",
+            "failed": "stopped by a SQLite error ('error'), the failed chunk was rolled back",
+        },
+    },
+}
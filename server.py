@@ -1,56 +1,123 @@
+import os
+if os.environ.get("SERVER") == "gevent":
+    # -- gevent (and the /ingest websocket handler) must patch the stdlib before bottle is imported
+    from gevent import monkey
+    monkey.patch_all()
+
 # from bottle import hook, install, route, run, request, response, redirect, static_file, urlencode, HTTPError
-from bottle import hook, route, run, request, redirect, urlencode
-from bottle_sqlite import SQLitePlugin, sqlite3
+from bottle import hook, route, run, request, response, json_dumps, HTTPResponse, FormsDict
 # from bottle_errorsrest import ErrorsRestPlugin
 # from datetime import datetime
 from db_functions import (
-    insertRow, fetchRow, fetchRows, updateRow, deleteRow,
+    insertRow, fetchRow, fetchRows, updateRow, updateRows, deleteRow,
     addTable, deleteTable, getTable, getTables, getColumns,
     securePassword, checkPassword, checkUserAgent, clean2,
     clean, extract, mapUrlPaths, getLogger, log_to_logger, logger,
     parseURI, parseUrlPaths, parseFilters, parseColumnValues,
-    ErrorsRestPlugin
+    ErrorsRestPlugin, CompressionPlugin, SQLitePoolPlugin, AdmissionPlugin, startRetention,
+    commitGenerations, getETag, checkETag, notModified, getGeneration, result_cache,
+    waitForRows, fetchNewRows, lastRowId, streamRows, connectDB, ingestFrame,
+    parseBody, body_types, slow_query_log, single_flight,
+    addStaticResponse, staticResponse, tableListing, configureShards, commitShards, shardRoute, uniqueColumns,
+    upsertRow, uniqueKeys, startWriteJob, write_jobs, pendingRowIds, discardRowIds
 )
 from rich import print
 from docs.usage import (
     usage_add, usage_get, usage_edit, usage_delete,
     usage_create_table, usage_delete_table,
-    usage_login, usage_logout
+    usage_login, usage_logout, usage_stats, usage_subscribe, usage_ingest, usage_batch, usage_jobs
 )
 import bottle
+import threading
 import json
-import os
+import time
 import re
 
 
 # app = Bottle()
 app = bottle.app()
-plugin = SQLitePlugin(dbfile="m2band.db", detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+dbfile = os.environ.get("DB_FILE", "m2band.db")
+time_storage = os.environ.get("TIME_STORAGE", "datetime").lower()
+# -- admission control first: rate limited and shed requests never reach the database
+admission = AdmissionPlugin(limits=json.loads(os.environ.get("ADMISSION_LIMITS", "{}")),
+                            max_concurrent=int(os.environ.get("ADMISSION_MAX_CONCURRENT", 64)),
+                            max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", 256)),
+                            shed_depth=int(os.environ.get("ADMISSION_SHED_DEPTH", 64)),
+                            queue_timeout=float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 10)),
+                            trust_proxy=os.environ.get("ADMISSION_TRUST_PROXY", "0") == "1")
+if os.environ.get("ADMISSION", "off") != "off":
+    app.install(admission)
+# -- read-only routes use the read pool (query_only, one snapshot per request), everything else the write pool
+plugin = SQLitePoolPlugin(dbfile=dbfile,
+                          read_routes=["/get", "/subscribe", "/login", "/getUser", "/getUsers", "/getSensorData", "/getAllSensorData"],
+                          read_size=int(os.environ.get("DB_READ_POOL", 2 * (os.cpu_count() or 2))),
+                          write_size=int(os.environ.get("DB_WRITE_POOL", 2)),
+                          mmap_size=int(os.environ.get("DB_MMAP_SIZE", 256*1024*1024)),
+                          cache_size=int(os.environ.get("DB_CACHE_SIZE", 64*1024*1024)),
+                          wal=os.environ.get("DB_WAL", "0") == "1")
 app.install(plugin)
+app.install(CompressionPlugin(min_size=int(os.environ.get("COMPRESS_MIN_SIZE", 1024)),
+                              level=int(os.environ.get("COMPRESS_LEVEL", 6))))
 app.install(log_to_logger)
 app.install(ErrorsRestPlugin())
+result_cache.max_entries = int(os.environ.get("CACHE_MAX_ENTRIES", 1024))
+result_cache.max_bytes = int(os.environ.get("CACHE_MAX_BYTES", 64*1024*1024))
+single_flight.max_wait = float(os.environ.get("COALESCE_MAX_WAIT", 5))
+slow_query_log.threshold_ms = float(os.environ.get("SLOW_QUERY_MS", 100))
+slow_query_log.log_file = os.environ.get("SLOW_QUERY_LOG", "m2band_slow.log")
+slow_query_log.resize(int(os.environ.get("SLOW_QUERY_BUFFER", 100)))
+configureShards(dbfile, int(os.environ.get("SHARDS", 1)))
+
+# -- /add/users relies on the unique index on users.username to reject duplicate usernames
+db = connectDB(dbfile)
+if ["username"] not in uniqueColumns(db, "users"):
+    logger.warning(f"{dbfile}: users.username is not unique (checked before each insert), run: tests/Add_Unique_Username_Index.py {dbfile}")
+    print(f"[bold red]WARNING[/bold red]: users.username is not unique, run: tests/Add_Unique_Username_Index.py {dbfile}")
+db.close()
 
 # -- hook to strip trailing slash
 @hook('before_request')
 def strip_path():
     request.environ['PATH_INFO'] = request.environ['PATH_INFO'].rstrip('/')
 
+# -- hook to bump table generations once the request's transaction is committed (SQLitePoolPlugin commits the shards too)
+@hook('after_request')
+def commit_generations():
+    commitGenerations()
+
+# -- error responses are sent with status 200 like every other response: the flag rolls the request's writes back
+# -- (main connection and shards, see SQLitePoolPlugin) and tells /batch the call failed
+def failure(res):
+    request.environ["m2band.failed"] = True
+    return clean(res)
+
 # -- index - response: available commands
+usage_index = {
+    "message": "available commands",
+    "Core_Functions": {
+        "/add": usage_add, "/get": usage_get, "/edit": usage_edit, "/delete": usage_delete,
+        "/batch": usage_batch,
+    },
+    "Admin_Functions": {
+        "/createTable": usage_create_table, "/deleteTable": usage_delete_table,
+    },
+    "User_Functions": {
+        "/login": usage_login, "/logout": usage_logout,
+    },
+}
+
+# -- documentation responses are serialized once and served as bytes (with an ETag)
+for (name, usage) in {
+    "usage_index": usage_index, "usage_add": usage_add, "usage_get": usage_get, "usage_edit": usage_edit,
+    "usage_delete": usage_delete, "usage_create_table": usage_create_table, "usage_delete_table": usage_delete_table,
+    "usage_stats": usage_stats, "usage_subscribe": usage_subscribe, "usage_ingest": usage_ingest,
+    "usage_batch": usage_batch, "usage_jobs": usage_jobs,
+}.items():
+    addStaticResponse(name, usage)
+
 @route("/", method=["GET", "POST", "PUT", "DELETE"])
 def index():
-    res = {
-        "message": "available commands",
-        "Core_Functions": {
-            "/add": usage_add, "/get": usage_get, "/edit": usage_edit, "/delete": usage_delete,
-        },
-        "Admin_Functions": {
-            "/createTable": usage_create_table, "/deleteTable": usage_delete_table,
-        },
-        "User_Functions": {
-            "/login": usage_login, "/logout": usage_logout,
-        },
-    }
-    return clean(res)
+    return staticResponse("usage_index")
 
 ###############################################################################
 #                   Core Function /add - Add Data to a Table                  #
@@ -60,41 +127,92 @@ def index():
 @route("/add/<table_name>/<url_paths:path>", method=["GET", "POST", "PUT", "DELETE"])
 def add(db, table_name="", url_paths=""):
     if table_name == 'usage':
-        return usage_add
+        return staticResponse("usage_add")
 
     tables = getTables(db)
     table = getTable(db, tables, table_name)
     if not table:
-        return clean({"message": "active tables in the database", "tables": tables})
+        return tableListing(db)
+
+    # -- body (MessagePack, CBOR, packed struct, JSON): decoded straight into insert rows
+    # -- an empty body is a normal call with params ("Content-Type: application/json" is a common client default)
+    body = request.body.read() if request.content_type.split(";")[0] in body_types else b""
+    if body and (table_name != "users"):
+        try:
+            frame = parseBody(table, request.content_type, body)
+        except (ValueError, TypeError) as e:
+            return failure({"message": "invalid body", "content_type": request.content_type, "error": str(e)})
+        res = ingestFrame(db, table, frame)
+        res.pop("frame")
+        return clean(res) if "count" in res else failure(res)
 
     # -- parse "params" and "filters" from HTTP request
     required_columns = getColumns(db, table, required=True)
-    params, filters = parseUrlPaths(url_paths, request.params, required_columns)
+    params, filters = parseUrlPaths(url_paths, request.params, table["columns"])
+
+    # -- upsert: the natural key (unique columns) to update OR keep the existing row by, e.g. "?upsert=user_id,entry_time"
+    upsert = params.pop("upsert", "") or request.params.get("upsert", "")
+    on_conflict = (params.pop("on_conflict", "") or request.params.get("on_conflict", "update")).lower()
+    conflict = [c.strip() for c in upsert.split(",") if c.strip()]
+    if conflict:
+        unknown = [c for c in conflict if c not in table["columns"]]
+        # -- a row can only be matched (and updated) within its own user's rows
+        no_user = ("user_id" in table["columns"]) and ("user_id" not in conflict)
+        if unknown or no_user or (on_conflict not in ("update", "nothing")) or (table_name == "users"):
+            res = {"message": "invalid upsert", "upsert": conflict, "unknown": unknown, "on_conflict": on_conflict,
+                   "required": ["user_id"] if no_user else [], "columns": list(table["columns"]),
+                   "options": {"on_conflict": ["update", "nothing"]}}
+            return failure(res)
+        # -- the conflict target must be an existing unique index (created offline: tests/Add_Upsert_Index.py)
+        unique_keys = uniqueKeys(db, table_name)
+        if set(conflict) not in unique_keys:
+            res = {"message": "invalid upsert: no unique index on the upsert columns", "upsert": conflict,
+                   "unique_keys": [sorted(key) for key in unique_keys]}
+            return failure(res)
 
     # -- check for required parameters
     missing_keys = (params.keys() ^ required_columns.keys())
     missing_params = {k: table["columns"][k] for k in required_columns if k in missing_keys}
+    missing_params.update({k: table["columns"][k] for k in conflict if not params.get(k)})
     if missing_params:
         res = {"message": "missing paramaters", "required": [required_columns],
                "missing": [missing_params], "submitted": [params]}
-        return clean(res)
+        return failure(res)
 
-    # -- the users table requires additional formatting and checking
+    # -- the users table requires additional formatting (uniqueness is checked by the insert, see below)
     if table_name == "users":
-        params.update({"password": securePassword(params["password"])})
-        if fetchRow(db, table=table, where="username=?", values=params["username"]):
+        # -- no unique index on users.username yet (see the warning at startup): check before the insert instead
+        if ({"username"} not in uniqueKeys(db, "users")) and \
+                fetchRow(db, table="users", where="username=?", values=params["username"]):
             res = {"message": "user exists", "username": params["username"]}
-            return clean(res)
+            return failure(res)
+        params.update({"password": securePassword(params["password"])})
 
     # -- define "columns" to edit and "values" to insert
-    edit_items = {k: params[k] for k in required_columns if params.get(k)}
+    edit_items = {k: params[k] for k in [*required_columns, *conflict] if params.get(k)}
     columns, col_values = list(edit_items.keys()), list(edit_items.values())
 
+    # -- query database -- INSERT INTO oximeter (...) VALUES (?, ...) ON CONFLICT (user_id,entry_time) DO UPDATE SET ...;
+    if conflict:
+        res = upsertRow(db, table=table, columns=columns, col_values=col_values, conflict=conflict, on_conflict=on_conflict)
+        if isinstance(res, dict):
+            return failure(res)
+        col_id, action = res
+        messages = {"inserted": "data added to", "updated": "data updated in", "ignored": "data already exists in"}
+        res = {"message": f"{messages[action]} <{table_name}>", getColumns(db, table, ref=True): col_id,
+               "upsert": {"conflict": conflict, "on_conflict": on_conflict, "action": action}}
+        for r in re.findall(r"(.*_id)", " ".join(required_columns)):
+            res[r] = params.get(r)
+        return clean(res)
+
     # -- query database -- INSERT INTO oximeter (user_id,heart_rate,...) VALUES (?, ?, ...);
     col_id = insertRow(db, table=table, columns=columns, col_values=col_values)
     if isinstance(col_id, dict):
-        if col_id.get('Error'):
-            return clean(col_id)
+        # -- unique index on users.username: the insert itself is the "user exists" check (no race between check and insert)
+        if (table_name == "users") and ("users.username" in col_id.get("SQLite.IntegrityError", "")):
+            res = {"message": "user exists", "username": params["username"]}
+            return failure(res)
+        return failure(col_id)
 
     # -- send response message
     col_ref = getColumns(db, table, ref=True)  # -- get (.*_id) name for table
@@ -112,15 +230,25 @@ def add(db, table_name="", url_paths=""):
 def get(db, table_name="", url_paths=""):
     print(f"request.params = {dict(request.params)}")
     if table_name == 'usage':
-        return usage_get
+        return staticResponse("usage_get")
+
+    # -- the generation before the snapshot starts (first SELECT): a write committed after this point
+    # -- bumps the generation again, so rows read from an older snapshot are never cached as current
+    generation = getGeneration(table_name)
+
+    # -- unchanged table and same query: 304 without running the query
+    etag = getETag(table_name, {**parseURI(url_paths), **request.params})
+    if checkETag(etag):
+        raise notModified(etag)
 
     tables = getTables(db)
     table = getTable(db, tables, table_name)
     if not table:
-        return clean({"message": "active tables in the database", "tables": tables})
+        return tableListing(db)
 
     # -- parse "params" and "filters" from HTTP request
     params, filters = parseUrlPaths(url_paths, request.params, table["columns"])
+    response.set_header("ETag", etag)
 
     # -- build "conditions" string and "values" array for "fetchRows()"
     conditions = " AND ".join([f"{param}=?" for param in params.keys()])
@@ -128,22 +256,148 @@ def get(db, table_name="", url_paths=""):
     if filters:
         conditions, values = parseFilters(filters, conditions, values)
 
-    # -- query database -- SELECT * FROM users WHERE (user_id=?);
-    rows = fetchRows(db, table=table, where=conditions, values=values)
-    if isinstance(rows, dict):
-        if rows.get('Error'):
-            return clean(rows)
-        message = f"1 {table_name.rstrip('s')} entry found"
-    elif isinstance(rows, list):
-        message = f"found {len(rows)} {table_name.rstrip('s')} entries"
+    # -- cached response (pre-serialized) for the same (table, conditions, values)
+    key = (table_name, conditions, tuple(values))
+    response.content_type = "application/json"
+    in_batch = request.environ.get("m2band.batch")
+    body = None if in_batch else result_cache.get(key)
+    if body:
+        return body
+
+    def query():
+        # -- query database -- SELECT * FROM users WHERE (user_id=?);
+        rows = fetchRows(db, table=table, where=conditions, values=values)
+        if isinstance(rows, dict):
+            if any(k.startswith("SQLite.") for k in rows):
+                return failure(rows)
+            message = f"1 {table_name.rstrip('s')} entry found"
+        elif isinstance(rows, list):
+            message = f"found {len(rows)} {table_name.rstrip('s')} entries"
+        else:
+            message = f"0 {table_name.rstrip('s')} entries found using submitted parameters"
+            rows = {"submitted": [params] + [{"filter": filters}]}
+
+        # -- send response message
+        res = {"message": message, "data": rows}
+        body = json_dumps(clean(res)).encode()
+        if not in_batch:
+            result_cache.put(key, generation, body)
+        return body
+
+    # -- identical requests in flight (same key and generation) wait for one query and share its response
+    return query() if in_batch else single_flight.do(key, generation, query)
+
+###############################################################################
+#           /subscribe - Stream New Rows From a Table (SSE / long-poll)       #
+###############################################################################
+# -- no snapshot: the long-poll must see the rows committed while it waits
+@route("/subscribe", method=["GET", "POST"], sqlite={"snapshot": False})
+@route("/subscribe/<table_name>", method=["GET", "POST"], sqlite={"snapshot": False})
+@route("/subscribe/<table_name>/<url_paths:path>", method=["GET", "POST"], sqlite={"snapshot": False})
+def subscribe(db, table_name="", url_paths=""):
+    if table_name == 'usage':
+        return staticResponse("usage_subscribe")
+
+    tables = getTables(db)
+    table = getTable(db, tables, table_name)
+    if not table:
+        return tableListing(db)
+
+    # -- the cursor is the table's "<name>_id" column: a table without one can't be followed
+    if not re.search(r"(.*_id)", " ".join(getColumns(db, table, non_editable=True))):
+        res = {"message": f"invalid table: <{table_name}> has no '_id' column to follow", "columns": table["columns"]}
+        return failure(res)
+
+    # -- parse "params" and "filters" from HTTP request (same syntax as /get)
+    params, filters = parseUrlPaths(url_paths, request.params, table["columns"])
+    options = {k: params.pop(k, request.params.get(k)) for k in ["since", "timeout", "stream"]}
+    try:
+        timeout = min(float(options["timeout"] or 25), 60)
+        if not timeout >= 0:
+            raise ValueError(options["timeout"])
+    except ValueError:
+        return clean({"message": "invalid timeout: seconds (0 - 60)", "timeout": options["timeout"]})
+
+    # -- build "conditions" string and "values" array for "fetchNewRows()"
+    conditions = " AND ".join([f"{param}=?" for param in params.keys()])
+    values = list(params.values())
+    if filters:
+        conditions, values = parseFilters(filters, conditions, values)
+
+    # -- served by asgi.py: the event loop waits for new rows instead of this thread ("wait" and "stream" are handed back)
+    async_state = request.environ.get("m2band.async")
+    resume = async_state.get("resume", {}) if async_state is not None else {}
+
+    # -- cursor: "since" (or Last-Event-ID), defaults to the newest row (only new rows are sent)
+    since = resume.get("since", options["since"] or request.headers.get("Last-Event-ID"))
+    if since:
+        try:
+            cursor = int(since)
+        except ValueError:
+            return clean({"message": "invalid since: the last entry ID received (int)", "since": since})
     else:
-        message = f"0 {table_name.rstrip('s')} entries found using submitted parameters"
-        rows = {"submitted": [params] + [{"filter": filters}]}
+        cursor = lastRowId(db, table)
+
+    # -- server-sent events: keep the connection open and push new rows
+    if (options["stream"] == "sse") or ("text/event-stream" in request.headers.get("Accept", "")):
+        response.content_type = "text/event-stream"
+        response.set_header("Cache-Control", "no-cache")
+        if async_state is not None:
+            async_state["stream"] = {"table": table, "conditions": conditions, "values": values,
+                                     "cursor": cursor, "timeout": timeout}
+            return None
+        return streamRows(dbfile, table, conditions, values, cursor, timeout=timeout)
+
+    # -- long-poll: return as soon as new rows are committed (or after "timeout" seconds)
+    deadline = resume.get("deadline", time.time() + timeout)
+    rows, cursor = fetchNewRows(db, table, conditions, values, cursor)
+    if (not rows) and (async_state is not None) and (time.time() < deadline):
+        async_state["wait"] = {"table": table_name, "since": cursor, "deadline": deadline}
+        return None
+    while (not rows) and waitForRows(table_name, cursor, deadline - time.time()):
+        rows, cursor = fetchNewRows(db, table, conditions, values, cursor)
+    if isinstance(rows, dict):
+        return clean(rows)
 
     # -- send response message
-    res = {"message": message, "data": rows}
+    res = {"message": f"found {len(rows)} new {table_name.rstrip('s')} entries", "since": cursor, "data": rows}
     return clean(res)
 
+###############################################################################
+#         /ingest - Persistent WebSocket Ingest Channel for Sample Streams    #
+###############################################################################
+@route("/ingest")
+@route("/ingest/<table_name>")
+def ingest(table_name=""):
+    if table_name == 'usage':
+        return staticResponse("usage_ingest")
+
+    wsock = request.environ.get("wsgi.websocket")
+    db = connectDB(dbfile)
+    try:
+        tables = getTables(db)
+        table = getTable(db, tables, table_name)
+        if (not wsock) or (not table) or (table_name == "users"):
+            res = {"message": "expected a websocket request for a table", "usage": "/ingest/usage",
+                   "tables": [t["name"] for t in tables if t["name"] != "users"]}
+            return clean(res)
+
+        # -- one frame in, one ack out: {"frame": 7, "rows": [...]} -> {"frame": 7, "count": 25, ...}
+        while True:
+            message = wsock.receive()
+            if message is None:
+                break
+            try:
+                frame = parseBody(table, "application/msgpack", message) if isinstance(message, bytes) else json.loads(message)
+            except (ValueError, TypeError) as e:
+                ack = {"frame": None, "message": "invalid frame", "error": str(e)}
+            else:
+                ack = ingestFrame(db, table, frame)
+            wsock.send(json.dumps(ack, default=str))
+    finally:
+        db.close()
+    return clean({"message": f"ingest to <{table_name}> closed"})
+
 ###############################################################################
 #                  Core Function /edit - Edit Data in a Table                 #
 ###############################################################################
@@ -153,17 +407,22 @@ def get(db, table_name="", url_paths=""):
 def edit(db, table_name="", url_paths=""):
     print(f"request.params = {dict(request.params)}")
     if table_name == 'usage':
-        return usage_edit
+        return staticResponse("usage_edit")
 
     tables = getTables(db)
     table = getTable(db, tables, table_name)
     if not table:
-        return clean({"message": "active tables in the database", "tables": tables})
+        return tableListing(db)
 
     # -- parse "params" and "filters" from HTTP request
     editable_columns = getColumns(db, table, editable=True)
     non_edit_columns = getColumns(db, table, non_editable=True)
+    # -- bulk edit: a JSON body (an empty body is a normal call with params)
+    body = request.body.read() if request.content_type.split(";")[0] == "application/json" else b""
+    if body.strip():
+        return bulkEdit(db, table, editable_columns, body)
     params, filters = parseUrlPaths(url_paths, request.params, table["columns"])
+    chunk = params.pop("chunk", "") or request.params.get("chunk", "")
     print(f"params = {params}\nfilters = '{filters}'")
 
     # -- the users table requires additional formatting and checking
@@ -175,7 +434,7 @@ def edit(db, table_name="", url_paths=""):
         submitted = {**{"filter": filters}, **params} if filters else params
         res = {"message": "missing a parameter to edit", "editable": [editable_columns],
                "submitted": [submitted]}
-        return clean(res)
+        return failure(res)
 
     # -- at least 1 query parameter required
     # TODO: add try except for (submitted)
@@ -183,7 +442,7 @@ def edit(db, table_name="", url_paths=""):
     query_params = {**non_edit_columns, **{"filter": filters}}
     if not (submitted.keys() & query_params.keys()):
         res = {"message": "missing a query parameter", "query_params": [query_params], "submitted": [submitted]}
-        return clean(res)
+        return failure(res)
 
     # -- define "columns" to edit and "values" to insert (parsed from params in HTTP request)
     edit_items = {k: params[k] for k in editable_columns if params.get(k)}
@@ -195,6 +454,10 @@ def edit(db, table_name="", url_paths=""):
     if filters:
         conditions, values = parseFilters(filters, conditions, values)
 
+    # -- large ranges: rowid-ranged chunks in short transactions from a background job (see /jobs)
+    if chunk:
+        return startJob("edit", table, conditions, values, chunk, submitted, columns=columns, col_values=col_values)
+
     # -- query database -- UPDATE users SET username=? WHERE (user_id=?);
     args = {
         "table": table, "columns": columns, "col_values": col_values,
@@ -202,8 +465,7 @@ def edit(db, table_name="", url_paths=""):
     }
     num_edits = updateRow(db, **args)
     if isinstance(num_edits, dict):
-        if num_edits.get('Error'):
-            return clean(num_edits)
+        return failure(num_edits)
     elif num_edits:
         if num_edits == 1:
             message = f"edited 1 {table_name.rstrip('s')} entry"
@@ -216,6 +478,47 @@ def edit(db, table_name="", url_paths=""):
     res = {"message": message, "submitted": [submitted]}
     return clean(res)
 
+def bulkEdit(db, table, editable_columns, body):
+    # -- JSON body: [{"key": {"entry_id": 52}, "changes": {"temperature": 98.2}}, ...] (a different edit for every row)
+    table_name = table["name"]
+    try:
+        updates = json.loads(body)
+    except ValueError as e:
+        return failure({"message": "invalid body", "error": str(e)})
+    updates = updates.get("updates") if isinstance(updates, dict) else updates
+
+    # -- every update needs a key (any columns, e.g. '{ref}_id') and at least 1 change (editable params, not in the key),
+    # -- with single values (no lists or objects)
+    invalid = []
+    for (i, update) in enumerate(updates if isinstance(updates, list) else []):
+        key, changes = (update.get("key"), update.get("changes")) if isinstance(update, dict) else (None, None)
+        if not (isinstance(key, dict) and key and (key.keys() <= table["columns"].keys())
+                and isinstance(changes, dict) and changes and (changes.keys() <= editable_columns.keys())
+                and not (key.keys() & changes.keys())
+                and not any(isinstance(v, (dict, list)) for v in [*key.values(), *changes.values()])):
+            invalid.append({"row": i, "submitted": update})
+    if (not isinstance(updates, list)) or (not updates) or invalid:
+        res = {"message": "invalid bulk edit", "expected": [{"key": {"<column>": "value"}, "changes": {"<edit_param>": "value"}}],
+               "columns": [table["columns"]], "editable": [editable_columns], "invalid": invalid[:10]}
+        return failure(res)
+
+    # -- the users table requires additional formatting
+    if table_name == "users":
+        for update in updates:
+            if update["changes"].get("password"):
+                update["changes"]["password"] = securePassword(update["changes"]["password"])
+
+    # -- query database -- UPDATE oximeter SET temperature=? WHERE (entry_id=?); (in order, one statement per set of columns)
+    counts = updateRows(db, table=table, updates=updates)
+    if isinstance(counts, dict):
+        return failure(counts)
+
+    # -- send response message
+    num_edits = sum(counts)
+    res = {"message": f"edited {num_edits} {table_name.rstrip('s')} {'entry' if num_edits == 1 else 'entries'}",
+           "rows": len(updates), "counts": counts, "not_found": [i for (i, count) in enumerate(counts) if not count]}
+    return clean(res)
+
 ###############################################################################
 #             Core Function /delete - Delete Data from a Table                #
 ###############################################################################
@@ -225,15 +528,16 @@ def edit(db, table_name="", url_paths=""):
 def delete(db, table_name="", url_paths=""):
     print(f"request.params = {dict(request.params)}")
     if table_name == 'usage':
-        return usage_delete
+        return staticResponse("usage_delete")
 
     tables = getTables(db)
     table = getTable(db, tables, table_name)
     if not table:
-        return clean({"message": "active tables in the database", "tables": tables})
+        return tableListing(db)
 
     # -- parse "params" and "filters" from HTTP request
     params, filters = parseUrlPaths(url_paths, request.params, table["columns"])
+    chunk = params.pop("chunk", "") or request.params.get("chunk", "")
     print(f"params = {params}\nfilters = '{filters}'")
 
     # -- to prevent accidental deletion of everything, at least 1 parameter is required
@@ -241,7 +545,7 @@ def delete(db, table_name="", url_paths=""):
     query_params = {**table["columns"], **{"filter": filters}}
     if not (submitted.keys() & query_params.keys()):
         res = {"message": "missing a query param(s)", "query_params": [query_params], "submitted": [submitted]}
-        return clean(res)
+        return failure(res)
 
     # -- build "conditions" string and "values" string/array for "updateRow()"
     conditions = " AND ".join([f"{param}=?" for param in table["columns"] if params.get(param)])
@@ -249,11 +553,14 @@ def delete(db, table_name="", url_paths=""):
     if filters:
         conditions, values = parseFilters(filters, conditions, values)
 
+    # -- large ranges: rowid-ranged chunks in short transactions from a background job (see /jobs)
+    if chunk:
+        return startJob("delete", table, conditions, values, chunk, submitted)
+
     # -- query database -- DELETE FROM users WHERE (user_id=?);
     num_deletes = deleteRow(db, table=table, where=conditions, values=values)
     if isinstance(num_deletes, dict):
-        if num_deletes.get('Error'):
-            return clean(num_deletes)
+        return failure(num_deletes)
     elif num_deletes:
         if num_deletes == 1:
             message = f"1 {table_name.rstrip('s')} entry deleted"
@@ -266,6 +573,132 @@ def delete(db, table_name="", url_paths=""):
     res = {"message": message, "submitted": [submitted]}
     return clean(res)
 
+###############################################################################
+#          /batch - Ordered add/get/edit/delete Calls in One Transaction      #
+###############################################################################
+batch_handlers = {}         # -- op: handler (filled in below, the handlers are defined above)
+batch_max_ops = int(os.environ.get("BATCH_MAX_OPS", 1000))
+def runBatchOp(db, op):
+    # -- one operation: the handler runs with the operation's params as request.params -- (result, failed)
+    handler = batch_handlers.get(op.get("op"))
+    if (not handler) or (not op.get("table")) or (not getTable(db, table_name=op["table"])):
+        return {"message": "invalid operation", "ops": list(batch_handlers), "submitted": op}, True
+    params = op.get("params") or {}
+    if (not isinstance(params, dict)) or ("chunk" in params):
+        return {"message": "invalid operation: 'params' must be an object (without 'chunk')", "submitted": op}, True
+    # -- values as they arrive in a query string: "user_id=8&temperature=98.1"
+    params = {k: v if isinstance(v, str) else json.dumps(v) for (k, v) in params.items()}
+    request.environ.update({"bottle.request.params": FormsDict(params), "CONTENT_TYPE": "", "m2band.failed": False})
+    try:
+        res = handler(db, op["table"])
+    except HTTPResponse as e:
+        return {"message": f"invalid operation: HTTP {e.status_code}", "error": str(e.body)}, True
+    res = json.loads(res) if isinstance(res, (bytes, str)) else res
+    return res, request.environ["m2band.failed"]
+
+@route("/batch", method=["POST", "PUT"])
+@route("/batch/<mode>", method=["GET", "POST", "PUT"])
+def batch(db, mode=""):
+    if mode == 'usage':
+        return staticResponse("usage_batch")
+    mode = mode or request.query.get("mode", "atomic")
+    try:
+        body = json.loads(request.body.read() or b"null")
+    except ValueError as e:
+        return clean({"message": "invalid body", "error": str(e)})
+    ops = body.get("operations") if isinstance(body, dict) else body
+    if (mode not in ("atomic", "savepoint")) or (not isinstance(ops, list)) or (not ops) or (len(ops) > batch_max_ops):
+        res = {"message": "expected a JSON list of operations", "usage": "/batch/usage", "mode": mode,
+               "modes": ["atomic", "savepoint"], "max_operations": batch_max_ops}
+        return clean(res)
+
+    # -- savepoints are on the main connection only: a failed operation can't be rolled back alone in the shards
+    sharded = [op.get("table") for op in ops if isinstance(op, dict) and isinstance(op.get("table"), str)
+               and shardRoute(db, "", {"table": op.get("table")})]
+    if (mode == "savepoint") and sharded:
+        res = {"message": "invalid mode: 'savepoint' can't be used with sharded tables, use 'atomic'",
+               "sharded": sorted(set(sharded))}
+        return clean(res)
+
+    # -- atomic: the first failed operation rolls back the batch, savepoint: only the failed operation is rolled back
+    # -- BEGIN IMMEDIATE; SAVEPOINT batch; SAVEPOINT op; INSERT ...; RELEASE op; SAVEPOINT op; UPDATE ...; ... RELEASE batch; COMMIT;
+    request_params, content_type = request.environ.get("bottle.request.params"), request.environ.get("CONTENT_TYPE", "")
+    request.environ["m2band.batch"] = True  # -- /get: no result cache and no coalescing (the rows aren't committed yet)
+    results, failed = [], 0
+    # -- take the write lock up front: a deferred transaction that reads first can't be upgraded once
+    # -- another connection has committed (SQLITE_BUSY_SNAPSHOT, not retried by the busy timeout)
+    if not db.in_transaction:
+        db.execute("BEGIN IMMEDIATE;")
+    db.execute("SAVEPOINT batch;")
+    batch_rowids = pendingRowIds()
+    try:
+        for (i, op) in enumerate(ops):
+            db.execute("SAVEPOINT op;")
+            rowids = pendingRowIds()
+            res, op_failed = runBatchOp(db, op if isinstance(op, dict) else {"submitted": op})
+            status = "failed" if op_failed else "ok"
+            db.execute("ROLLBACK TO op;" if status == "failed" else "RELEASE op;")
+            if status == "failed":
+                discardRowIds(rowids)
+            results.append({"op": i, "status": status, "result": res})
+            if status == "failed":
+                failed += 1
+                if mode == "atomic":
+                    db.execute("ROLLBACK TO batch;")
+                    commitShards(rollback=True)
+                    discardRowIds(batch_rowids)
+                    for r in results[:-1]:
+                        r["status"] = "rolled back"
+                    results += [{"op": k, "status": "skipped"} for k in range(i + 1, len(ops))]
+                    break
+        db.execute("RELEASE batch;")
+    finally:
+        request.environ.pop("bottle.request.params", None)
+        request.environ.pop("m2band.batch")
+        request.environ.pop("m2band.failed", None)  # -- the failed operations are already rolled back (savepoints)
+        request.environ["CONTENT_TYPE"] = content_type
+        if request_params is not None:
+            request.environ["bottle.request.params"] = request_params
+        response.headers.pop("ETag", None)
+
+    # -- send response message
+    applied = sum(r["status"] == "ok" for r in results)
+    res = {"message": f"batch: {applied} of {len(ops)} operations applied", "mode": mode,
+           "failed": failed, "results": results}
+    return clean(res)
+
+batch_handlers.update({"add": add, "get": get, "edit": edit, "delete": delete})
+
+###############################################################################
+#       /jobs - Chunked /delete and /edit Jobs: Progress and Cancellation     #
+###############################################################################
+chunk_pause = float(os.environ.get("CHUNK_PAUSE", 0.05))
+
+def startJob(op, table, conditions, values, chunk, submitted, columns=None, col_values=None):
+    # -- /delete and /edit with "chunk=<rowids per transaction>"
+    if not str(chunk).isdigit() or int(chunk) < 1:
+        return clean({"message": "invalid chunk: rowids per transaction (int > 0)", "chunk": chunk})
+    job = startWriteJob(dbfile, op, table, where=conditions, values=values, columns=columns, col_values=col_values,
+                        chunk_size=int(chunk), pause=chunk_pause)
+    res = {"message": f"{op} job started", "job": job.id, "progress": f"/jobs/{job.id}",
+           "cancel": f"/jobs/{job.id}/cancel", "submitted": [submitted]}
+    return clean(res)
+
+@route("/jobs")
+@route("/jobs/<job_id>")
+@route("/jobs/<job_id>/<action>", method=["GET", "POST", "PUT", "DELETE"])
+def jobs(job_id="", action=""):
+    if job_id == 'usage':
+        return staticResponse("usage_jobs")
+    job = write_jobs.get(job_id)
+    if not job:
+        res = {"message": "write jobs", "jobs": [j.info() for j in list(write_jobs.values())]}
+        return clean(res)
+    if action == "cancel":
+        job.cancel()
+        return clean({"message": f"job {job_id} cancelled (after the current chunk)", **job.info()})
+    return clean({"message": f"job {job_id}: {job.state['status']}", **job.info()})
+
 ###############################################################################
 #                      User's Table: Additional Functions                     #
 ###############################################################################
@@ -315,19 +748,19 @@ def logout(db):
 def createTable(db, table_name="", url_paths=""):
     required_columns = {"user_id": "INTEGER", "{ref}_id": "INTEGER", "{ref}_time": "DATETIME",
                         "column_name": "column_type",
-                        "available_types": ["INTEGER", "DOUBLE", "TEXT", "DATETIME"]}
+                        "available_types": ["INTEGER", "DOUBLE", "TEXT", "DATETIME", "EPOCH"]}
     if table_name == 'usage':
-        return usage_create_table
+        return staticResponse("usage_create_table")
     if (not table_name):
-        return clean({"message": "active tables in the database", "tables": getTables(db)})
+        return tableListing(db)
     if ((not url_paths) and (not request.params)):
         res = {"message": "missing paramaters", "required": [required_columns],
-               "available_types": ["INTEGER", "DOUBLE", "TEXT", "DATETIME"],
+               "available_types": ["INTEGER", "DOUBLE", "TEXT", "DATETIME", "EPOCH"],
                "Exception": "\"{ref}_id\" not required when creating \"users\" table", "submitted": []}
         return clean(res)
 
     # -- parse "params" and "url_paths" from HTTP request
-    params, columns = mapUrlPaths(url_paths, request.params, table_name)
+    params, columns = mapUrlPaths(url_paths, request.params, table_name, epoch=(time_storage == "epoch"))
 
     # if not checkCreateTable(params, columns):
     #     res = {"message": "missing paramaters", "required": [required_columns],
@@ -343,19 +776,35 @@ def createTable(db, table_name="", url_paths=""):
 @route("/deleteTable/<table_name>")
 def dropTable(db, table_name=""):
     if table_name == 'usage':
-        return usage_delete_table
+        return staticResponse("usage_delete_table")
 
     tables = getTables(db)
     table = getTable(db, tables, table_name)
     if not table:
-        return clean({"message": "active tables in the database", "tables": tables})
+        return tableListing(db)
 
     # -- DROP TABLE <table>
     res = deleteTable(db, table=table_name)
     res.update({"table": table_name})
     return clean(res)
 
-
+@route("/stats")
+@route("/stats/<stat_name>")
+def stats(stat_name=""):
+    if stat_name == 'usage':
+        return staticResponse("usage_stats")
+
+    server_stats = {
+        "cache": result_cache.info(),
+        "coalescing": single_flight.info(),
+        "slowQueries": slow_query_log.info(),
+        "legacy": legacy_usage,
+        "pools": plugin.info(),
+        "admission": admission.info(),
+    }
+    if stat_name not in server_stats:
+        return clean({"message": "server stats", **server_stats})
+    return clean({"message": f"server stats: {stat_name}", stat_name: server_stats[stat_name]})
 
 ###############################################################################
 #                    Old Routes For Backwards Compatability                   #
@@ -365,53 +814,76 @@ These routes are here to keep existing apps working.
 Eventually, they should be deleted.
 Apps should migrate to the new Framework Format as these routes are currently using.
 """
+# -- legacy path: {"count": requests served, "last_used": time} (see /stats/legacy)
+legacy_usage = {path: {"count": 0, "last_used": ""} for path in [
+    "/addUser", "/createUser", "/getUser", "/getUsers", "/editUser", "/deleteUser",
+    "/addSensorData", "/getSensorData", "/getAllSensorData", "/editSensorData", "/deleteSensorData",
+]}
+legacy_lock = threading.Lock()
+
+def legacyDispatch(handler, db, table_name):
+    """serve a legacy path with the new handler in the same request (was a 302 redirect)"""
+    print(f"request.url = {request.url}")
+    with legacy_lock:
+        usage = legacy_usage.setdefault(request.path, {"count": 0, "last_used": ""})
+        usage["count"] += 1
+        usage["last_used"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    return handler(db, table_name)
+
 # users table #################################################################
 @route("/addUser", method=["GET", "POST", "PUT", "DELETE"])
 @route("/createUser", method=["GET", "POST", "PUT", "DELETE"])
 def addUser(db):
-    print(f"request.url = {request.url}")
-    return redirect(f'https://m2band.hopto.org/add/users?{urlencode(request.params)}')
+    return legacyDispatch(add, db, "users")
 
 @route("/getUser", method=["GET", "POST", "PUT", "DELETE"])
 @route("/getUsers", method=["GET", "POST", "PUT", "DELETE"])
 def getUserOld(db):
-    print(f"request.url = {request.url}")
-    return redirect(f'https://m2band.hopto.org/get/users?{urlencode(request.params)}')
+    return legacyDispatch(get, db, "users")
 
 @route("/editUser", method=["GET", "POST", "PUT", "DELETE"])
 def editUser(db):
-    print(f"request.url = {request.url}")
-    return redirect(f'https://m2band.hopto.org/edit/users?{urlencode(request.params)}')
+    return legacyDispatch(edit, db, "users")
 
 @route('/deleteUser', method=["GET", "POST", "PUT", "DELETE"])
 def deleteUser(db):
-    print(f"request.url = {request.url}")
-    return redirect(f'https://m2band.hopto.org/delete/users?{urlencode(request.params)}')
+    return legacyDispatch(delete, db, "users")
 
 # oximeter table ##############################################################
 @route("/addSensorData", method=["GET", "POST", "PUT", "DELETE"])
 def addSensorData(db):
-    print(f"request.url = {request.url}")
-    return redirect(f'https://m2band.hopto.org/add/oximeter?{urlencode(request.params)}')
+    return legacyDispatch(add, db, "oximeter")
 
 @route("/getSensorData", method=["GET", "POST", "PUT", "DELETE"])
 @route("/getAllSensorData", method=["GET", "POST", "PUT", "DELETE"])
 def getSensorOld(db):
-    print(f"request.url = {request.url}")
-    return redirect(f'https://m2band.hopto.org/get/oximeter?{urlencode(request.params)}')
+    return legacyDispatch(get, db, "oximeter")
 
 @route("/editSensorData", method=["GET", "POST", "PUT", "DELETE"])
 def editSensorData(db):
-    print(f"request.url = {request.url}")
-    return redirect(f'https://m2band.hopto.org/edit/oximeter?{urlencode(request.params)}')
+    return legacyDispatch(edit, db, "oximeter")
 
 @route("/deleteSensorData", method=["GET", "POST", "PUT", "DELETE"])
 def deleteSensorData(db):
-    print(f"request.url = {request.url}")
-    return redirect(f'https://m2band.hopto.org/delete/oximeter?{urlencode(request.params)}')
-
-
-# -- Run Web Server
-port = int(os.environ.get("PORT", 8080))
-# run(host="0.0.0.0", port=port, reloader=True)
-run(app, host="0.0.0.0", port=port, reloader=True)
+    return legacyDispatch(delete, db, "oximeter")
+
+if __name__ == "__main__":
+    # -- importing server.py (tests/benchmark_routes.py) only builds "app"
+    # -- Retention Policies: RETENTION_POLICIES='{"oximeter": {"max_age": "90 days", "max_rows": 100000}}'
+    retention_policies = json.loads(os.environ.get("RETENTION_POLICIES", "{}"))
+    if retention_policies and os.environ.get("BOTTLE_CHILD"):
+        # -- only the reloader's child process serves requests (and purges tables)
+        startRetention(dbfile, retention_policies,
+                       interval=int(os.environ.get("RETENTION_INTERVAL", 3600)),
+                       chunk_size=int(os.environ.get("RETENTION_CHUNK_SIZE", 500)))
+
+    # -- Run Web Server
+    port = int(os.environ.get("PORT", 8080))
+    server = os.environ.get("SERVER", "wsgiref")  # -- /subscribe streams need a threaded server: paste, cheroot, waitress
+    options = {}
+    if server == "gevent":
+        # -- /ingest websockets: pip3 install gevent-websocket
+        from geventwebsocket.handler import WebSocketHandler
+        options["handler_class"] = WebSocketHandler
+    # run(host="0.0.0.0", port=port, reloader=True)
+    run(app, server=server, host="0.0.0.0", port=port, reloader=True, **options)
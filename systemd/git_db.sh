@@ -1,3 +1,4 @@
 #!/bin/bash
+# -- commits m2band.db on every write: only with the default rollback journal (DB_WAL=0), in WAL mode recent writes are in m2band.db-wal
 
 inotifywait -q -m -e CLOSE_WRITE --format="git commit -m 'auto commit db' %w && git push origin main" ../m2band.db | bash
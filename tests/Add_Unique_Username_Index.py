@@ -0,0 +1,26 @@
+# coding: utf-8
+"""
+usage: Add_Unique_Username_Index.py [dbfile]
+
+Enforce unique usernames with a unique index on users.username.
+/add/users relies on the index: a duplicate username fails the insert ("user exists"),
+and /login finds the username with an index seek instead of a full scan of users.
+Duplicate usernames must be resolved (renamed or deleted) before the index can be created.
+"""
+from pathlib import Path
+import sys
+
+sys.path.append(str(Path(".").absolute().parent))
+from rich import print
+from db_functions import *
+import sqlite3
+
+
+if __name__ == "__main__":
+    db = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else "../m2band.db")
+    db.text_factory = str
+    db.row_factory = sqlite3.Row
+
+    print("CREATE INDEX:")
+    print(addUniqueIndex(db, "users", ["username"]))
+    print(db.execute("EXPLAIN QUERY PLAN SELECT * FROM users WHERE username=?;", ["user_01"]).fetchall()[0]["detail"])
@@ -0,0 +1,43 @@
+# coding: utf-8
+"""
+usage: Add_Upsert_Index.py dbfile table_name col_1,col_2,...
+
+Create the unique index a natural key needs before "/add/<table_name>?...&upsert=col_1,col_2" can be used.
+/add never creates indexes: the key is checked against the existing unique indexes of the table.
+On tables with a "user_id" column the key must include "user_id".
+Duplicate values must be resolved (deleted) before the index can be created.
+
+example usage:
+    python3 Add_Upsert_Index.py ../m2band.db oximeter user_id,entry_time
+"""
+from pathlib import Path
+import sys
+
+sys.path.append(str(Path(".").absolute().parent))
+from rich import print
+from db_functions import *
+import sqlite3
+import os
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        sys.exit(__doc__)
+    dbfile, table_name = sys.argv[1], sys.argv[2]
+    columns = [c.strip() for c in sys.argv[3].split(",") if c.strip()]
+
+    db = connectDB(dbfile)
+    table = getTable(db, table_name=table_name)
+    if not table:
+        sys.exit(f"<{table_name}>: no such table")
+    unknown = [c for c in columns if c not in table["columns"]]
+    if unknown:
+        sys.exit(f"<{table_name}>: unknown columns {unknown}")
+    if ("user_id" in table["columns"]) and ("user_id" not in columns):
+        sys.exit(f"<{table_name}>: the key must include user_id")
+
+    # -- on a sharded database the index is copied to the shards with the schema (and checked for duplicates there)
+    configureShards(dbfile, int(os.environ.get("SHARDS", 1)))
+    print("CREATE INDEX:")
+    print(addUniqueIndex(db, table_name, columns))
+    db.close()
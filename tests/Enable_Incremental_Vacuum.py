@@ -0,0 +1,30 @@
+# coding: utf-8
+"""
+usage: Enable_Incremental_Vacuum.py [dbfile]
+
+Switch the database (and its shard files) to auto_vacuum = INCREMENTAL, so retention purges can give the freed pages back.
+This is a full VACUUM: the database is locked until it is done. Stop the server first.
+
+example usage:
+    python3 Enable_Incremental_Vacuum.py ../m2band.db
+"""
+from pathlib import Path
+import sys
+import os
+
+sys.path.append(str(Path(".").absolute().parent))
+from rich import print
+from db_functions import *
+import sqlite3
+
+
+if __name__ == "__main__":
+    dbfile = sys.argv[1] if len(sys.argv) > 1 else "../m2band.db"
+    files = [dbfile]
+    while os.path.exists(shardFile(dbfile, len(files) - 1)):
+        files.append(shardFile(dbfile, len(files) - 1))
+
+    for path in files:
+        db = sqlite3.connect(path)
+        print(f"{path}: auto_vacuum = {enableIncrementalVacuum(db)}")
+        db.close()
@@ -0,0 +1,23 @@
+# coding: utf-8
+from pathlib import Path
+import sys
+
+sys.path.append(str(Path(".").absolute().parent))
+from rich import print
+from db_functions import *
+import sqlite3
+
+
+if __name__ == "__main__":
+    db = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else "../m2band.db")
+    db.text_factory = str
+    db.row_factory = sqlite3.Row
+
+    # -- rebuild every table with "*_time" columns stored as integer epoch milliseconds
+    print("MIGRATE TABLES:")
+    for table in getTables(db):
+        print(migrateTimeColumns(db, table["name"]))
+    print()
+
+    # -- reclaim the space used by the old tables
+    db.execute("VACUUM;")
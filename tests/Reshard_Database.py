@@ -0,0 +1,115 @@
+# coding: utf-8
+"""
+usage: Reshard_Database.py [dbfile] [count]
+
+Move the rows of the user-scoped tables (every table with a "user_id" column except "users")
+into "count" shard files next to dbfile (m2band.shard0.db, ...), or back into dbfile with count=1.
+Row ids are kept. Stop the server first, then start it with SHARDS=<count>.
+
+example usage:
+    python3 Reshard_Database.py ../m2band.db 8
+    SHARDS=8 python3 ../server.py
+"""
+from pathlib import Path
+import sys
+import os
+
+sys.path.append(str(Path(".").absolute().parent))
+from rich import print
+from db_functions import *
+import sqlite3
+
+
+def shardFiles(dbfile):
+    # -- the shard files on disk: m2band.shard0.db, m2band.shard1.db, ...
+    files = []
+    while os.path.exists(shardFile(dbfile, len(files))):
+        files.append(shardFile(dbfile, len(files)))
+    return files
+
+
+def removeDB(path):
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def countRows(path, table):
+    conn = sqlite3.connect(path)
+    exists = conn.execute("SELECT 1 FROM sqlite_schema WHERE type = 'table' AND name = ?;", [table]).fetchone()
+    num_rows = conn.execute(f"SELECT COUNT(*) FROM {table};").fetchone()[0] if exists else 0
+    conn.close()
+    return num_rows
+
+
+if __name__ == "__main__":
+    dbfile = sys.argv[1] if len(sys.argv) > 1 else "../m2band.db"
+    count = max(1, int(sys.argv[2])) if len(sys.argv) > 2 else 1
+    batch = 10000
+
+    db = connectDB(dbfile)
+    tables = shardedTables(db)
+    old_files = shardFiles(dbfile)
+    print(f"RESHARD: {dbfile} ({len(old_files) or 1} -> {count} shards), tables: {tables}")
+
+    # -- 1. copy every row to its new shard (temporary files, the old files stay untouched until the copy is verified)
+    if count > 1:
+        new_files = [f"{shardFile(dbfile, k)}.new" for k in range(count)]
+        for path in new_files:
+            removeDB(path)
+        targets = [sqlite3.connect(path) for path in new_files]
+        statements = db.execute("SELECT sql FROM sqlite_schema WHERE tbl_name IN (%s) AND sql IS NOT NULL "
+                                "ORDER BY type = 'index';" % ", ".join("?" * len(tables)), tables).fetchall()
+        for conn in targets:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            for (sql,) in statements:
+                conn.execute(sql)
+        sources = [dbfile] + old_files
+    else:
+        new_files = []
+        targets = [sqlite3.connect(dbfile)]
+        sources = old_files
+
+    for table in tables:
+        expected = sum(countRows(path, table) for path in [dbfile] + old_files)
+        for path in sources:
+            if not countRows(path, table):
+                continue
+            src = sqlite3.connect(path)
+            cur = src.execute(f"SELECT * FROM {table};")
+            columns = [d[0] for d in cur.description]
+            query = f"INSERT INTO {table} ({','.join(columns)}) VALUES ({', '.join(['?'] * len(columns))});"
+            user_col = columns.index("user_id")
+            while True:
+                rows = cur.fetchmany(batch)
+                if not rows:
+                    break
+                shards = {}
+                for row in rows:
+                    shards.setdefault(shardIndex(row[user_col], count) if count > 1 else 0, []).append(row)
+                for (shard, shard_rows) in shards.items():
+                    targets[shard].executemany(query, shard_rows)
+            src.close()
+            print(f"  {table}: copied {path}")
+        for conn in targets:
+            conn.commit()
+
+        # -- verify
+        copied = sum(countRows(path, table) for path in new_files) if count > 1 else countRows(dbfile, table)
+        if copied != expected:
+            sys.exit(f"<{table}>: {copied} rows copied, expected {expected}. Nothing was removed.")
+        print(f"  {table}: {copied} rows")
+    for conn in targets:
+        conn.close()
+
+    # -- 2. remove the rows from their old location and swap in the new shard files
+    if count > 1:
+        for table in tables:
+            db.execute(f"DELETE FROM {table};")
+        db.commit()
+    db.close()
+    for path in old_files:
+        removeDB(path)
+    for (k, path) in enumerate(new_files):
+        os.rename(path, shardFile(dbfile, k))
+    print(f"DONE: start the server with SHARDS={count}")
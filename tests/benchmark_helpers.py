@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+usage: benchmark_helpers.py [-h] [--quiet] [--min-time MIN_TIME] [--helpers HELPERS [HELPERS ...]] [--output OUTPUT]
+
+Micro-benchmarks for the per-request helpers in db_functions.py:
+parseURI, parseUrlPaths, parseFilters, parseColumnValues, mapUrlPaths, clean, getColumns
+
+Every helper is timed over a small, a realistic and a large input corpus and reports:
+  ns/op         - mean wall time per call
+  peak B/op     - peak memory allocated during one call (tracemalloc)
+  blocks/op     - memory blocks still allocated after one call (tracemalloc)
+
+optional arguments:
+  -h, --help            show this help message and exit
+  --quiet               replace the helpers' (rich) print with a no-op to time the parsing alone
+  --min-time MIN_TIME   seconds to run each case (default: 0.5)
+  --helpers HELPERS     helpers to run (default: all)
+  --output OUTPUT       save the results as json
+
+example usage:
+    benchmark_helpers.py --quiet --output helpers_$(git rev-parse --short HEAD).json
+"""
+from pathlib import Path
+import contextlib
+import tracemalloc
+import argparse
+import sqlite3
+import time
+import json
+import sys
+import io
+
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+import db_functions
+from db_functions import (
+    parseURI, parseUrlPaths, parseFilters, parseColumnValues, mapUrlPaths, clean, getColumns, getTable
+)
+
+
+###############################################################################
+#                                 Input Corpora                               #
+###############################################################################
+def wideTable(db, num_columns):
+    """a table with "num_columns" value columns (plus the {ref}_id, user_id and {ref}_time columns)"""
+    name = f"wide_{num_columns}"
+    url_paths = "/".join([f"{name}_id/INTEGER/user_id/INTEGER"]
+                         + [f"value_{i}/DOUBLE" for i in range(num_columns)] + [f"{name}_time/DATETIME"])
+    params, columns = mapUrlPaths(url_paths, {}, name)
+    db.execute(f'CREATE TABLE {name} ({", ".join(columns)});')
+    return url_paths, getTable(db, table_name=name)
+
+
+def filterString(num_clauses):
+    """a long filter: temperature > '100.4' AND entry_time BETWEEN '...' AND '...' ..."""
+    clauses = [f"(temperature > '{100 + i / 10}' OR heart_rate < '{60 + i}')" for i in range(num_clauses)]
+    return " AND ".join(["entry_time BETWEEN '2022-04-01 00:00:00' AND '2022-04-30 23:59:59'"] + clauses)
+
+
+def rowList(num_rows):
+    return [{"entry_id": i, "user_id": i % 50, "heart_rate": 60 + i % 100, "blood_o2": 90 + i % 10,
+             "temperature": 97 + (i % 40) / 10, "steps": i % 10, "entry_time": "2022-04-05 12:16:54.651"}
+            for i in range(num_rows)]
+
+
+def cases(db):
+    """(helper, case, function) for every helper and input size"""
+    oximeter_paths = "user_id/8/heart_rate/133/blood_o2/95/temperature/98.71/steps/4"
+    oximeter = {"user_id": "INTEGER", "heart_rate": "INTEGER", "blood_o2": "INTEGER",
+                "temperature": "DOUBLE", "steps": "INTEGER"}
+    tables = {n: wideTable(db, n) for n in [5, 50, 500]}
+    filters = {n: filterString(n) for n in [1, 20, 200]}
+    rows = {n: rowList(n) for n in [1, 100, 10000]}
+
+    for n in [1, 20, 200]:
+        url = f"{oximeter_paths}/filter/{filters[n]}"
+        yield ("parseURI", f"filter_{n}_clauses", lambda url=url: parseURI(url))
+        yield ("parseUrlPaths", f"filter_{n}_clauses",
+               lambda url=url: parseUrlPaths(url, {"steps": "4"}, oximeter))
+        yield ("parseFilters", f"filter_{n}_clauses",
+               lambda f=filters[n]: parseFilters(f, "user_id=?", ["8"]))
+    for (n, (url_paths, table)) in tables.items():
+        cols = [c for c in table["columns"] if c.startswith("value_")]
+        vals = [f"{c}*1.8+32" if i % 2 else "98.6" for (i, c) in enumerate(cols)]
+        yield ("parseColumnValues", f"columns_{n}", lambda cols=cols, vals=vals: parseColumnValues(cols, vals))
+        yield ("mapUrlPaths", f"columns_{n}", lambda url_paths=url_paths: mapUrlPaths(url_paths, {}, "wide"))
+        yield ("getColumns", f"pragma_columns_{n}", lambda name=table["name"]: getColumns(db, {"name": name}))
+        yield ("getColumns", f"editable_columns_{n}", lambda table=table: getColumns(db, table, editable=True))
+    for (n, data) in rows.items():
+        yield ("clean", f"rows_{n}", lambda data=data: clean({"message": f"found {n} entries", "data": data}))
+
+
+###############################################################################
+#                                    Timing                                   #
+###############################################################################
+def measure(fn, min_time):
+    # -- calibrate: double the loop count until one run takes at least "min_time"
+    number = 1
+    while True:
+        start = time.perf_counter_ns()
+        for i in range(number):
+            fn()
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= min_time * 1e9:
+            break
+        number *= 2
+
+    # -- allocations of a single call
+    fn()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+    return {"ns_per_op": round(elapsed / number), "ops": number, "peak_bytes_per_op": peak, "blocks_per_op": blocks}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="micro-benchmarks for the db_functions helpers")
+    parser.add_argument("--quiet", action="store_true", help="replace the helpers' print with a no-op")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds to run each case")
+    parser.add_argument("--helpers", nargs="+", help="helpers to run (default: all)")
+    parser.add_argument("--output", help="save the results as json")
+    args = parser.parse_args()
+
+    if args.quiet:
+        db_functions.print = lambda *args, **kwargs: None
+
+    db = sqlite3.connect(":memory:")
+    db.row_factory = sqlite3.Row
+    results = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        all_cases = list(cases(db))
+    for (helper, case, fn) in all_cases:
+        if args.helpers and (helper not in args.helpers):
+            continue
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = {"helper": helper, "case": case, **measure(fn, args.min_time)}
+        results.append(result)
+        print(f'{helper:<18} {case:<22} {result["ns_per_op"]:>14,} ns/op   '
+              f'{result["peak_bytes_per_op"]:>12,} peak B/op   {result["blocks_per_op"]:>8,} blocks/op')
+
+    if args.output:
+        report = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "python": sys.version.split()[0],
+                  "quiet": args.quiet, "results": results}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+usage: benchmark_routes.py [-h] [--db DB] [--users USERS] [--rows ROWS] [--requests REQUESTS]
+                           [--routes ROUTES [ROUTES ...]] [--no-cache] [--output OUTPUT]
+
+In-process benchmark of every route: the bottle app is driven through WSGI
+(no network, no server) against a temporary copy of the database.
+
+optional arguments:
+  -h, --help            show this help message and exit
+  --db DB               database to copy (default: ../m2band.db)
+  --users USERS         number of users in the copy (default: 100)
+  --rows ROWS           number of oximeter rows in the copy (default: 10000)
+  --requests REQUESTS   requests per route (default: 500)
+  --routes ROUTES       routes to run (default: all)
+  --no-cache            disable the /get result cache
+  --output OUTPUT       save the results as json (default: print only)
+
+example usage:
+    benchmark_routes.py --rows 100000 --output bench_$(git rev-parse --short HEAD).json
+"""
+from pathlib import Path
+from random import Random
+from wsgiref.util import setup_testing_defaults
+import contextlib
+import subprocess
+import argparse
+import tempfile
+import shutil
+import time
+import json
+import sys
+import io
+import os
+
+REPO = Path(__file__).absolute().parent.parent
+
+
+###############################################################################
+#                                 WSGI Driver                                 #
+###############################################################################
+def call(app, path, method="GET", body=b"", headers=None):
+    """call the WSGI app in-process, returns (status_code, body)"""
+    path, _, query = path.partition("?")
+    environ = {
+        "PATH_INFO": path, "QUERY_STRING": query, "REQUEST_METHOD": method,
+        "wsgi.input": io.BytesIO(body), "CONTENT_LENGTH": str(len(body)),
+    }
+    for (k, v) in (headers or {}).items():
+        k = k.upper().replace("-", "_")
+        environ[k if k == "CONTENT_TYPE" else f"HTTP_{k}"] = v
+    setup_testing_defaults(environ)
+
+    status = []
+    chunks = app(environ, lambda s, h, exc_info=None: status.append(s))
+    data = b"".join(chunks)
+    if hasattr(chunks, "close"):
+        chunks.close()
+    return int(status[0].split()[0]), data
+
+
+def percentile(samples, p):
+    ranked = sorted(samples)
+    return ranked[min(len(ranked) - 1, int(round(p / 100 * (len(ranked) - 1))))]
+
+
+def run(app, name, paths, requests):
+    """time "requests" calls of "paths" (a function returning (path, method, body, headers))"""
+    latencies, statuses = [], {}
+    start = time.perf_counter()
+    for i in range(requests):
+        path, method, body, headers = paths(i)
+        t = time.perf_counter_ns()
+        status, data = call(app, path, method, body, headers)
+        latencies.append((time.perf_counter_ns() - t) / 1e6)
+        statuses[status] = statuses.get(status, 0) + 1
+    seconds = time.perf_counter() - start
+    return {
+        "route": name,
+        "requests": requests,
+        "seconds": round(seconds, 3),
+        "throughput": round(requests / seconds, 1),
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies), 3),
+            "p50": round(percentile(latencies, 50), 3),
+            "p90": round(percentile(latencies, 90), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "max": round(max(latencies), 3),
+        },
+        "status": statuses,
+    }
+
+
+###############################################################################
+#                                    Setup                                    #
+###############################################################################
+def seed(db, users, rows, rng):
+    """grow the copy to "users" users and "rows" oximeter rows (bulk inserts)"""
+    password = securePassword("bench")
+    existing = db.execute("SELECT COUNT(*) FROM users;").fetchone()[0]
+    insertRows(db, table="users", columns=["username", "password"],
+               rows=[[f"bench_{i}", password] for i in range(existing, users)])
+    user_ids = [r[0] for r in db.execute("SELECT user_id FROM users;").fetchall()]
+
+    existing = db.execute("SELECT COUNT(*) FROM oximeter;").fetchone()[0]
+    columns = ["user_id", "heart_rate", "blood_o2", "temperature", "steps"]
+    for start in range(existing, rows, 10000):
+        batch = [[rng.choice(user_ids), rng.randint(60, 160), rng.randint(90, 100),
+                  round(rng.uniform(97, 101), 2), rng.randint(0, 10)]
+                 for i in range(start, min(rows, start + 10000))]
+        insertRows(db, table="oximeter", columns=columns, rows=batch)
+    db.commit()
+    return user_ids
+
+
+def routes(user_ids, rng):
+    """(name, paths) for every route, each paths(i) returns (path, method, body, headers)"""
+    u = lambda: rng.choice(user_ids)
+    sample = lambda: f"user_id/{u()}/heart_rate/{rng.randint(60, 160)}/blood_o2/{rng.randint(90, 100)}" \
+                     f"/temperature/{round(rng.uniform(97, 101), 2)}/steps/{rng.randint(0, 10)}"
+    return [
+        ("index", lambda i: ("/", "GET", b"", {})),
+        ("add", lambda i: (f"/add/oximeter/{sample()}", "GET", b"", {})),
+        ("get_user", lambda i: (f"/get/oximeter/user_id/{u()}", "GET", b"", {})),
+        ("get_filter", lambda i: (f"/get/oximeter?filter=temperature > '100.4' AND user_id={u()}", "GET", b"", {})),
+        ("get_repeat", lambda i: ("/get/oximeter/user_id/1", "GET", b"", {})),
+        ("edit", lambda i: (f"/edit/oximeter?steps=steps%2B1&filter=user_id={u()} AND entry_id > {i * 7}", "GET", b"", {})),
+        ("delete", lambda i: (f"/delete/oximeter/user_id/{u()}/heart_rate/{rng.randint(60, 160)}", "GET", b"", {})),
+        ("login", lambda i: ("/login/username/bench_0/password/bench", "GET", b"", {})),
+        ("createTable", lambda i: (f"/createTable/bench_{i}/bench_id/INTEGER/user_id/INTEGER/value/DOUBLE/bench_time/DATETIME",
+                                   "GET", b"", {})),
+        ("deleteTable", lambda i: (f"/deleteTable/bench_{i}", "GET", b"", {})),
+    ]
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="in-process WSGI benchmark of every route")
+    parser.add_argument("--db", default=str(REPO / "m2band.db"), help="database to copy")
+    parser.add_argument("--users", type=int, default=100, help="number of users in the copy")
+    parser.add_argument("--rows", type=int, default=10000, help="number of oximeter rows in the copy")
+    parser.add_argument("--requests", type=int, default=500, help="requests per route")
+    parser.add_argument("--routes", nargs="+", help="routes to run (default: all)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--no-cache", action="store_true", help="disable the /get result cache")
+    parser.add_argument("--output", help="save the results as json")
+    args = parser.parse_args()
+
+    # -- temporary copy of the database, server.py reads DB_FILE when it's imported
+    output = os.path.abspath(args.output) if args.output else ""
+    tmp = tempfile.mkdtemp(prefix="m2band_bench_")
+    dbfile = os.path.join(tmp, "m2band.db")
+    shutil.copy(args.db, dbfile)
+    os.environ["DB_FILE"] = dbfile
+    os.environ.setdefault("ADMISSION", "off")  # -- every request comes from one client: no rate limits
+    os.chdir(tmp)  # -- m2band.log is written to the working directory
+    sys.path.insert(0, str(REPO))
+
+    rng = Random(args.seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        from db_functions import insertRows, securePassword, connectDB, result_cache
+        import server
+        db = connectDB(dbfile)
+        user_ids = seed(db, args.users, args.rows, rng)
+        db.close()
+    if args.no_cache:
+        result_cache.max_entries = 0
+
+    results = []
+    for (name, paths) in routes(user_ids, rng):
+        if args.routes and (name not in args.routes):
+            continue
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = run(server.app, name, paths, args.requests)
+        results.append(result)
+        lat = result["latency_ms"]
+        print(f'{name:<12} {result["throughput"]:>9.1f} req/s   p50 {lat["p50"]:>8.3f} ms   '
+              f'p90 {lat["p90"]:>8.3f} ms   p99 {lat["p99"]:>8.3f} ms   status {result["status"]}')
+
+    report = {
+        "commit": gitCommit(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": sys.version.split()[0],
+        "config": {k: v for (k, v) in vars(args).items() if k != "output"},
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    shutil.rmtree(tmp, ignore_errors=True)
@@ -0,0 +1,69 @@
+# coding: utf-8
+"""
+pytest fixtures: the server (server.py) on a copy of m2band.db, called through WSGI
+
+server.py is configured from the environment on import, so every test module shares one server and database.
+"""
+from pathlib import Path
+from wsgiref.util import setup_testing_defaults
+import importlib
+import shutil
+import sqlite3
+import json
+import sys
+import io
+import os
+
+import pytest
+
+repo = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(repo))
+
+# -- scripts (run by hand against m2band.db), not pytest modules
+collect_ignore = ["sqlite3_test.py", "test_edit_setup.py", "test_request_params.py"]
+
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    # -- (server module, dbfile), with a unique index on oximeter (user_id, entry_time) for the upserts
+    dbfile = tmp_path_factory.mktemp("server") / "m2band.db"
+    shutil.copy(repo / "m2band.db", dbfile)
+    db = sqlite3.connect(dbfile)
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS oximeter_user_id_entry_time ON oximeter (user_id, entry_time);")
+    db.commit()
+    db.close()
+    os.environ.update({"DB_FILE": str(dbfile), "ADMISSION": "off", "SHARDS": "1", "DB_WAL": "1"})
+    sys.argv = ["server.py"]
+    return importlib.import_module("server"), dbfile
+
+
+def send(server, path, method="GET", body=b"", headers=None):
+    # -- one request: (status code, headers (lower case names), body)
+    module, _ = server
+    path, _, query = path.partition("?")
+    env = {"PATH_INFO": path, "QUERY_STRING": query, "REQUEST_METHOD": method,
+           "CONTENT_LENGTH": str(len(body)), "wsgi.input": io.BytesIO(body)}
+    for (k, v) in (headers or {}).items():
+        k = k.upper().replace("-", "_")
+        env[k if k in ("CONTENT_TYPE",) else "HTTP_" + k] = v
+    setup_testing_defaults(env)
+    started = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        started.update(status=int(status.split()[0]), headers={k.lower(): v for (k, v) in response_headers})
+
+    data = b"".join(module.app(env, start_response))
+    return started["status"], started["headers"], data
+
+
+def call(server, path, body=None):
+    # -- a JSON request and its JSON response
+    body = json.dumps(body).encode() if body is not None else b""
+    return json.loads(send(server, path, "POST", body, {"Content-Type": "application/json"})[2])
+
+
+def count(server, where="1", values=(), table="oximeter"):
+    db = sqlite3.connect(server[1])
+    n = db.execute(f"SELECT COUNT(*) FROM {table} WHERE {where};", values).fetchone()[0]
+    db.close()
+    return n
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+usage: generate_data.py [-h] [--db DB] [--template TEMPLATE] [--users USERS] [--rows ROWS] [--table TABLE]
+                        [--start START] [--days DAYS] [--seed SEED] [--batch BATCH]
+
+Synthetic data generator: scale a database to production volumes (10M+ rows)
+with realistic per-user time series. The output is deterministic for a given
+seed (except the shared password hash, which is salted).
+
+  * users           - "synthetic_{n}" with the password "synthetic"
+  * rows            - ordered by time across [start, start + days], so row ids grow with time like real ingest
+  * activity        - every user reports at their own rate (log-normal), so a few users own many rows
+  * values          - every user has a baseline, values follow the time of day plus noise
+                      (heart_rate, blood_o2, temperature, steps have real ranges, other INTEGER/DOUBLE/TEXT columns get generic series)
+
+optional arguments:
+  -h, --help            show this help message and exit
+  --db DB               database to write (default: m2band_synthetic.db), created from --template if missing
+  --template TEMPLATE   database to copy the schema from (default: ../m2band.db)
+  --users USERS         number of users to create (default: 1000)
+  --rows ROWS           number of rows to create (default: 1000000)
+  --table TABLE         table to fill (default: oximeter)
+  --start START         first timestamp (default: 2022-01-01 00:00:00)
+  --days DAYS           days covered by the rows (default: 90)
+  --seed SEED           random seed (default: 0)
+  --batch BATCH         rows per transaction (default: 50000)
+
+example usage:
+    generate_data.py --users 10000 --rows 10000000 --db m2band_10M.db
+    DB_FILE=tests/m2band_10M.db python3 server.py
+"""
+from pathlib import Path
+from datetime import datetime, timedelta
+from random import Random
+from itertools import accumulate
+import contextlib
+import argparse
+import sqlite3
+import math
+import time
+import sys
+import io
+import os
+
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+from db_functions import connectDB, insertRows, securePassword, getTable, getColumns
+
+# -- column: (baseline range, time-of-day amplitude, noise, (min, max), decimals)
+signals = {
+    "heart_rate": ((55, 85), 15, 4, (40, 190), 0),
+    "blood_o2": ((95, 99), 0.5, 0.8, (85, 100), 0),
+    "temperature": ((97.4, 98.8), 0.6, 0.15, (95, 104), 2),
+    "steps": ((0, 2), 8, 3, (0, 60), 0),
+    "INTEGER": ((0, 100), 10, 3, (None, None), 0),
+    "DOUBLE": ((0, 100), 10, 3, (None, None), 2),
+}
+
+
+###############################################################################
+#                                    Schema                                   #
+###############################################################################
+def createSchema(db, template):
+    """copy the CREATE statements of every table (and index) from the template database"""
+    src = sqlite3.connect(template)
+    statements = src.execute("SELECT sql FROM sqlite_schema WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+                             "ORDER BY type = 'index';").fetchall()
+    src.close()
+    for (sql,) in statements:
+        db.execute(sql)
+    db.commit()
+
+
+def columnGenerators(db, table, rng, num_users):
+    """(columns, [per-user state], generate(user_id, state, daytime, timestamp)) for a table"""
+    ref = getColumns(db, table, ref=True)
+    columns = [c for c in table["columns"] if c != ref]
+    noise = lambda: rng.random() + rng.random() + rng.random() - 1.5  # -- ~ normal, std 0.5
+
+    def series(col, signal):
+        (base, amp, std, (lo, hi), decimals) = signal
+        std *= 2
+        if lo is None:
+            return lambda state, daytime, ts: round(state[col] + amp * daytime + std * noise(), decimals or None)
+        return lambda state, daytime, ts: round(min(hi, max(lo, state[col] + amp * daytime + std * noise())), decimals or None)
+
+    generators, states = [], [{} for u in range(num_users)]
+    for col in columns:
+        signal = signals.get(col) or signals.get(table["columns"][col])
+        if col == "user_id":
+            generators.append(None)
+        elif col.endswith("_time"):
+            generators.append(lambda state, daytime, ts: ts)
+        elif signal:
+            generators.append(series(col, signal))
+            for state in states:
+                state[col] = rng.uniform(*signal[0])
+        else:
+            generators.append(lambda state, daytime, ts, col=col: f"{col}_{rng.getrandbits(32):08x}")
+
+    def generate(user_id, state, daytime, timestamp):
+        return [fn(state, daytime, timestamp) if fn else user_id for fn in generators]
+
+    return columns, states, generate
+
+
+###############################################################################
+#                                  Generators                                 #
+###############################################################################
+def generateUsers(db, num_users, start, batch):
+    """create "num_users" users (one shared password hash), returns their user_ids"""
+    password = securePassword("synthetic")
+    first = db.execute("SELECT COALESCE(MAX(user_id), 0) + 1 FROM users;").fetchone()[0]
+    user_ids = []
+    for n in range(first, first + num_users, batch):
+        rows = [[f"synthetic_{i}", password, (start - timedelta(minutes=num_users - i + first)).isoformat(" ", "milliseconds")]
+                for i in range(n, min(first + num_users, n + batch))]
+        res = insertRows(db, table="users", columns=["username", "password", "create_time"], rows=rows)
+        if isinstance(res, dict):
+            sys.exit(res)
+        user_ids += res
+        db.commit()
+    return user_ids
+
+
+def generateRows(db, table, user_ids, num_rows, start, days, batch, rng):
+    """insert "num_rows" time-ordered rows for "user_ids" into "table" (one transaction per batch)"""
+    columns, states, generate = columnGenerators(db, table, rng, len(user_ids))
+    cum_weights = list(accumulate(rng.lognormvariate(0, 1) for u in user_ids))
+    users = range(len(user_ids))
+    step = days * 86400 / num_rows
+
+    inserted = 0
+    while inserted < num_rows:
+        size = min(batch, num_rows - inserted)
+        picks = rng.choices(users, cum_weights=cum_weights, k=size)
+        rows = []
+        for (i, u) in enumerate(picks):
+            ts = start + timedelta(seconds=(inserted + i + rng.random()) * step)
+            hour = ts.hour + ts.minute / 60
+            daytime = max(0.0, math.sin(math.pi * (hour - 6) / 16)) if 6 <= hour <= 22 else 0.0
+            rows.append(generate(user_ids[u], states[u], daytime, ts.isoformat(" ", "milliseconds")))
+        res = insertRows(db, table=table, columns=columns, rows=rows)
+        if isinstance(res, dict):
+            sys.exit(res)
+        db.commit()
+        inserted += size
+        yield inserted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="synthetic data generator")
+    parser.add_argument("--db", default="m2band_synthetic.db", help="database to write")
+    parser.add_argument("--template", default=str(Path(__file__).absolute().parent.parent / "m2band.db"),
+                        help="database to copy the schema from")
+    parser.add_argument("--users", type=int, default=1000, help="number of users to create")
+    parser.add_argument("--rows", type=int, default=1000000, help="number of rows to create")
+    parser.add_argument("--table", default="oximeter", help="table to fill")
+    parser.add_argument("--start", default="2022-01-01 00:00:00", help="first timestamp")
+    parser.add_argument("--days", type=float, default=90, help="days covered by the rows")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--batch", type=int, default=50000, help="rows per transaction")
+    args = parser.parse_args()
+
+    rng = Random(args.seed)
+    start = datetime.fromisoformat(args.start)
+    exists = os.path.exists(args.db)
+    db = connectDB(args.db)
+    db.execute("PRAGMA synchronous = OFF;")
+    db.execute("PRAGMA cache_size = -262144;")
+    if not exists:
+        createSchema(db, args.template)
+
+    t = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        table = getTable(db, table_name=args.table)
+    if not table:
+        sys.exit(f'table "{args.table}" does not exist in {args.db}')
+    with contextlib.redirect_stdout(io.StringIO()):
+        user_ids = generateUsers(db, args.users, start, args.batch)
+    print(f"{len(user_ids):,} users ({time.time() - t:.1f}s)")
+
+    # -- insertRows() prints every batch, keep the progress line readable
+    batches = generateRows(db, table, user_ids, args.rows, start, args.days, args.batch, rng)
+    while True:
+        with contextlib.redirect_stdout(io.StringIO()):
+            inserted = next(batches, None)
+        if inserted is None:
+            break
+        print(f"\r{inserted:,} / {args.rows:,} rows ({inserted / (time.time() - t):,.0f} rows/s)", end="", flush=True)
+    print(f"\n{args.rows:,} {args.table} rows ({time.time() - t:.1f}s)")
+    db.execute("ANALYZE;")
+    db.close()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+usage: load_simulator.py [-h] [--url URL] [--devices DEVICES] [--duration DURATION] [--rate RATE] [--batch BATCH]
+                         [--poll POLL] [--ramp RAMP] [--interval INTERVAL] [--timeout TIMEOUT] [--seed SEED] [--output OUTPUT]
+
+Wristband fleet load simulator: thousands of concurrent devices against a running server.
+Every device keeps one HTTP/1.1 keep-alive connection (asyncio, no dependencies) and:
+
+  1. signs up  - /add/users/username/<device>/password/<password> ("user exists" is fine)
+  2. logs in   - /login/username/<device>/password/<password>
+  3. ingests   - "--rate" oximeter samples per second, one /add per sample (--batch 1)
+                 or a JSON body of "--batch" samples per POST /add/oximeter
+  4. polls     - /get/oximeter/user_id/<user_id> for new rows every "--poll" seconds (with If-None-Match)
+
+Every "--interval" seconds a line with the ingest rate, request rate, error rate and
+tail latency (p50/p99/max per request kind) is printed, the full timeline can be saved as json.
+
+optional arguments:
+  -h, --help            show this help message and exit
+  --url URL             server to load (default: http://127.0.0.1:8080)
+  --devices DEVICES     number of simulated wristbands (default: 100)
+  --duration DURATION   seconds to run after the ramp up (default: 60)
+  --rate RATE           samples per second per device (default: 1)
+  --batch BATCH         samples per /add request (default: 1)
+  --poll POLL           seconds between /get polls per device, 0 to disable (default: 10)
+  --ramp RAMP           seconds to spread the device start ups over (default: 10)
+  --interval INTERVAL   seconds per report line (default: 5)
+  --timeout TIMEOUT     request timeout in seconds (default: 30)
+  --seed SEED           random seed (default: 0)
+  --output OUTPUT       save the timeline and totals as json
+
+example usage:
+    ADMISSION=off SERVER=paste python3 server.py &
+    load_simulator.py --devices 2000 --rate 0.5 --batch 10 --duration 300 --output load_2000.json
+
+NOTE: the default "wsgiref" server closes every connection (HTTP/1.0), the devices reconnect
+      for every request then. Run the server with SERVER=paste|cheroot|gevent to measure keep-alive.
+NOTE: all devices share one client IP: run the server with admission control off (ADMISSION=off, the default),
+      or the per IP rate limits reject most of the load with 429.
+"""
+from urllib.parse import urlsplit, quote
+from random import Random
+import argparse
+import asyncio
+import time
+import json
+
+
+###############################################################################
+#                             Keep-Alive HTTP Client                          #
+###############################################################################
+class Connection:
+    """one persistent HTTP/1.1 connection (reopened when the server closes it)"""
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+        self.opened = 0
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=b"", headers=None):
+        """returns (status, headers, body)"""
+        for attempt in range(2):
+            reused = self.writer is not None
+            if not reused:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+                self.opened += 1
+            try:
+                head = [f"{method} {quote(path, safe='/?=&%')} HTTP/1.1", f"Host: {self.host}:{self.port}",
+                        f"Content-Length: {len(body)}"] + [f"{k}: {v}" for (k, v) in (headers or {}).items()]
+                self.writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+                await self.writer.drain()
+                return await self.response()
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # -- a reused connection may have been closed by the server in the meantime: retry once
+                self.close()
+                if (not reused) or attempt:
+                    raise
+
+    async def response(self):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by server")
+        version, status = status_line.split()[:2]
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            k, _, v = line.decode("latin-1").partition(":")
+            headers[k.strip().lower()] = v.strip()
+
+        if (int(status) in (204, 304)) or (100 <= int(status) < 200):
+            body = b""
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if not size:
+                    break
+                body += chunk[:-2]
+        elif "content-length" in headers:
+            body = await self.reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await self.reader.read()
+            self.close()
+
+        if (version != b"HTTP/1.1") or (headers.get("connection", "").lower() == "close"):
+            self.close()
+        return int(status), headers, body
+
+
+###############################################################################
+#                                   Statistics                                #
+###############################################################################
+def percentile(samples, p):
+    ranked = sorted(samples)
+    return ranked[min(len(ranked) - 1, int(round(p / 100 * (len(ranked) - 1))))] if ranked else 0
+
+
+class Stats:
+    """per interval and total request latencies, errors and ingested samples"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.interval, self.total = self.bucket(), self.bucket()
+        self.timeline = []
+        self.devices = 0
+        self.connections = 0
+
+    def bucket(self):
+        return {"latencies": {}, "errors": {}, "samples": 0, "requests": 0, "start": time.perf_counter()}
+
+    def record(self, kind, seconds, error=None, samples=0):
+        for b in (self.interval, self.total):
+            b["latencies"].setdefault(kind, []).append(seconds * 1000)
+            b["requests"] += 1
+            b["samples"] += samples
+            if error:
+                b["errors"][error] = b["errors"].get(error, 0) + 1
+
+    def summary(self, b):
+        seconds = max(1e-9, time.perf_counter() - b["start"])
+        errors = sum(b["errors"].values())
+        return {
+            "t": round(time.perf_counter() - self.start, 1),
+            "devices": self.devices,
+            "ingest_rate": round(b["samples"] / seconds, 1),
+            "request_rate": round(b["requests"] / seconds, 1),
+            "error_rate": round(100 * errors / b["requests"], 2) if b["requests"] else 0,
+            "errors": dict(b["errors"]),
+            "latency_ms": {kind: {"count": len(lat), "p50": round(percentile(lat, 50), 1),
+                                  "p99": round(percentile(lat, 99), 1), "max": round(max(lat), 1)}
+                           for (kind, lat) in b["latencies"].items()},
+        }
+
+    def rotate(self):
+        res = self.summary(self.interval)
+        self.timeline.append(res)
+        self.interval = self.bucket()
+        return res
+
+
+###############################################################################
+#                                    Devices                                  #
+###############################################################################
+def responseError(status, body):
+    """"error" for a failed response: HTTP status >= 400 or an error message in the json body"""
+    if status >= 400:
+        return f"HTTP {status}"
+    for marker in (b'"SQLite.', b'"invalid frame"', b'"invalid body"', b'"missing paramaters"', b'"user does not exist"'):
+        if marker in body:
+            return marker.decode().strip('"').rstrip(".")
+    return None
+
+
+async def call(conn, stats, kind, method, path, body=b"", headers=None, samples=0, timeout=30):
+    t = time.perf_counter()
+    try:
+        status, resp_headers, data = await asyncio.wait_for(conn.request(method, path, body, headers), timeout)
+    except asyncio.TimeoutError:
+        conn.close()
+        stats.record(kind, time.perf_counter() - t, error="timeout")
+        return None, {}, b""
+    except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+        conn.close()
+        stats.record(kind, time.perf_counter() - t, error=e.__class__.__name__)
+        return None, {}, b""
+    error = responseError(status, data)
+    stats.record(kind, time.perf_counter() - t, error=error, samples=0 if error else samples)
+    return status, resp_headers, data
+
+
+def sample(rng, user_id):
+    return {"user_id": user_id, "heart_rate": rng.randint(60, 160), "blood_o2": rng.randint(90, 100),
+            "temperature": round(rng.uniform(97, 101), 2), "steps": rng.randint(0, 10)}
+
+
+async def device(n, args, stats, deadline, rng):
+    url = urlsplit(args.url)
+    conn = Connection(url.hostname, url.port or 80)
+    username, password = f"wristband_{args.seed}_{n}", "wristband"
+    await asyncio.sleep(rng.uniform(0, args.ramp))
+    stats.devices += 1
+
+    try:
+        # -- sign up (or reuse the account from an earlier run) and log in
+        await call(conn, stats, "signup", "GET", f"/add/users/username/{username}/password/{password}", timeout=args.timeout)
+        status, headers, data = await call(conn, stats, "login", "GET", f"/login/username/{username}/password/{password}",
+                                           timeout=args.timeout)
+        try:
+            user_id = json.loads(data)["user_id"]
+        except (ValueError, KeyError):
+            return
+
+        # -- ingest at "rate" samples per second, poll every "poll" seconds
+        buffer, cursor, etag = [], 0, ""
+        next_poll = time.perf_counter() + rng.uniform(0, args.poll) if args.poll else float("inf")
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(rng.expovariate(args.rate))
+            buffer.append(sample(rng, user_id))
+            if len(buffer) >= args.batch:
+                if args.batch == 1:
+                    path = "/add/oximeter/" + "/".join(f"{k}/{v}" for (k, v) in buffer[0].items())
+                    await call(conn, stats, "add", "GET", path, samples=1, timeout=args.timeout)
+                else:
+                    body = json.dumps({"columns": list(buffer[0].keys()), "rows": [list(s.values()) for s in buffer]})
+                    await call(conn, stats, "add_batch", "POST", "/add/oximeter", body.encode(),
+                               {"Content-Type": "application/json"}, samples=len(buffer), timeout=args.timeout)
+                buffer = []
+
+            if time.perf_counter() >= next_poll:
+                next_poll += args.poll
+                headers = {"If-None-Match": etag} if etag else {}
+                status, resp_headers, data = await call(
+                    conn, stats, "get", "GET", f"/get/oximeter/user_id/{user_id}?filter=entry_id > '{cursor}'",
+                    headers=headers, timeout=args.timeout)
+                if status == 200:
+                    etag = resp_headers.get("etag", "")
+                    try:
+                        # -- "data": a list of rows, one row (dict) or {"submitted": ...} when no rows were found
+                        rows = json.loads(data).get("data", [])
+                        rows = rows if isinstance(rows, list) else [rows] if "entry_id" in rows else []
+                        cursor = max([cursor] + [row["entry_id"] for row in rows])
+                    except (ValueError, AttributeError, TypeError, KeyError):
+                        pass
+    finally:
+        stats.devices -= 1
+        conn.close()
+        stats.connections += conn.opened
+
+
+async def reporter(stats, interval):
+    while True:
+        await asyncio.sleep(interval)
+        res = stats.rotate()
+        lat = " ".join(f'{k} {v["p50"]}/{v["p99"]}/{v["max"]}ms' for (k, v) in res["latency_ms"].items())
+        print(f'[{res["t"]:>7.1f}s] devices {res["devices"]:>5}   ingest {res["ingest_rate"]:>9.1f}/s   '
+              f'requests {res["request_rate"]:>8.1f}/s   errors {res["error_rate"]:>5.2f}%   p50/p99/max {lat}', flush=True)
+
+
+async def main(args):
+    stats = Stats()
+    rng = Random(args.seed)
+    deadline = time.perf_counter() + args.ramp + args.duration
+    report = asyncio.ensure_future(reporter(stats, args.interval))
+    await asyncio.gather(*[device(n, args, stats, deadline, Random(rng.random())) for n in range(args.devices)])
+    report.cancel()
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="wristband fleet load simulator")
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="server to load")
+    parser.add_argument("--devices", type=int, default=100, help="number of simulated wristbands")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run after the ramp up")
+    parser.add_argument("--rate", type=float, default=1, help="samples per second per device")
+    parser.add_argument("--batch", type=int, default=1, help="samples per /add request")
+    parser.add_argument("--poll", type=float, default=10, help="seconds between /get polls per device, 0 to disable")
+    parser.add_argument("--ramp", type=float, default=10, help="seconds to spread the device start ups over")
+    parser.add_argument("--interval", type=float, default=5, help="seconds per report line")
+    parser.add_argument("--timeout", type=float, default=30, help="request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--output", help="save the timeline and totals as json")
+    args = parser.parse_args()
+
+    stats = asyncio.run(main(args))
+    total = stats.summary(stats.total)
+    total["connections"] = stats.connections
+    print(json.dumps(total, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "timeline": stats.timeline, "total": total}, f, indent=2)
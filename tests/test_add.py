@@ -0,0 +1,31 @@
+# coding: utf-8
+"""
+/add with a body (frames of samples): validation and insertion (pytest)
+
+usage (from the tests folder):
+    python3 -m pytest -q test_add.py
+"""
+from conftest import call, count
+
+
+def sample(**params):
+    return {"user_id": 6, "heart_rate": 70, "blood_o2": 97, "temperature": 98.1, "steps": 11, **params}
+
+
+def test_frame_inserted(server):
+    before = count(server, "steps = 2718")
+    rows = [sample(steps=2718, entry_time=f"2003-01-01 00:00:0{i}.000") for i in range(2)]
+    res = call(server, "/add/oximeter", {"rows": rows})
+    assert res["count"] == 2
+    assert count(server, "steps = 2718") == before + 2
+
+
+def test_non_scalar_cells_rejected(server):
+    before = count(server)
+    for cell in ({"a": 1}, [1, 2]):
+        res = call(server, "/add/oximeter", {"rows": [sample(), sample(steps=cell)]})
+        assert (res["message"], res["non_scalar_rows"]) == ("invalid frame", [1])
+    res = call(server, "/add/oximeter", {"columns": ["user_id", "heart_rate", "blood_o2", "temperature", "steps"],
+                                         "rows": [[6, 70, 97, [98.1], 11]]})
+    assert (res["message"], res["non_scalar_rows"]) == ("invalid frame", [0])
+    assert count(server) == before
@@ -0,0 +1,92 @@
+# coding: utf-8
+"""
+/batch: atomic rollback, savepoint partial commit and upserts in a batch (pytest)
+
+usage (from the tests folder):
+    python3 -m pytest -q test_batch.py
+"""
+import sqlite3
+
+from conftest import call, count
+
+
+def sample(user_id, **params):
+    return {"op": "add", "table": "oximeter",
+            "params": {"user_id": user_id, "heart_rate": 70, "blood_o2": 97, "temperature": 98.1, "steps": 2, **params}}
+
+
+def test_atomic_rollback(server):
+    before = count(server)
+    ops = [sample(8), {"op": "edit", "table": "oximeter", "params": {"temperature": 97.0}}, sample(8)]
+    res = call(server, "/batch", ops)
+    assert [r["status"] for r in res["results"]] == ["rolled back", "failed", "skipped"]
+    assert count(server) == before
+
+
+def test_unknown_table_fails(server):
+    res = call(server, "/batch", [{"op": "get", "table": "no_such_table", "params": {}}])
+    assert res["failed"] == 1
+
+
+def test_savepoint_partial_commit(server):
+    before = count(server)
+    ops = [sample(8), {"op": "delete", "table": "oximeter", "params": {}}, sample(9)]
+    res = call(server, "/batch/savepoint", ops)
+    assert [r["status"] for r in res["results"]] == ["ok", "failed", "ok"]
+    assert count(server) == before + 2
+
+
+def test_get_sees_batch_rows(server):
+    get = {"op": "get", "table": "oximeter", "params": {"user_id": 8, "steps": 987654}}
+    ops = [sample(8, steps=987654), get, {"op": "edit", "table": "oximeter", "params": {"temperature": 97.0}}]
+    res = call(server, "/batch", ops)
+    assert res["results"][1]["status"] == "rolled back"
+    assert res["results"][1]["result"]["data"]["steps"] == 987654
+    # -- the rolled back row was not cached: the same read doesn't see it
+    res = call(server, "/batch", [get])
+    assert "data" not in res["results"][0]["result"] or "steps" not in res["results"][0]["result"]["data"]
+    assert count(server, "steps = 987654") == 0
+
+
+def test_upsert_rollback(server):
+    entry_time = "2001-01-01 00:00:00.000"
+    upsert = sample(8, entry_time=entry_time, upsert="user_id,entry_time")
+    res = call(server, "/batch", [upsert])
+    assert res["failed"] == 0
+    # -- the update of the existing row is rolled back with the batch
+    upsert["params"]["heart_rate"] = 150
+    res = call(server, "/batch", [upsert, {"op": "delete", "table": "oximeter", "params": {}}])
+    assert res["failed"] == 1
+    assert count(server, "entry_time = ? AND heart_rate = 70", [entry_time]) == 1
+
+
+def test_upsert_without_index_fails(server):
+    entry_time = "2002-01-01 00:00:00.000"
+    ops = [sample(8, entry_time=entry_time), sample(8, entry_time=entry_time, upsert="user_id,steps")]
+    res = call(server, "/batch", ops)
+    assert res["results"][1]["status"] == "failed"
+    assert count(server, "entry_time = ?", [entry_time]) == 0
+
+
+def test_batch_holds_the_write_lock(server, monkeypatch):
+    # -- a batch that reads first must not let another writer commit before its own writes (SQLITE_BUSY_SNAPSHOT)
+    module, dbfile = server
+    writes = []
+
+    def get(db, table_name=""):
+        res = module.get(db, table_name)
+        other = sqlite3.connect(dbfile, timeout=0)
+        try:
+            other.execute("UPDATE oximeter SET steps = steps WHERE entry_id = 1;")
+            other.commit()
+            writes.append("committed")
+        except sqlite3.OperationalError:
+            writes.append("locked")
+        other.close()
+        return res
+
+    monkeypatch.setitem(module.batch_handlers, "get", get)
+    ops = [{"op": "get", "table": "oximeter", "params": {"user_id": 8}}, sample(8)]
+    res = call(server, "/batch", ops)
+    assert writes == ["locked"]
+    assert res["failed"] == 0
@@ -0,0 +1,110 @@
+# coding: utf-8
+"""
+/get result cache (ResultCache) and request coalescing (SingleFlight) (pytest)
+
+usage (from the tests folder):
+    python3 -m pytest -q test_cache.py
+"""
+import threading
+import time
+import json
+
+from conftest import send
+from db_functions import ResultCache, SingleFlight, bumpGeneration, commitGenerations, getGeneration
+
+
+def test_cache_hit_and_write_invalidation(server):
+    module, _ = server
+    path = "/get/oximeter/user_id/2/steps/4711"
+    send(server, "/add/oximeter?user_id=2&heart_rate=70&blood_o2=97&temperature=98.1&steps=4711")
+    _, _, body = send(server, path)
+    hits = module.result_cache.info()["hits"]
+    _, _, cached = send(server, path)
+    assert (cached, module.result_cache.info()["hits"]) == (body, hits + 1)
+    # -- a write to the table evicts its entries: the next /get sees the new row
+    invalidations = module.result_cache.info()["invalidations"]
+    send(server, "/add/oximeter?user_id=2&heart_rate=71&blood_o2=97&temperature=98.1&steps=4711")
+    assert module.result_cache.info()["invalidations"] > invalidations
+    _, _, body = send(server, path)
+    assert sorted(row["heart_rate"] for row in json.loads(body)["data"]) == [70, 71]
+
+
+def test_result_cache_generation_and_lru():
+    cache = ResultCache(max_entries=2, max_bytes=10)
+    key = lambda n: ("cache_test", "user_id=?", (n,))
+    generation = getGeneration("cache_test")
+    cache.put(key(1), generation, b"aaaa")
+    cache.put(key(2), generation, b"bbbb")
+    assert cache.get(key(1)) == b"aaaa"
+    # -- over max_entries (and max_bytes): the least recently used entry (2) goes
+    cache.put(key(3), generation, b"cccc")
+    assert (cache.get(key(2)), cache.get(key(3)), cache.info()["evictions"]) == (None, b"cccc", 1)
+    cache.put(key(4), generation, b"d" * 11)
+    assert cache.get(key(4)) is None
+    # -- an entry of an older generation is never served, nor stored
+    bumpGeneration("cache_test")
+    commitGenerations()
+    assert (cache.get(key(1)), cache.get(key(3))) == (None, None)
+    cache.put(key(5), generation, b"eeee")
+    assert cache.get(key(5)) is None
+
+
+def test_result_cache_invalidate():
+    cache = ResultCache()
+    generation = getGeneration("cache_test")
+    cache.put(("cache_test", "", ()), generation, b"a")
+    cache.put(("other_test", "", ()), getGeneration("other_test"), b"b")
+    cache.invalidate("cache_test")
+    assert cache.get(("cache_test", "", ())) is None
+    assert cache.get(("other_test", "", ())) == b"b"
+    assert (cache.info()["invalidations"], cache.info()["bytes"]) == (1, 1)
+
+
+def test_single_flight_coalesces():
+    flights, release, calls, results = SingleFlight(max_wait=5), threading.Event(), [], []
+
+    def query():
+        calls.append(1)
+        release.wait(5)
+        return b"rows"
+
+    threads = [threading.Thread(target=lambda: results.append(flights.do("key", 1, query))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert (len(calls), results) == (1, [b"rows"] * 4)
+    assert (flights.info()["leaders"], flights.info()["shared"], flights.info()["in_flight"]) == (1, 3, 0)
+
+
+def test_single_flight_generations_and_failures():
+    flights = SingleFlight(max_wait=0.5)
+    # -- another generation (a write happened) is another flight
+    assert [flights.do("key", g, lambda: g) for g in (1, 2)] == [1, 2]
+    assert flights.info()["leaders"] == 2
+
+    # -- a leader that fails doesn't fail the waiting requests: they run the query themselves
+    started, results = threading.Event(), []
+
+    def failing():
+        started.set()
+        time.sleep(0.2)
+        raise ValueError("query failed")
+
+    def lead():
+        try:
+            flights.do("key", 3, failing)
+        except ValueError:
+            results.append("leader failed")
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    started.wait(5)
+    results.append(flights.do("key", 3, lambda: "own query"))
+    leader.join(5)
+    assert sorted(results) == ["leader failed", "own query"]
+    assert flights.info()["timeouts"] == 1
+    # -- max_wait 0 disables coalescing
+    assert SingleFlight(max_wait=0).do("key", 1, lambda: "direct") == "direct"
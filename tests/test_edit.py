@@ -0,0 +1,29 @@
+# coding: utf-8
+"""
+/edit bulk edits: counts in order and value checks (pytest)
+
+usage (from the tests folder):
+    python3 -m pytest -q test_edit.py
+"""
+from conftest import call, count
+
+
+def test_counts_follow_the_edits(server):
+    # -- the 2nd edit moves the row away from the key of the 1st and 3rd edits: the edits run (and are counted) in order
+    res = call(server, "/add/oximeter", {"user_id": 5, "heart_rate": 70, "blood_o2": 97, "temperature": 98.1, "steps": 31415})
+    entry_id = res["entry_id"][0]
+    updates = [{"key": {"steps": 31415}, "changes": {"temperature": 97.5}},
+               {"key": {"entry_id": entry_id}, "changes": {"steps": 31416}},
+               {"key": {"steps": 31415}, "changes": {"temperature": 96.0}}]
+    res = call(server, "/edit/oximeter", updates)
+    assert (res["counts"], res["not_found"]) == ([1, 1, 0], [2])
+    assert count(server, "entry_id = ? AND steps = 31416 AND temperature = 97.5", [entry_id]) == 1
+
+
+def test_values_must_be_scalars(server):
+    for changes in ({"temperature": [1]}, {"temperature": {"a": 1}}):
+        res = call(server, "/edit/oximeter", [{"key": {"entry_id": 1}, "changes": changes}])
+        assert res["message"] == "invalid bulk edit"
+        assert res["invalid"][0]["row"] == 0
+    res = call(server, "/edit/oximeter", [{"key": {"entry_id": [1, 2]}, "changes": {"temperature": 97}}])
+    assert res["message"] == "invalid bulk edit"
@@ -0,0 +1,53 @@
+# coding: utf-8
+"""
+/get ETags: 304 Not Modified, invalidation by writes and compressed bodies (pytest)
+
+usage (from the tests folder):
+    python3 -m pytest -q test_etag.py
+"""
+import gzip
+import json
+
+from conftest import send
+
+
+def test_not_modified(server):
+    status, headers, body = send(server, "/get/oximeter/user_id/2")
+    etag = headers["etag"]
+    assert (status, etag[:3]) == (200, 'W/"')
+    status, headers, body = send(server, "/get/oximeter/user_id/2", headers={"If-None-Match": etag})
+    assert (status, body) == (304, b"")
+    assert headers["etag"] == etag
+    assert headers["vary"] == "Accept-Encoding"
+    # -- the strong form of the tag matches too (weak comparison)
+    status, _, _ = send(server, "/get/oximeter/user_id/2", headers={"If-None-Match": etag[2:]})
+    assert status == 304
+
+
+def test_write_changes_etag(server):
+    status, headers, _ = send(server, "/get/oximeter/user_id/2")
+    etag = headers["etag"]
+    send(server, "/add/oximeter?user_id=2&heart_rate=70&blood_o2=97&temperature=98.1&steps=5")
+    status, headers, body = send(server, "/get/oximeter/user_id/2", headers={"If-None-Match": etag})
+    assert status == 200
+    assert headers["etag"] != etag
+    assert any(row["steps"] == 5 for row in json.loads(body)["data"])
+
+
+def test_compressed_body(server):
+    status, headers, body = send(server, "/get/oximeter", headers={"Accept-Encoding": "gzip"})
+    assert (status, headers.get("content-encoding")) == (200, "gzip")
+    assert "Accept-Encoding" in headers["vary"]
+    _, plain_headers, plain = send(server, "/get/oximeter")
+    assert gzip.decompress(body) == plain
+    # -- one weak tag for both representations, the caches select them with "Vary"
+    assert headers["etag"] == plain_headers["etag"]
+    status, headers, _ = send(server, "/get/oximeter", headers={"Accept-Encoding": "gzip", "If-None-Match": headers["etag"]})
+    assert (status, headers["vary"]) == (304, "Accept-Encoding")
+
+
+def test_static_response(server):
+    status, headers, _ = send(server, "/get/usage")
+    assert (status, headers["etag"][:3]) == (200, 'W/"')
+    status, headers, _ = send(server, "/get/usage", headers={"If-None-Match": headers["etag"]})
+    assert (status, headers["vary"]) == (304, "Accept-Encoding")
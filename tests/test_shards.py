@@ -0,0 +1,182 @@
+# coding: utf-8
+"""
+sharded mode (SHARDS > 1): routing, cross-shard rollback and id allocation (pytest)
+
+usage (from the tests folder):
+    python3 -m pytest -q test_shards.py
+"""
+from pathlib import Path
+from wsgiref.util import setup_testing_defaults
+import subprocess
+import threading
+import shutil
+import sqlite3
+import sys
+import time
+import io
+
+import pytest
+
+repo = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(repo))
+from db_functions import *
+import bottle
+
+
+def resetShards():
+    for conn in getattr(shard_local, "connections", None) or []:
+        conn.close()
+    shard_local.connections = None
+
+
+@pytest.fixture
+def shards(tmp_path):
+    # -- a copy of m2band.db split into 4 shard files
+    dbfile = str(tmp_path / "m2band.db")
+    shutil.copy(repo / "m2band.db", dbfile)
+    subprocess.run([sys.executable, "Reshard_Database.py", dbfile, "4"], cwd=repo / "tests",
+                   check=True, capture_output=True)
+    saved, published = dict(shard_config), dict(table_rowids)
+    resetShards()
+    configureShards(dbfile, 4)
+    db = connectDB(dbfile)
+    yield db
+    db.close()
+    resetShards()
+    # -- the process-wide state the other test modules' server shares
+    shard_config.update(saved)
+    table_rowids.clear()
+    table_rowids.update(published)
+    discardRowIds()
+
+
+def shardRows(db, shard, where="1", values=()):
+    conn = sqlite3.connect(shardFile(shard_config["dbfile"], shard))
+    rows = conn.execute(f"SELECT * FROM oximeter WHERE {where};", values).fetchall()
+    conn.close()
+    return rows
+
+
+def failIn(shard, event):
+    # -- a trigger that makes every UPDATE / DELETE on oximeter fail in one shard
+    conn = sqlite3.connect(shardFile(shard_config["dbfile"], shard))
+    conn.execute(f"CREATE TRIGGER fail_{event.lower()} BEFORE {event} ON oximeter BEGIN SELECT RAISE(ABORT, 'shard down'); END;")
+    conn.commit()
+    conn.close()
+
+
+def test_routing(shards):
+    table = getTable(shards, table_name="oximeter")
+    row_id = insertRow(shards, table=table, columns=["user_id", "heart_rate", "blood_o2", "temperature", "steps"],
+                       col_values=[8, 70, 97, 98.1, 2])
+    commitShards()
+    assert [len(shardRows(shards, k, "entry_id = ?", [row_id])) for k in range(4)].count(1) == 1
+    assert shardRows(shards, shardIndex(8), "entry_id = ?", [row_id])
+    assert row_id % 4 == shardIndex(8)
+    assert fetchRow(shards, table=table, where="entry_id=?", values=[row_id])["user_id"] == 8
+    # -- the main database keeps the schema only
+    assert shards.execute("SELECT COUNT(*) FROM oximeter;").fetchone()[0] == 0
+
+
+def test_fan_out_update_rolls_back_every_shard(shards):
+    failIn(3, "UPDATE")
+    before = [shardRows(shards, k) for k in range(4)]
+    table = getTable(shards, table_name="oximeter")
+    res = updateRow(shards, table=table, columns=["temperature"], col_values=["50.0"], where="temperature > ?", values=[0])
+    assert isinstance(res, dict)
+    commitShards()
+    assert [shardRows(shards, k) for k in range(4)] == before
+
+
+def test_fan_out_delete_rolls_back_every_shard(shards):
+    failIn(3, "DELETE")
+    before = [shardRows(shards, k) for k in range(4)]
+    table = getTable(shards, table_name="oximeter")
+    res = deleteRow(shards, table=table, where="temperature > ?", values=[0])
+    assert isinstance(res, dict)
+    commitShards()
+    assert [shardRows(shards, k) for k in range(4)] == before
+
+
+def shardAdd(db):
+    # -- a handler that writes to a shard and then fails (error response with status 200, or an exception) or not
+    insertRow(db, table=getTable(db, table_name="oximeter"),
+              columns=["user_id", "heart_rate", "blood_o2", "temperature", "steps"], col_values=[8, 70, 97, 98.1, 4242])
+    if bottle.request.query.get("failure") == "exception":
+        raise ValueError("handler error")
+    if bottle.request.query.get("failure") == "flag":
+        bottle.request.environ["m2band.failed"] = True
+    return {"message": "done"}
+
+
+@pytest.mark.parametrize("failure", ["", "flag", "exception"])
+def test_request_commits_or_rolls_back_shards(shards, failure):
+    app = bottle.Bottle(catchall=True)
+    app.install(SQLitePoolPlugin(shard_config["dbfile"], write_size=1))
+    app.route("/add", callback=shardAdd)
+    env = {"PATH_INFO": "/add", "QUERY_STRING": f"failure={failure}", "REQUEST_METHOD": "GET", "wsgi.input": io.BytesIO(b"")}
+    setup_testing_defaults(env)
+    b"".join(app(env, lambda status, headers, exc_info=None: None))
+    assert len(shardRows(shards, shardIndex(8), "steps = 4242")) == (0 if failure else 1)
+
+
+def addSample(user_id, steps):
+    # -- an /add of one sample on this thread's connections (not committed)
+    db = connectDB(shard_config["dbfile"])
+    row_id = insertRow(db, table=getTable(db, table_name="oximeter"),
+                       columns=["user_id", "heart_rate", "blood_o2", "temperature", "steps"],
+                       col_values=[user_id, 70, 97, 98.1, steps])
+    db.close()
+    return row_id
+
+
+def otherShardUser(user_id):
+    return next(u for u in range(1, 100) if shardIndex(u) != shardIndex(user_id))
+
+
+def test_ids_are_committed_in_order(shards):
+    # -- request A reserves an id in one shard, request B in another shard while A is still open
+    user_b = otherShardUser(8)
+    ids, allocated, commit = {}, threading.Event(), threading.Event()
+
+    def requestA():
+        ids["a"] = addSample(8, 1)
+        allocated.set()
+        commit.wait(10)
+        commitShards()
+
+    def requestB():
+        ids["b"] = addSample(user_b, 2)
+        commitShards()
+
+    a = threading.Thread(target=requestA)
+    a.start()
+    allocated.wait(10)
+    b = threading.Thread(target=requestB)
+    b.start()
+    b.join(0.5)
+    # -- B waits for A's commit: a subscriber can't see B's (larger) id before A's row is committed
+    assert b.is_alive()
+    assert not shardRows(shards, shardIndex(user_b), "steps = 2 AND user_id = ?", [user_b])
+    commit.set()
+    a.join(10)
+    b.join(10)
+    assert ids["a"] < ids["b"]
+    assert shardRows(shards, shardIndex(8), "entry_id = ?", [ids["a"]])
+    assert shardRows(shards, shardIndex(user_b), "entry_id = ?", [ids["b"]])
+
+
+def test_ids_grow_across_shards(shards):
+    # -- a shard with ids ahead of the clock (a large insertRows): the other shards continue after them
+    ahead = int(time.time() * 1000000) + 10**9
+    conn = sqlite3.connect(shardFile(shard_config["dbfile"], shardIndex(8)))
+    conn.execute("INSERT INTO oximeter (entry_id, user_id, heart_rate, blood_o2, temperature, steps) "
+                 "VALUES (?, 8, 70, 97, 98.1, 3);", [ahead])
+    conn.commit()
+    conn.close()
+    row_id = addSample(otherShardUser(8), 4)
+    commitShards()
+    assert row_id > ahead
+    db = connectDB(shard_config["dbfile"])
+    assert lastRowId(db, getTable(db, table_name="oximeter")) == row_id
+    db.close()
@@ -0,0 +1,27 @@
+# coding: utf-8
+"""
+/stats: the slow query log doesn't expose the bound values (pytest)
+
+usage (from the tests folder):
+    python3 -m pytest -q test_stats.py
+"""
+import json
+
+from conftest import send
+
+
+def test_slow_queries_without_values(server, monkeypatch, tmp_path):
+    module, _ = server
+    # -- log every query (to a temporary log file)
+    monkeypatch.setattr(module.slow_query_log, "threshold_ms", 0)
+    monkeypatch.setattr(module.slow_query_log, "log_file", str(tmp_path / "slow.log"))
+    monkeypatch.setattr(module.slow_query_log, "logger", None)
+    send(server, "/get/oximeter/user_id/73519/steps/86421")
+    status, _, body = send(server, "/stats/slowQueries")
+    entries = json.loads(body)["slowQueries"]["entries"]
+    entry = next(e for e in entries if e["query"].startswith("SELECT") and "FROM oximeter" in e["query"])
+    assert "user_id" in entry["query"] and entry["values"] and set(entry["values"]) <= {"int", "str"}
+    assert "73519" not in body.decode() and "86421" not in body.decode()
+    assert "73519" not in (tmp_path / "slow.log").read_text()
+    module.slow_query_log.logger.handlers[-1].close()
+    module.slow_query_log.logger.removeHandler(module.slow_query_log.logger.handlers[-1])
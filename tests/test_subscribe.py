@@ -0,0 +1,54 @@
+# coding: utf-8
+"""
+/subscribe: long-poll cursor and parameter checks (pytest)
+
+usage (from the tests folder):
+    python3 -m pytest -q test_subscribe.py
+"""
+import json
+
+from conftest import send, call
+
+
+def subscribe(server, path):
+    status, _, body = send(server, path)
+    return status, json.loads(body)
+
+
+def test_new_rows_after_cursor(server):
+    status, res = subscribe(server, "/subscribe/oximeter?timeout=0")
+    since = res["since"]
+    send(server, "/add/oximeter?user_id=3&heart_rate=70&blood_o2=97&temperature=98.1&steps=5")
+    status, res = subscribe(server, f"/subscribe/oximeter?timeout=0&since={since}")
+    assert status == 200
+    assert [row["user_id"] for row in res["data"]] == [3]
+    assert res["since"] == res["data"][-1]["entry_id"]
+
+
+def test_rolled_back_rows_are_not_published(server):
+    # -- the rowid of a rolled back insert is reused by the next insert: the cursor must not move past it
+    status, res = subscribe(server, "/subscribe/oximeter?timeout=0")
+    since = res["since"]
+    sample = {"user_id": 4, "heart_rate": 70, "blood_o2": 97, "temperature": 98.1, "steps": 5}
+    res = call(server, "/batch", [{"op": "add", "table": "oximeter", "params": sample},
+                                  {"op": "edit", "table": "oximeter", "params": {"temperature": 97}}])
+    assert res["failed"] == 1
+    status, res = subscribe(server, "/subscribe/oximeter?timeout=0")
+    assert res["since"] == since
+    send(server, "/add/oximeter?user_id=4&heart_rate=70&blood_o2=97&temperature=98.1&steps=6")
+    status, res = subscribe(server, f"/subscribe/oximeter?timeout=0&since={since}")
+    assert [row["steps"] for row in res["data"]] == [6]
+
+
+def test_table_without_id_column(server):
+    status, res = subscribe(server, "/subscribe/steps?timeout=0")
+    assert status == 200
+    assert res["message"].startswith("invalid table")
+
+
+def test_invalid_timeout_and_since(server):
+    for query in ("timeout=abc", "timeout=-1", "timeout=nan"):
+        status, res = subscribe(server, f"/subscribe/oximeter?{query}")
+        assert (status, res["message"].split(":")[0]) == (200, "invalid timeout")
+    status, res = subscribe(server, "/subscribe/oximeter?timeout=0&since=abc")
+    assert (status, res["message"].split(":")[0]) == (200, "invalid since")
@@ -0,0 +1,66 @@
+# coding: utf-8
+"""
+/add upserts (?upsert=user_id,entry_time): conflict handling on the natural key (pytest)
+
+usage (from the tests folder):
+    python3 -m pytest -q test_upsert.py
+
+the server fixture (conftest.py) creates the unique index on oximeter (user_id, entry_time)
+"""
+import json
+
+from conftest import send, count
+
+
+def add(server, query):
+    status, _, body = send(server, "/add/oximeter?heart_rate=70&blood_o2=97&temperature=98.1&steps=2&" + query)
+    return json.loads(body)
+
+
+def test_insert_then_update(server):
+    entry_time = "2004-01-01 00:00:00.000"
+    res = add(server, f"user_id=8&entry_time={entry_time}&upsert=user_id,entry_time")
+    assert res["upsert"]["action"] == "inserted"
+    entry_id = res["entry_id"]
+    res = add(server, f"user_id=8&entry_time={entry_time}&upsert=user_id,entry_time&heart_rate=99")
+    assert (res["upsert"]["action"], res["entry_id"]) == ("updated", entry_id)
+    assert count(server, "entry_time = (SELECT entry_time FROM oximeter WHERE entry_id = ?)", [entry_id]) == 1
+    assert count(server, "entry_id = ? AND heart_rate = 99 AND user_id = 8", [entry_id]) == 1
+
+
+def test_other_user_same_time_is_inserted(server):
+    # -- the natural key includes user_id: another user's sample at the same time is a new row
+    entry_time = "2004-02-01 00:00:00.000"
+    first = add(server, f"user_id=8&entry_time={entry_time}&upsert=user_id,entry_time")
+    second = add(server, f"user_id=9&entry_time={entry_time}&upsert=user_id,entry_time")
+    assert (first["upsert"]["action"], second["upsert"]["action"]) == ("inserted", "inserted")
+    assert first["entry_id"] != second["entry_id"]
+
+
+def test_on_conflict_nothing(server):
+    entry_time = "2004-03-01 00:00:00.000"
+    entry_id = add(server, f"user_id=8&entry_time={entry_time}&upsert=user_id,entry_time")["entry_id"]
+    res = add(server, f"user_id=8&entry_time={entry_time}&upsert=user_id,entry_time&on_conflict=nothing&heart_rate=99")
+    assert (res["upsert"]["action"], res["entry_id"]) == ("ignored", None)
+    # -- the existing row is kept as it was
+    assert count(server, "entry_time = (SELECT entry_time FROM oximeter WHERE entry_id = ?)", [entry_id]) == 1
+    assert count(server, "entry_id = ? AND heart_rate = 70", [entry_id]) == 1
+
+
+def test_invalid_upserts_are_refused(server):
+    before = count(server)
+    # -- no unique index on the columns
+    res = add(server, "user_id=8&upsert=user_id,steps")
+    assert res["message"].startswith("invalid upsert: no unique index")
+    assert ["entry_time", "user_id"] in res["unique_keys"]
+    # -- a key without user_id would match another user's rows
+    res = add(server, "user_id=8&entry_time=2004-04-01 00:00:00.000&upsert=entry_time")
+    assert (res["message"], res["required"]) == ("invalid upsert", ["user_id"])
+    # -- unknown columns and options
+    assert add(server, "user_id=8&upsert=user_id,nope")["unknown"] == ["nope"]
+    res = add(server, "user_id=8&entry_time=2004-04-01 00:00:00.000&upsert=user_id,entry_time&on_conflict=replace")
+    assert res["message"] == "invalid upsert"
+    # -- the key columns are required
+    res = add(server, "user_id=8&upsert=user_id,entry_time")
+    assert res["message"] == "missing paramaters"
+    assert count(server) == before